@@ -2,20 +2,22 @@ import streamlit as st
 import pandas as pd
 import os
 import json
-import tempfile
 import logging
 import pytz 
-import sys
+import threading
 
 from datetime import datetime, timedelta
 from google.cloud import bigquery
-from google.api_core.exceptions import NotFound, BadRequest, GoogleAPICallError
-from io import StringIO
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from ga4queries import *
+from ga4jobs import limit_jobs, run_jobs, DONE
+from ga4pipeline import DatasetCheckError, build_pipeline_jobs, check_dataset, choose_date_window, discover_keys_and_types, get_table_patterns
+from ga4telemetry import byte_budget, format_bytes, recording, summarize_job_records
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, filename='script.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+# Configure logging, appending so earlier runs are kept. Set GA4TOBQ_LOG_LEVEL=DEBUG to also log the generated SQL.
+logging.basicConfig(level=os.environ.get("GA4TOBQ_LOG_LEVEL", "INFO"), filename='script.log', filemode='a', format='%(asctime)s %(threadName)s %(name)s - %(levelname)s - %(message)s')
 
 # Create a dictionary with country name and corresponding timezone
 timezone_dict = {
@@ -86,9 +88,48 @@ timezone_dict = {
 continents = ["Oceania","North America", "South America", "Europe", "Asia"]
 
 # Create a list of ranges
-dranges = ["All","Days", "Months"]
+dranges = ["All", "Last N days", "Date range"]
+
+# How the event table is deployed, labels for ga4pipeline.EVENT_MODES
+event_modes = {"View": "view", "Materialized table": "materialized"}
+
+# BigQuery jobs allowed to run at the same time
+max_parallel_jobs = 4
 
-view_names = "user_table_view", "event_table_view", "item_table_view"
+# BigQuery jobs allowed at the same time for one project across every session of a hosted app,
+# MAX_PROJECT_JOBS in the Streamlit secrets overrides it
+max_project_jobs = 8
+
+##############################################################################################################################################
+# Caching
+##############################################################################################################################################
+# Streamlit reruns this script on every widget change. The client is kept for as long as the app runs, and the
+# dataset checks, cost estimates and discovered keys for a while, so changing a dropdown doesn't redo BigQuery work.
+# Cached BigQuery results are keyed by the service account as well, so sessions only share what they could read.
+# Arguments starting with an underscore aren't part of the cache key.
+
+@st.cache_resource
+def get_client(key_json):
+    return bigquery.Client.from_service_account_info(json.loads(key_json))
+
+@st.cache_resource
+def get_project_semaphore(project_id, max_jobs):
+    return threading.BoundedSemaphore(max_jobs)
+
+@st.cache_data(ttl=SHARD_CATALOG_TTL_SECONDS, show_spinner=False)
+def cached_check_dataset(_client, account, project_id, dataset_id, utc_ts):
+    return check_dataset(_client, project_id, dataset_id, utc_ts)
+
+@st.cache_data(ttl=SHARD_CATALOG_TTL_SECONDS, show_spinner="Estimating bytes scanned...")
+def cached_plan(_client, account, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, pivot_strategy, date_window, budget_bytes, pivot_arrays, event_mode):
+    # (date_window, estimates), the widest window within budget_bytes if there is one
+    if budget_bytes:
+        return choose_date_window(_client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, budget_bytes, pivot_strategy, pivot_arrays=pivot_arrays, event_mode=event_mode)
+    return date_window, plan_pipeline_costs(_client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, pivot_strategy=pivot_strategy, date_window=date_window, pivot_arrays=pivot_arrays, event_mode=event_mode)
+
+@st.cache_data(ttl=SHARD_CATALOG_TTL_SECONDS, show_spinner="Finding event parameter keys...")
+def cached_keys_and_types(_client, account, project_id, dataset_id, event_table_patterns, user_table_pattern, date_window, utc_ts, pivot_arrays, max_keys):
+    return discover_keys_and_types(_client, project_id, dataset_id, event_table_patterns, user_table_pattern, utc_ts, date_window, pivot_arrays, top_n=max_keys)
 
 ##############################################################################################################################################
 # Streamlit Layout
@@ -117,7 +158,6 @@ with tab2:
              
             Things to do:
              - Error checking and notification needs to be improved.
-             - Unnest and add audience data for users 
 
             If you have any questions or feedback do not heistate to contact us at **howdy@teamcircle.tech**
             ''')
@@ -147,27 +187,69 @@ with tab1:
 
 
     today = datetime.now(pytz.timezone(utc_ts)) 
-    formatted_today = today.strftime('%Y%m%d')
-    formatted_days = today.strftime('%Y%m*')
-    formatted_months = today.strftime('%Y*')
-    yesterday = today - timedelta(days=1)
-    formatted_yesterday = yesterday.strftime('%Y%m%d')
 
     st.write('''
         ### Set daterange adjustment:
-        **What this does:** The drop downs below alters how far back the data is checked, if the process is timing out you will want to restrict the amount of data you pull in 
+        **What this does:** The drop downs below alters how far back the data is checked, if the process is timing out you will want to restrict the amount of data you pull in. "Last N days" is worked out each time the views are queried, so it keeps rolling forward without having to rerun this app 
             ''')
     # Create a dropdown to select date range 
     drange = st.selectbox("2. Select a date range", dranges)
     if drange == "All":
-        wildcard_date = f"*"
-    elif drange == "Days":
-        wildcard_date = f"{formatted_days}"
-    elif drange == "Months":
-        wildcard_date = f"{formatted_months}"
-    st.markdown(f"Date Range: **{wildcard_date}**")
+        date_window = None
+    elif drange == "Last N days":
+        date_window = {"days": st.number_input("Number of days, including today", min_value=1, value=30)}
+    elif drange == "Date range":
+        date_range = st.date_input("Start and end dates", (today.date() - timedelta(days=30), today.date()))
+        if len(date_range) < 2:
+            st.info("Select an end date to continue")
+            st.stop()
+        date_window = {"start": date_range[0].strftime('%Y%m%d'), "end": date_range[1].strftime('%Y%m%d')}
+    st.markdown(f"Date Range: **{describe_date_window(date_window)}**")
+
+    st.write('''
+        **Byte budget:** Every query is dry-run first so you can see how much data each step will scan before anything is created. With a budget set, the widest date range whose estimate fits is used instead of the drop down, and the run stops once its queries have billed the budget: every query is capped at its own estimate and may only start while that still fits in what is left. A materialized event table is priced by the days it would merge, and keeps the days outside a range chosen for the budget 
+            ''')
+    budget_gb = st.number_input("Byte budget in GB (0 for no limit)", min_value=0.0, value=0.0, step=10.0)
 
-    event_table_patterns = "events_"+wildcard_date, "events_intraday_"+wildcard_date
+    event_table_patterns = "events_*", "events_intraday_*"
+
+    st.write('''
+        ### Set event table mode:
+        **What this does:** A view re-flattens every event each time a dashboard reads it. A materialized table is partitioned by day and clustered by event name and user, and each run only merges the days that are new or that GA4 has restated since the last run (a new parameter key gets a column from the day it is found, earlier days keep it in event_params_other, and days a date window has moved past are dropped), so dashboards only scan the days they ask for 
+            ''')
+    event_mode = st.selectbox("3. Select an event table mode", list(event_modes))
+    st.write('''
+        **User table mode:** A view ranks every daily users snapshot on each read to find each user's latest state. A materialized table keeps that latest state and only merges in the snapshots that are new or restated since the last run, and removes users last active before the date range as it moves 
+            ''')
+    user_mode = st.selectbox("3b. Select a user table mode", list(event_modes))
+    st.write('''
+        **Event parameter pivot:** "unnest" expands every event into one row per parameter and groups them back together (exact duplicate events in the export are merged). "subquery" looks each parameter up inside its own event, one row per event, which avoids the large regroup on properties with many parameters but keeps exact duplicate events, unless they are written to a materialized table 
+            ''')
+    pivot_strategy = st.selectbox("4. Select an event parameter pivot", PIVOT_STRATEGIES)
+    st.write('''
+        **Parameter columns:** Every event parameter key normally gets its own column. Limiting it to the most frequent keys keeps the view and its SQL small on properties with hundreds of one-off keys; the remaining parameters are kept as JSON in event_params_other 
+            ''')
+    max_keys = st.number_input("4b. Most frequent parameter keys to give a column (0 = all)", min_value=0, value=0, step=10)
+    st.write('''
+        **Daily rollups:** Small tables with one row per day, source/medium, device, country and event (and per item for ecommerce), with users and sessions stored as sketches. Point dashboard tiles at daily_event_rollup_view, daily_item_rollup_view or daily_totals_view and they read kilobytes instead of re-flattening every event 
+            ''')
+    rollups = st.checkbox("4c. Maintain daily rollup tables for dashboards")
+    st.write('''
+        **Column profiles:** The event view carries every geo, device, traffic source and ecommerce field. A profile builds an extra, narrower event_table_view_<profile> with only the dimensions it names (core: event, platform, stream, country and device category; acquisition adds traffic source and location detail; ecommerce adds the purchase fields), so dashboards that read it scan and regroup a fraction of the data 
+            ''')
+    column_profiles = st.multiselect("4d. Narrower event views to build", [profile for profile in EVENT_COLUMN_PROFILES if profile != "full"])
+    st.write('''
+        **Nested arrays:** Event parameters always get a column per key. The same can be done for the user properties sent with each event (user_property_<key> in the event view), the item parameters of each item (item_param_<key> in the item view) and the audiences of each user (audience_<name> in the user view, when they joined). Their keys are found in the same scan as the event parameters 
+            ''')
+    pivot_arrays = st.multiselect("4e. Nested arrays to pivot into columns", PIVOT_ARRAYS)
+    st.write('''
+        **Event name views:** Most parameter columns of the event view are empty for most events, a purchase parameter is never set on a page_view. Each event name listed here gets its own <event_name>_event_view with only those events and a column for only the parameters they carry, for dashboards about one kind of event 
+            ''')
+    event_name_views = [event_name.strip() for event_name in st.text_input("4f. Event names to build their own view for, comma separated (e.g. purchase, page_view)").split(",") if event_name.strip()]
+    st.write('''
+        **Profiling sample:** Summary statistics profile every column in one pass to find the columns that never change. On a materialized event table the profile can read a sample of the table instead of all of it. A sparse column can look empty or constant in a sample, so a sampled profile only feeds the data quality checks and the _mini views keep every column 
+            ''')
+    sample_percent = st.slider("5. Percent of the materialized event table to profile", min_value=1, max_value=100, value=100)
 
     st.write('''
             ### Connect Google Analytics 4 (GA4) to BigQuery:
@@ -197,16 +279,9 @@ with tab1:
         st.info("Upload GA JSON Authenticator to continue")
         st.stop()
 
-    if json_file :
-        with tempfile.NamedTemporaryFile(delete=False) as fp:
-            fp.write(json_file.getvalue())
-        try:
-            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = fp.name          
-            with open(fp.name,'rb') as a:
-                client = bigquery.Client()
-        finally:
-            if os.path.isfile(fp.name):
-                os.unlink(fp.name)
+    key_json = json_file.getvalue().decode()
+    client = get_client(key_json)
+    account = json.loads(key_json).get("client_email")
     
     if "PROJECT_ID" in st.secrets:
         project_id = st.secrets["PROJECT_ID"]
@@ -231,93 +306,97 @@ with tab1:
         st.info("Enter a Dataset ID to continue")
         st.stop()
 
-    # Generate table list to account for known users, traffic for the day
-    tables = client.list_tables(project_id+'.'+dataset_id)
-    table_names = set(table.table_id for table in tables)
+    # Every BigQuery job of this run, for the run report at the end
+    job_records = []
+    target = f"{project_id}.{dataset_id}"
 
-    # Checking if the events table exists if not error out
+    # Checking that yesterday's events and today's intraday events exist, and whether there are known users
     st.write("Checking for events yesterday today")
-    events_intra = "events_"+formatted_yesterday
-    if events_intra not in table_names:
-        st.error("You have no events on your site for yesterday, do you have streaming turned on: https://support.google.com/analytics/answer/9823238")
-        sys.exit()
-    else:
-        st.write("Events for yesterday found")
-
-    # Checking if the today events_intraday table exists, if not it errors our
-    events_intra = "events_intraday_"+formatted_today
-    st.write("Checking for traffic today:")
-    st.write(events_intra)
-    if events_intra not in table_names:
-        st.error("You have no traffic on your site for today, please generate some")
-        sys.exit()
-    else:
-        st.write("Events for today found")
-
-    #Check if there are known users 
-    st.write("Checking for known users")
-    user_table = "users_"+formatted_yesterday
-    # Check if the 'users' table exists
-    if user_table in table_names:
-        st.write("Table "+user_table+" does exist.")
-        user_table_pattern = "users_"+wildcard_date, "pseudonymous_users_"+wildcard_date
-        userid_sub = "sub.user_id, sub.user_pseudo_id,"
-    else:
-        st.write("Table "+user_table+" does not exist.")
-        user_table_pattern = "pseudonymous_users_"+wildcard_date,""
-        userid_sub = "sub.user_pseudo_id,"
+    try:
+        with recording(job_records, "Planning", target):
+            dataset = cached_check_dataset(client, account, project_id, dataset_id, utc_ts)
+    except DatasetCheckError as e:
+        st.error(str(e))
+        st.stop()
+    st.write("Events for yesterday and today found")
+    st.write("Known users found" if dataset["known_users"] else "No known users found")
+    event_table_patterns, user_table_pattern, userid_sub = get_table_patterns(dataset["known_users"])
+    item_check_table = dataset["item_check_table"]
+
+    # Dry-run everything before anything is created
+    budget_bytes = int(budget_gb * 1024**3) if budget_gb else None
+    try:
+        with recording(job_records, "Planning", target):
+            date_window, estimates = cached_plan(client, account, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, pivot_strategy, date_window, budget_bytes, pivot_arrays, event_modes[event_mode])
+    except DatasetCheckError as e:
+        st.error(str(e))
+        st.stop()
+    if budget_bytes:
+        st.markdown(f"Date Range within budget: **{describe_date_window(date_window)}**")
+    st.table(pd.DataFrame(
+        [(step, format_bytes(num_bytes)) for step, num_bytes in estimates.items()] + [("Total", format_bytes(sum(estimates.values())))],
+        columns=["Step", "Estimated bytes scanned"],
+    ))
+
+    # Nothing is created until asked for, so changing a setting above only redoes the (cached) checks
+    if not st.button("Run", type="primary"):
+        st.info("Press Run to create the tables and views")
+        st.stop()
 
     #This is where things are run
-    keys_and_types = get_unique_keys_and_types(client, project_id, dataset_id, event_table_patterns)
-    st.write("Unique keys and types retrieved successfully.")
-    if keys_and_types:
-
-        st.write("Retrieved keys and types.")#, keys_and_types)
-        st.write("Creating User Table View.")
-        logging.info(user_table_pattern)
-        create_user_table_view(client, project_id, dataset_id, user_table_pattern, utc_ts)
-        st.write("User Table Created")
-        
-        st.write("Creating Event Table View.")
-        logging.info(event_table_patterns)
-        create_event_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts)
-        st.write("Event Table Created.")
-
-        #check if there are any items 
-        st.write("Checking for eCommerce.")
-        itemcheckquery = f"""
-        SELECT it.item_id AS item_id, FROM ( SELECT GENERATE_UUID() as ueid, * FROM `{project_id}.{dataset_id}.events_{formatted_yesterday}`) sub CROSS JOIN UNNEST(sub.items) AS it LIMIT 1
-        """
-        logging.info(itemcheckquery)
-        query_job = client.query(itemcheckquery)
-        # Attempt to fetch one row
-        try:
-            # Get the results
-            results = query_job.result()  # Waits for the job to complete
-
-            # Fetch one row
-            row = next(results, None)
-
-            # Check if the query returned at least one result
-            if row:
-                create_item_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts)
-                st.write("Items Table View Created")
-            else:
-                st.write("No items found in event table")
-                view_names = "user_table_view", "event_table_view"
-
-        except Exception as e:
-            st.error(f"Error occurred: {e}")
-
-        st.write("Creating Summary Statistics")
-        create_summary_statistics(client, project_id, dataset_id, view_names)
-        st.write("Summary Statistics Created")
+    # Every job is capped at what is left of the budget, so the whole run can't bill more than it
+    budget = byte_budget(budget_bytes) if budget_bytes else None
+    with recording(job_records, "Key discovery", target, budget):
+        keys_and_types = cached_keys_and_types(client, account, project_id, dataset_id, event_table_patterns, user_table_pattern, date_window, utc_ts, pivot_arrays, max_keys or None)
+    jobs = build_pipeline_jobs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, date_window, event_modes[event_mode], pivot_strategy, sample_percent if sample_percent < 100 else None, event_modes[user_mode], max_keys=max_keys or None, rollups=rollups, job_records=job_records, keys_and_types=keys_and_types, column_profiles=column_profiles, pivot_arrays=pivot_arrays, event_name_views=event_name_views, budget=budget, drop_outside_window=not budget_bytes)
+    project_jobs = int(st.secrets["MAX_PROJECT_JOBS"]) if "MAX_PROJECT_JOBS" in st.secrets else max_project_jobs
+    jobs = limit_jobs(jobs, get_project_semaphore(project_id, project_jobs))
+
+    progress = st.empty()
+    def show_progress(status):
+        progress.table(pd.DataFrame(
+            [(name, entry["status"], f"{entry['elapsed']:.1f}s", entry["error"] or "") for name, entry in status.items()],
+            columns=["Step", "Status", "Elapsed", "Error"],
+        ))
+
+    # Worker threads need the script context to write to the page
+    script_run_ctx = get_script_run_ctx()
+    status = run_jobs(jobs, max_workers=max_parallel_jobs, on_update=show_progress, initializer=lambda: add_script_run_ctx(threading.current_thread(), script_run_ctx))
+
+    # Run report: what each step cost in BigQuery, then every job with its slowest stages
+    st.write("Run report")
+    job_totals = summarize_job_records(job_records)
+    st.table(pd.DataFrame(
+        [
+            (step, totals["jobs"], totals["cached"], totals["skipped"], f"{totals['elapsed_seconds']:.1f}s", format_bytes(totals["bytes_processed"]), format_bytes(totals["bytes_billed"]), f"{totals['slot_ms'] / 1000:,.1f}", format_bytes(totals["shuffle_bytes"]))
+            for step, totals in job_totals.items()
+        ],
+        columns=["Step", "Jobs", "Cached", "Unchanged", "Elapsed", "Bytes processed", "Bytes billed", "Slot seconds", "Shuffle"],
+    ))
+    with st.expander("BigQuery jobs"):
+        st.dataframe(pd.DataFrame(
+            [
+                {
+                    "step": record["step"], "job": record["name"], "elapsed_seconds": record["elapsed_seconds"],
+                    "bytes_billed": record.get("bytes_billed"), "slot_ms": record.get("slot_ms"), "cache_hit": record.get("cache_hit"),
+                    "slowest_stages": ", ".join(f"{stage['name']} {stage['duration_ms'] or 0:.0f}ms" for stage in record.get("slowest_stages") or []),
+                    "job_id": record.get("job_id"), "error": record["error"],
+                }
+                for record in job_records
+            ]
+        ))
+
+    if status["Summary statistics"]["status"] == DONE:
+        data_quality_checks = get_data_quality_checks(status["Summary statistics"]["result"])
+        if data_quality_checks:
+            st.write("Data quality checks")
+            st.dataframe(pd.DataFrame(data_quality_checks))
+
+    if all(entry["status"] == DONE for entry in status.values()):
         st.write("FINISHED!")
         st.write('''
             ### Notes
             [Link to looker dashboard](https://lookerstudio.google.com/reporting/5d4d6088-3ecb-48d8-8059-cc08cbbfac4d/preview)
             ''')
     else:
-        st.write("Failed to retrieve keys and types.")
-
-
+        st.error("Some steps did not finish, check the table above and your logs")
@@ -0,0 +1,76 @@
+import argparse
+import json
+import logging
+
+from google.cloud import bigquery
+
+from ga4queries import PIVOT_STRATEGIES, generate_event_table_query, get_unique_keys_and_types
+
+# Compare the event_params pivot strategies on real BigQuery jobs.
+#
+#   python ga4bench.py my-project.analytics_123456 --patterns events_20261017 --keys 50 500 2000
+#
+# Every run is a real, uncached query, so point --patterns at a single day unless you mean to pay for more.
+
+def pad_keys(keys_and_types, key_count):
+    # Use the real keys first, then pad with keys that never occur so the column count is what we asked for
+    keys = dict(list(keys_and_types.items())[:key_count])
+    for i in range(key_count - len(keys)):
+        keys[f"ga4tobq_bench_{i}"] = "string"
+    return keys
+
+def get_job_statistics(query_job):
+    query_plan = query_job.query_plan or []
+    return {
+        "elapsed_ms": int((query_job.ended - query_job.started).total_seconds() * 1000),
+        "slot_ms": query_job.slot_millis,
+        "bytes_processed": query_job.total_bytes_processed,
+        "shuffle_output_bytes": sum(stage.shuffle_output_bytes or 0 for stage in query_plan),
+        "shuffle_output_bytes_spilled": sum(stage.shuffle_output_bytes_spilled or 0 for stage in query_plan),
+        "sql_length": len(query_job.query),
+    }
+
+def run_benchmark(client, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, key_counts, strategies):
+    discovered = get_unique_keys_and_types(client, project_id, dataset_id, event_table_patterns)
+    job_config = bigquery.QueryJobConfig(use_query_cache=False)
+
+    results = []
+    for key_count in key_counts:
+        keys_and_types = pad_keys(discovered, key_count)
+        for strategy in strategies:
+            query = generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, strategy)
+            query_job = client.query(query, job_config=job_config)
+            query_job.result()
+            result = {"strategy": strategy, "keys": key_count, "job_id": query_job.job_id}
+            result.update(get_job_statistics(query_job))
+            logging.info(f"Benchmark result: {result}")
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the event_params pivot strategies in BigQuery")
+    parser.add_argument("target", help="project.dataset holding the GA4 export")
+    parser.add_argument("--patterns", nargs="+", default=["events_*"], help="event table patterns to read")
+    parser.add_argument("--keys", nargs="+", type=int, default=[50, 500, 2000], help="number of pivoted keys")
+    parser.add_argument("--strategies", nargs="+", default=PIVOT_STRATEGIES, choices=PIVOT_STRATEGIES)
+    parser.add_argument("--timezone", default="UTC")
+    parser.add_argument("--with-user-id", action="store_true", help="the export has a users_ table, so include user_id")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    project_id, dataset_id = args.target.split(".", 1)
+    userid_sub = "sub.user_id, sub.user_pseudo_id," if args.with_user_id else "sub.user_pseudo_id,"
+    client = bigquery.Client(project=project_id)
+
+    results = run_benchmark(client, project_id, dataset_id, args.patterns, userid_sub, args.timezone, args.keys, args.strategies)
+
+    print(f"{'strategy':<10} {'keys':>6} {'elapsed ms':>11} {'slot ms':>12} {'shuffle bytes':>15} {'bytes processed':>16}")
+    for result in results:
+        print(f"{result['strategy']:<10} {result['keys']:>6} {result['elapsed_ms']:>11} {result['slot_ms']:>12} {result['shuffle_output_bytes']:>15} {result['bytes_processed']:>16}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import logging
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ga4queries import get_shard_catalog, match_shards
+from ga4telemetry import run_query_job
+
+# Export the flattened views (or their _mini variants, or the materialized tables) to local Parquet without pulling
+# whole results into Python. Rows are read as Arrow record batches through the BigQuery Storage Read API, several
+# streams at a time, and each stream writes its own file, so memory is a few batches per stream whatever the size.
+#
+#   out/event_table_view/event_partition_date=2026-10-17/part-0000.parquet
+#   out/user_table_view/part-0000.parquet
+#
+# Anything with an event_date column is split by date, the rest is exported whole. Views are first written to a
+# staging table, ga4tobq_export_<view>, partitioned by date if they have one. A partition directory only gets
+# its final name once every stream has finished writing it, and partitions that already exist are skipped, so an
+# interrupted export is resumed by running it again.
+
+# Dates come from the event shards, whichever view is exported
+EVENT_TABLE_PATTERNS = ("events_*", "events_intraday_*")
+
+def get_export_dates(client, project_id, dataset_id, date_window=None, utc_ts="UTC"):
+    # GA4 dates in the window, from the shard catalog so nothing is scanned to find them
+    catalog = get_shard_catalog(client, project_id, dataset_id)
+    return sorted(match_shards(catalog, EVENT_TABLE_PATTERNS, date_window, utc_ts))
+
+def get_partition_dir(output_dir, view_name, date):
+    if date is None:
+        return os.path.join(output_dir, view_name)
+    return os.path.join(output_dir, view_name, f"event_partition_date={date[:4]}-{date[4:6]}-{date[6:]}")
+
+# Views are staged in a table next to them, dropped after the export or by BigQuery itself if it is interrupted
+EXPORT_STAGING_PREFIX = "ga4tobq_export_"
+EXPORT_STAGING_HOURS = 24
+
+def stage_export(client, table, dates):
+    # (table, partitioned, selected_fields) for the Storage Read API to read. Tables are read directly. A view is
+    # queried once for all pending dates into a staging table, the API can't read views and an anonymous result
+    # table is capped in size. It is partitioned by date like the materialized tables, so each day's read session
+    # only reads that day, and selected_fields leaves the partition column out of the files.
+    if table.table_type == "TABLE":
+        partitioned = bool(table.time_partitioning and table.time_partitioning.field == "event_partition_date")
+        return table, partitioned, None
+
+    staging_id = f"{table.project}.{table.dataset_id}.{EXPORT_STAGING_PREFIX}{table.table_id}"
+    source = f"SELECT * FROM `{table.project}.{table.dataset_id}.{table.table_id}`"
+    partition_sql = ""
+    if dates:
+        date_list = ", ".join(f"'{date}'" for date in dates)
+        source = f"SELECT *, PARSE_DATE('%Y%m%d', event_date) AS event_partition_date FROM ({source}) WHERE event_date IN ({date_list})"
+        partition_sql = "PARTITION BY event_partition_date"
+    query = f"""
+    CREATE OR REPLACE TABLE `{staging_id}`
+    {partition_sql}
+    OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {EXPORT_STAGING_HOURS} HOUR))
+    AS {source}
+    """
+    logging.info(f"Staging {table.table_id} for export in {staging_id}")
+    run_query_job(client, query, name=f"{table.table_id} export")
+    return client.get_table(staging_id), bool(dates), [field.name for field in table.schema]
+
+def get_row_restriction(date, partitioned):
+    if date is None:
+        return ""
+    if partitioned:
+        # Filtering on the partition column lets the read session skip every other day
+        return f"event_partition_date = '{date[:4]}-{date[4:6]}-{date[6:]}'"
+    return f"event_date = '{date}'"
+
+def read_stream(read_client, session, stream_name, path):
+    # Write one stream to its own Parquet file a record batch at a time, returns the rows written
+    import pyarrow.parquet as pq
+
+    writer = None
+    rows = 0
+    try:
+        for page in read_client.read_rows(stream_name).rows(session).pages:
+            batch = page.to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+def export_partition(read_client, table, row_restriction, partition_dir, max_streams, selected_fields=None):
+    from google.cloud.bigquery_storage import types
+
+    read_session = types.ReadSession(
+        table=f"projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}",
+        data_format=types.DataFormat.ARROW,
+        read_options=types.ReadSession.TableReadOptions(selected_fields=selected_fields or [], row_restriction=row_restriction),
+    )
+    session = read_client.create_read_session(parent=f"projects/{table.project}", read_session=read_session, max_stream_count=max_streams)
+
+    temp_dir = partition_dir + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    with ThreadPoolExecutor(max_workers=max(len(session.streams), 1)) as executor:
+        futures = [
+            executor.submit(read_stream, read_client, session, stream.name, os.path.join(temp_dir, f"part-{i:04d}.parquet"))
+            for i, stream in enumerate(session.streams)
+        ]
+        rows = sum(future.result() for future in futures)
+    os.replace(temp_dir, partition_dir)
+    return rows
+
+def export_view(client, project_id, dataset_id, view_name, output_dir, date_window=None, utc_ts="UTC", max_streams=4, overwrite=False, credentials=None):
+    # Returns {GA4 date or "all": rows written, None if it was already there}. The Storage Read API is called with
+    # credentials, or the application default credentials without them.
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        raise ImportError("Exporting needs the BigQuery Storage API and pyarrow, pip install -r requirements-export.txt")
+
+    table = client.get_table(f"{project_id}.{dataset_id}.{view_name}")
+    dated = any(field.name == "event_date" for field in table.schema)
+    dates = get_export_dates(client, project_id, dataset_id, date_window, utc_ts) if dated else [None]
+    written = {}
+    pending = []
+    for date in dates:
+        partition_dir = get_partition_dir(output_dir, view_name, date)
+        if os.path.exists(partition_dir):
+            if not overwrite:
+                written[date or "all"] = None
+                continue
+            shutil.rmtree(partition_dir)
+        pending.append(date)
+    logging.info(f"Exporting {len(pending)} of {len(dates)} partitions of {view_name}")
+    if not pending:
+        return written
+
+    source, partitioned, selected_fields = stage_export(client, table, [date for date in pending if date])
+    read_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+    for date in pending:
+        partition_dir = get_partition_dir(output_dir, view_name, date)
+        os.makedirs(os.path.dirname(partition_dir), exist_ok=True)
+        rows = export_partition(read_client, source, get_row_restriction(date, partitioned), partition_dir, max_streams, selected_fields)
+        written[date or "all"] = rows
+        logging.info(f"Exported {rows} rows of {view_name} to {partition_dir}")
+    if source is not table:
+        client.delete_table(source, not_found_ok=True)
+    return written
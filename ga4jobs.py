@@ -0,0 +1,106 @@
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Job states reported to on_update
+PENDING, RUNNING, DONE, FAILED, SKIPPED = "pending", "running", "done", "failed", "skipped"
+
+def run_jobs(jobs, max_workers=4, on_update=None, initializer=None, poll_seconds=0.5):
+    # Run a small DAG of blocking jobs, at most max_workers at a time.
+    #
+    # jobs is {name: (fn, [names it depends on])}. Each fn is called with a dict of the results of the jobs
+    # that have finished so far, and its return value becomes its result. A job whose dependency failed or was
+    # skipped is skipped. on_update gets the status table from the calling thread every time something changes
+    # and every poll_seconds while jobs are running, so it can redraw progress and elapsed times.
+    #
+    # Returns {name: {"status", "result", "error", "started", "elapsed"}}.
+    for name, (_, dependencies) in jobs.items():
+        unknown = [dependency for dependency in dependencies if dependency not in jobs]
+        if unknown:
+            raise ValueError(f"Job {name} depends on unknown jobs: {unknown}")
+
+    status = {name: {"status": PENDING, "result": None, "error": None, "started": None, "elapsed": 0.0} for name in jobs}
+    results = {}
+    running = {}
+
+    def notify():
+        now = time.monotonic()
+        for entry in status.values():
+            if entry["status"] == RUNNING:
+                entry["elapsed"] = now - entry["started"]
+        if on_update:
+            on_update(status)
+
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=initializer) as executor:
+        while True:
+            # Skip whatever can no longer run, then submit everything whose dependencies are done
+            for name, (fn, dependencies) in jobs.items():
+                if status[name]["status"] != PENDING:
+                    continue
+                if any(status[dependency]["status"] in (FAILED, SKIPPED) for dependency in dependencies):
+                    status[name]["status"] = SKIPPED
+                    logging.info(f"Skipping job {name}, a dependency did not finish")
+                elif all(status[dependency]["status"] == DONE for dependency in dependencies):
+                    status[name]["status"] = RUNNING
+                    status[name]["started"] = time.monotonic()
+                    running[executor.submit(fn, dict(results))] = name
+                    logging.info(f"Started job {name}")
+            notify()
+
+            if not running:
+                break
+
+            finished, _ = wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                entry = status[name]
+                entry["elapsed"] = time.monotonic() - entry["started"]
+                try:
+                    entry["result"] = results[name] = future.result()
+                    entry["status"] = DONE
+                    logging.info(f"Finished job {name} in {entry['elapsed']:.1f}s")
+                except Exception as e:
+                    entry["status"] = FAILED
+                    entry["error"] = str(e)
+                    logging.error(f"Job {name} failed after {entry['elapsed']:.1f}s: {e}")
+
+        # Anything still pending is waiting on a cycle
+        for entry in status.values():
+            if entry["status"] == PENDING:
+                entry["status"] = SKIPPED
+        notify()
+
+    return status
+
+def limit_jobs(jobs, semaphore):
+    # The same jobs, each holding semaphore while it runs, so job graphs running side by side (one per app
+    # session, say) share one cap on how many of their jobs run at once
+    def limited(fn):
+        def run(results):
+            with semaphore:
+                return fn(results)
+        return run
+    return {name: (limited(fn), dependencies) for name, (fn, dependencies) in jobs.items()}
+
+def select_jobs(jobs, names, previous_results):
+    # Only the jobs in names, for a refresh that knows what changed. A dependency that isn't in names returns its
+    # result from previous_results instead of running again, or runs too if there is none.
+    selected = {name for name in names if name in jobs}
+    pending = list(selected)
+    while pending:
+        for dependency in jobs[pending.pop()][1]:
+            if dependency not in selected and dependency not in previous_results:
+                selected.add(dependency)
+                pending.append(dependency)
+
+    def reuse(result):
+        return lambda results: result
+
+    selected_jobs = {}
+    for name, (fn, dependencies) in jobs.items():
+        if name in selected:
+            selected_jobs[name] = (fn, dependencies)
+        elif any(name in jobs[other][1] for other in selected):
+            selected_jobs[name] = (reuse(previous_results[name]), [])
+    return selected_jobs
@@ -0,0 +1,188 @@
+import logging
+import os
+import re
+
+# Runs the BigQuery SQL from ga4queries on GA4 export shards stored as local files, with duckdb.
+#
+# Shards are files named after their BigQuery table, events_20261017.parquet or pseudonymous_users_20261017.avro,
+# in one directory. References like `project.dataset.events_*` are pointed at a local view over the matching files
+# that has the same _TABLE_SUFFIX column as a BigQuery wildcard table, then sqlglot translates the SQL to duckdb.
+# duckdb and sqlglot are only needed for local runs and are imported when a connection is made.
+
+# The file readers for each shard format
+SHARD_READERS = {".parquet": "read_parquet", ".avro": "read_avro"}
+
+# A fully qualified BigQuery table reference in generated SQL, `project.dataset.table`
+TABLE_REFERENCE = re.compile(r"`([^`.]+)\.([^`.]+)\.([^`]+)`")
+
+class LocalEngineError(Exception):
+    # The local files can't answer the query
+    pass
+
+def connect(threads=None, memory_limit=None, temp_directory=None):
+    # A duckdb connection for running generated queries. memory_limit ("4GB") makes duckdb spill to temp_directory
+    # instead of growing past it.
+    try:
+        import duckdb
+    except ImportError:
+        raise LocalEngineError("Running queries locally needs duckdb, pip install -r requirements-local.txt")
+
+    con = duckdb.connect()
+    # TIMESTAMP_MICROS is UTC in BigQuery, the translated SQL relies on the session time zone for the same
+    con.execute("SET TimeZone = 'UTC'")
+    # duckdb has no FARM_FINGERPRINT. Its own hash gives different values, but the same ones for the same event in
+    # every table of a local run, which is all the event key needs.
+    con.execute("CREATE MACRO farm_fingerprint(value) AS hash(value)")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    if temp_directory:
+        con.execute(f"SET temp_directory = '{temp_directory}'")
+    return con
+
+def list_shards(shard_dir):
+    # {table_id: path} for every shard file in the directory
+    shards = {}
+    for file_name in sorted(os.listdir(shard_dir)):
+        table_id, extension = os.path.splitext(file_name)
+        if extension in SHARD_READERS:
+            shards[table_id] = os.path.join(shard_dir, file_name)
+    return shards
+
+def match_table_reference(shards, table_name):
+    # The shards a BigQuery table name covers. A trailing * matches on prefix, like a wildcard table.
+    if table_name.endswith("*"):
+        prefix = table_name[:-1]
+        return {table_id: path for table_id, path in shards.items() if table_id.startswith(prefix)}
+    return {table_name: shards[table_name]} if table_name in shards else {}
+
+def generate_shard_view_query(table_name, matched):
+    # One branch per file format, each reading all of its files in one scan. The file name gives _TABLE_SUFFIX.
+    prefix_length = len(table_name.rstrip("*"))
+    branches = []
+    for extension, reader in SHARD_READERS.items():
+        paths = [path for path in matched.values() if path.endswith(extension)]
+        if not paths:
+            continue
+        path_list = ", ".join(f"'{path}'" for path in paths)
+        suffix = f", substr(parse_filename(filename, true), {prefix_length + 1}) AS _TABLE_SUFFIX" if table_name.endswith("*") else ""
+        branches.append(f"SELECT * EXCLUDE (filename){suffix} FROM {reader}([{path_list}], filename = true, union_by_name = true)")
+    return " UNION ALL BY NAME ".join(branches)
+
+def to_duckdb_sql(query):
+    # BigQuery SQL with project.dataset.table references reduced to the table name, translated to duckdb
+    import sqlglot
+
+    local_query = TABLE_REFERENCE.sub(lambda match: f"`{match.group(3)}`", query)
+    return sqlglot.transpile(local_query, read="bigquery", write="duckdb")[0]
+
+def generate_tables_view_query(shards):
+    # The dataset's __TABLES__ metadata, just the table ids, for the filters that ask which shards exist
+    values = ", ".join(f"('{table_id}')" for table_id in sorted(shards))
+    return f"SELECT * FROM (VALUES {values}) AS t(table_id)"
+
+def register_shard_views(con, shards, query):
+    # Create a view for every table the query reads, named like the table so the translated SQL finds it
+    if any(path.endswith(".avro") for path in shards.values()):
+        con.execute("INSTALL avro; LOAD avro")
+    for table_name in sorted({match.group(3) for match in TABLE_REFERENCE.finditer(query)}):
+        if table_name == "__TABLES__":
+            con.execute(f'CREATE OR REPLACE VIEW "{table_name}" AS {generate_tables_view_query(shards)}')
+            continue
+        matched = match_table_reference(shards, table_name)
+        if not matched:
+            raise LocalEngineError(f"No local shards match {table_name}")
+        con.execute(f'CREATE OR REPLACE VIEW "{table_name}" AS {generate_shard_view_query(table_name, matched)}')
+
+def has_local_batch_fields(con, shards, table_ids):
+    # ga4queries.has_batch_fields for local shards, from the files' own schemas
+    from ga4queries import EVENT_BATCH_FIELDS
+
+    for table_id in table_ids:
+        columns = {row[0] for row in con.execute(f"DESCRIBE {generate_shard_view_query(table_id, {table_id: shards[table_id]})}").fetchall()}
+        if not set(EVENT_BATCH_FIELDS) <= columns:
+            return False
+    return True
+
+def prepare_query(con, shards, query):
+    # The duckdb SQL for a generated BigQuery query, with its source views in place
+    register_shard_views(con, shards, query)
+    local_query = to_duckdb_sql(query)
+    logging.debug(local_query)
+    return local_query
+
+def run_query(con, shards, query):
+    return con.execute(prepare_query(con, shards, query)).fetchall()
+
+def get_local_array_keys_and_types(con, shards, table_patterns, sources, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    # get_array_keys_and_types over local shards
+    from ga4queries import generate_key_discovery_query, get_array_key_statistics, select_array_pivot_keys
+
+    query = generate_key_discovery_query("local", "local", table_patterns, date_window, utc_ts, sources)
+    return select_array_pivot_keys(get_array_key_statistics(run_query(con, shards, query), sources), min_occurrences, top_n)
+
+def get_local_keys_and_types(con, shards, event_table_patterns, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    # get_unique_keys_and_types over local shards
+    return get_local_array_keys_and_types(con, shards, event_table_patterns, ["event_params"], date_window, utc_ts, min_occurrences, top_n)["event_params"]
+
+# Output tables of flatten_export, each a directory of Parquet files
+FLATTENED_TABLES = ["event_table", "item_table", "user_table"]
+
+def copy_to_parquet(con, shards, query, path, overwrite=False):
+    # Writes the query result to path and returns its row count, or None if the file is already there.
+    # The file is renamed into place once complete, so an interrupted run never leaves a partial partition behind.
+    if os.path.exists(path) and not overwrite:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    con.execute(f"COPY ({prepare_query(con, shards, query)}) TO '{temp_path}' (FORMAT PARQUET)")
+    os.replace(temp_path, path)
+    return con.execute(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0]
+
+def flatten_export(shard_dir, output_dir, utc_ts="UTC", date_window=None, pivot_strategy="unnest", threads=None, memory_limit=None, temp_directory=None, overwrite=False, min_key_occurrences=None, max_keys=None, pivot_arrays=()):
+    # Flattens a GA4 export on disk into Parquet with the same columns as the BigQuery views:
+    #
+    #   event_table/event_partition_date=2026-10-17/data.parquet
+    #   item_table/event_partition_date=2026-10-17/data.parquet
+    #   user_table/data.parquet
+    #
+    # Keys are discovered over every shard in the window first, so all partitions have the same columns. Then each
+    # day's shards are flattened on their own, which keeps memory bounded by one day while duckdb uses every core
+    # on it. Partitions already written are skipped unless overwrite is set, so a stopped run picks up where it was.
+    # Returns {table: {partition: rows written, None if skipped}}.
+    from ga4pipeline import get_table_patterns
+    from ga4queries import generate_event_table_query, generate_item_table_query, generate_user_table_query, get_array_sources, match_shards, prefer_daily_shards
+
+    con = connect(threads, memory_limit, temp_directory)
+    # Row order doesn't matter to the output and keeping it costs memory on large days
+    con.execute("SET preserve_insertion_order = false")
+    shards = list_shards(shard_dir)
+    known_users = any(table_id.startswith("users_") for table_id in shards)
+    event_table_patterns, user_table_pattern, userid_sub = get_table_patterns(known_users)
+
+    event_sources = get_array_sources(["event_params", *pivot_arrays], ["events", "items"])
+    array_keys = get_local_array_keys_and_types(con, shards, event_table_patterns, event_sources, date_window, utc_ts, min_key_occurrences, max_keys)
+    user_sources = get_array_sources(pivot_arrays, ["users"])
+    user_patterns = [pattern for pattern in user_table_pattern if pattern and match_shards(shards, [pattern], date_window, utc_ts)]
+    if user_sources and user_patterns:
+        array_keys.update(get_local_array_keys_and_types(con, shards, user_patterns, user_sources, date_window, utc_ts, min_key_occurrences, max_keys))
+    keys_and_types = array_keys["event_params"]
+    logging.info(f"Found {len(keys_and_types)} event_params keys in {shard_dir}")
+
+    written = {table: {} for table in FLATTENED_TABLES}
+    for suffix, table_ids in sorted(prefer_daily_shards(match_shards(shards, event_table_patterns, date_window, utc_ts)).items()):
+        partition = f"event_partition_date={suffix[:4]}-{suffix[4:6]}-{suffix[6:]}"
+        batch_fields = has_local_batch_fields(con, shards, table_ids)
+        event_query = generate_event_table_query(keys_and_types, "local", "local", table_ids, userid_sub, utc_ts, pivot_strategy, array_keys=array_keys, batch_fields=batch_fields)
+        written["event_table"][partition] = copy_to_parquet(con, shards, event_query, os.path.join(output_dir, "event_table", partition, "data.parquet"), overwrite)
+        item_query = generate_item_table_query(keys_and_types, "local", "local", table_ids, userid_sub, utc_ts, array_keys=array_keys, batch_fields=batch_fields)
+        written["item_table"][partition] = copy_to_parquet(con, shards, item_query, os.path.join(output_dir, "item_table", partition, "data.parquet"), overwrite)
+        logging.info(f"Flattened {partition} from {table_ids}")
+
+    # The latest state of each user needs every snapshot at once, duckdb spills to temp_directory if it has to
+    if match_shards(shards, user_table_pattern, date_window, utc_ts):
+        user_query = generate_user_table_query("local", "local", user_table_pattern, utc_ts, date_window, array_keys=array_keys)
+        written["user_table"]["all"] = copy_to_parquet(con, shards, user_query, os.path.join(output_dir, "user_table", "data.parquet"), overwrite)
+    con.close()
+    return written
@@ -0,0 +1,162 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from ga4local import connect, get_local_keys_and_types, list_shards, prepare_query
+from ga4queries import (
+    generate_event_table_query,
+    generate_item_table_query,
+    generate_key_discovery_query,
+    generate_profile_query,
+    generate_user_table_query,
+)
+from ga4synth import generate_export
+
+# Benchmark the SQL generators offline, on synthetic GA4 exports run with duckdb instead of BigQuery.
+#
+#   python ga4localbench.py --events-per-day 10000 100000 --keys 50 500 --output bench.json
+#   python ga4localbench.py --events-per-day 10000 100000 --keys 50 500 --baseline bench.json
+#
+# Every case materializes the full query result, in its own process so the peak memory is that query's alone.
+# With --baseline the results are compared against an earlier --output, and the exit status is 1 when any case
+# got slower, used more memory or generated more SQL by more than --threshold.
+
+EVENT_TABLE_PATTERNS = ("events_*", "events_intraday_*")
+USER_TABLE_PATTERN = ("users_*", "pseudonymous_users_*")
+USERID_SUB = "sub.user_id, sub.user_pseudo_id,"
+
+BENCH_QUERIES = ["key discovery", "shared key discovery", "event unnest", "event subquery", "item", "user", "profile"]
+
+# What is compared against the baseline, as (result field, label)
+REGRESSION_METRICS = [("elapsed_seconds", "time"), ("peak_memory_bytes", "peak memory"), ("sql_bytes", "SQL size")]
+
+def generate_bench_queries(keys_and_types, utc_ts):
+    # {name: BigQuery SQL} for every generated query, all with the same project/dataset placeholders
+    return {
+        "key discovery": generate_key_discovery_query("bench", "bench", EVENT_TABLE_PATTERNS, utc_ts=utc_ts),
+        "shared key discovery": generate_key_discovery_query("bench", "bench", EVENT_TABLE_PATTERNS, utc_ts=utc_ts, sources=["event_params", "user_properties", "item_params"]),
+        "event unnest": generate_event_table_query(keys_and_types, "bench", "bench", EVENT_TABLE_PATTERNS, USERID_SUB, utc_ts, "unnest"),
+        "event subquery": generate_event_table_query(keys_and_types, "bench", "bench", EVENT_TABLE_PATTERNS, USERID_SUB, utc_ts, "subquery"),
+        "item": generate_item_table_query(keys_and_types, "bench", "bench", EVENT_TABLE_PATTERNS, USERID_SUB, utc_ts),
+        "user": generate_user_table_query("bench", "bench", USER_TABLE_PATTERN, utc_ts),
+    }
+
+def generate_bench_profile_query(con, shards, queries):
+    # The profile pass over the event, item and user queries, the way profile_views runs it over the views
+    profile_sources = []
+    for view_name, name in (("event_table_view", "event unnest"), ("item_table_view", "item"), ("user_table_view", "user")):
+        columns = con.execute(f"DESCRIBE {prepare_query(con, shards, queries[name])}").fetchall()
+        # duckdb spells nested types as STRUCT(...), MAP(...) or TYPE[]
+        profile_columns = [(column[0], "ARRAY" if column[1].endswith("]") else column[1]) for column in columns]
+        profile_sources.append((view_name, f"({queries[name]})", profile_columns))
+    return generate_profile_query(profile_sources)
+
+def run_case(shard_dir, query, repeat, threads, memory_limit):
+    # Runs in a fresh process: the fastest of repeat runs, and the process's peak RSS
+    import resource
+
+    con = connect(threads, memory_limit)
+    shards = list_shards(shard_dir)
+    local_query = prepare_query(con, shards, query)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        con.execute(f"CREATE OR REPLACE TEMP TABLE ga4bench_result AS {local_query}")
+        timings.append(time.perf_counter() - started)
+    result_rows = con.execute("SELECT COUNT(*) FROM ga4bench_result").fetchone()[0]
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {"elapsed_seconds": min(timings), "peak_memory_bytes": peak_memory, "result_rows": result_rows}
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(work_dir, events_per_day_counts, key_counts, query_names, days=3, utc_ts="UTC", repeat=1, threads=None, memory_limit=None, seed=0):
+    cases = []
+    for events_per_day in events_per_day_counts:
+        for key_count in key_counts:
+            shard_dir = os.path.join(work_dir, f"days{days}_events{events_per_day}_keys{key_count}_seed{seed}")
+            if not os.path.isdir(shard_dir):
+                generate_export(shard_dir, days=days, events_per_day=events_per_day, users=max(events_per_day // 20, 10), param_keys=key_count, seed=seed)
+
+            con = connect(threads, memory_limit)
+            shards = list_shards(shard_dir)
+            keys_and_types = get_local_keys_and_types(con, shards, EVENT_TABLE_PATTERNS, utc_ts=utc_ts)
+            queries = generate_bench_queries(keys_and_types, utc_ts)
+            if "profile" in query_names:
+                queries["profile"] = generate_bench_profile_query(con, shards, queries)
+            con.close()
+
+            for name in query_names:
+                # A new process per case, so one query's memory doesn't count towards the next
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(run_case, shard_dir, queries[name], repeat, threads, memory_limit).result()
+                result.update({"query": name, "events_per_day": events_per_day, "keys": len(keys_and_types), "sql_bytes": len(queries[name].encode())})
+                logging.info(f"Benchmark result: {result}")
+                cases.append(result)
+    return cases
+
+def case_id(case):
+    return f"{case['query']}|{case['events_per_day']}|{case['keys']}"
+
+def find_regressions(cases, baseline_cases, threshold):
+    # [(case id, label, baseline value, new value)] for every metric that grew by more than threshold
+    baseline = {case_id(case): case for case in baseline_cases}
+    regressions = []
+    for case in cases:
+        previous = baseline.get(case_id(case))
+        if not previous:
+            continue
+        for metric, label in REGRESSION_METRICS:
+            if previous.get(metric) and case[metric] > previous[metric] * (1 + threshold):
+                regressions.append((case_id(case), label, previous[metric], case[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SQL generators on synthetic GA4 data with duckdb")
+    parser.add_argument("--work-dir", default="ga4bench_data", help="synthetic exports are generated here once and reused")
+    parser.add_argument("--events-per-day", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--keys", nargs="+", type=int, default=[50, 500], help="custom event_params keys in the data")
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--queries", nargs="+", default=BENCH_QUERIES, choices=BENCH_QUERIES)
+    parser.add_argument("--timezone", default="UTC")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--memory-limit", help="duckdb memory limit, e.g. 4GB")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth before a case counts as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s - %(levelname)s - %(message)s', force=True)
+    cases = run_benchmark(args.work_dir, args.events_per_day, args.keys, args.queries, args.days, args.timezone, args.repeat, args.threads, args.memory_limit)
+
+    print(f"{'query':<15} {'events/day':>10} {'keys':>6} {'seconds':>9} {'peak MB':>9} {'SQL KB':>8} {'rows':>10}")
+    for case in cases:
+        print(f"{case['query']:<15} {case['events_per_day']:>10} {case['keys']:>6} {case['elapsed_seconds']:>9.3f} {case['peak_memory_bytes'] / 1024**2:>9.1f} {case['sql_bytes'] / 1024:>8.1f} {case['result_rows']:>10}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": get_commit(), "cases": cases}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(cases, baseline["cases"], args.threshold)
+        for case, label, before, after in regressions:
+            print(f"REGRESSION {case}: {label} {before:.3f} -> {after:.3f} (baseline {baseline.get('commit')})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import logging
+import pytz
+
+from datetime import datetime, timedelta
+
+from ga4jobs import run_jobs, DONE
+from ga4queries import (
+    create_event_name_views,
+    create_event_profile_views,
+    create_event_table_materialized,
+    create_event_table_view,
+    create_item_table_view,
+    create_rollup_tables,
+    create_updated_view,
+    create_user_table_materialized,
+    create_user_table_view,
+    describe_date_window,
+    generate_event_table_query,
+    generate_item_check_query,
+    generate_item_table_query,
+    generate_user_table_query,
+    get_array_keys_and_types,
+    get_array_keys_and_types_incremental,
+    get_array_sources,
+    get_columns_to_exclude,
+    get_data_quality_checks,
+    get_event_name_keys_and_types,
+    get_shard_catalog,
+    get_window_bytes,
+    plan_pipeline_costs,
+    profile_views,
+)
+from ga4telemetry import byte_budget, recording, run_query, summarize_job_records, tracked
+
+# The whole GA4 to BigQuery run without any UI, used by the Streamlit app and the command line
+
+# How the event and user tables are deployed
+EVENT_MODES = ["view", "materialized"]
+USER_MODES = ["view", "materialized"]
+
+# Windows tried against a byte budget, widest first
+BUDGET_WINDOWS = [None, {"days": 365}, {"days": 90}, {"days": 30}, {"days": 7}, {"days": 1}]
+
+class DatasetCheckError(Exception):
+    # The dataset isn't a GA4 export this pipeline can run against
+    pass
+
+def check_dataset(client, project_id, dataset_id, utc_ts):
+    # Yesterday's daily and today's intraday event shards must exist. Returns whether there is a users_ export
+    # and the shard to probe for ecommerce.
+    today = datetime.now(pytz.timezone(utc_ts))
+    formatted_today = today.strftime('%Y%m%d')
+    formatted_yesterday = (today - timedelta(days=1)).strftime('%Y%m%d')
+
+    table_names = set(get_shard_catalog(client, project_id, dataset_id))
+
+    if "events_"+formatted_yesterday not in table_names:
+        raise DatasetCheckError("You have no events on your site for yesterday, do you have streaming turned on: https://support.google.com/analytics/answer/9823238")
+    if "events_intraday_"+formatted_today not in table_names:
+        raise DatasetCheckError("You have no traffic on your site for today, please generate some")
+
+    return {
+        "known_users": "users_"+formatted_yesterday in table_names,
+        "item_check_table": "events_"+formatted_yesterday,
+    }
+
+def get_table_patterns(known_users):
+    # (event_table_patterns, user_table_pattern, userid_sub) for an export with or without a users_ table
+    event_table_patterns = "events_*", "events_intraday_*"
+    if known_users:
+        return event_table_patterns, ("users_*", "pseudonymous_users_*"), "sub.user_id, sub.user_pseudo_id,"
+    return event_table_patterns, ("pseudonymous_users_*", ""), "sub.user_pseudo_id,"
+
+def discover_keys_and_types(client, project_id, dataset_id, event_table_patterns, user_table_pattern, utc_ts, date_window=None, pivot_arrays=(), min_occurrences=None, top_n=None):
+    # {source: {key: value_type}} for event_params and each of pivot_arrays (see ga4queries.NESTED_ARRAYS). The
+    # arrays on events and their items share one incremental scan of the event shards, audiences take one of
+    # the user snapshots.
+    event_sources = get_array_sources(["event_params", *pivot_arrays], ["events", "items"])
+    discovered = get_array_keys_and_types_incremental(client, project_id, dataset_id, event_table_patterns, event_sources, date_window, utc_ts, min_occurrences, top_n)
+    if not discovered["event_params"]:
+        raise ValueError("Failed to retrieve keys and types.")
+    user_sources = get_array_sources(pivot_arrays, ["users"])
+    user_patterns = [pattern for pattern in user_table_pattern if pattern]
+    if user_sources and user_patterns:
+        discovered.update(get_array_keys_and_types(client, project_id, dataset_id, user_patterns, user_sources, date_window, utc_ts, min_occurrences, top_n))
+    return discovered
+
+def choose_date_window(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, budget_bytes, pivot_strategy="unnest", candidates=BUDGET_WINDOWS, pivot_arrays=(), event_mode="view"):
+    # The widest candidate window whose estimated bytes fit the budget, with its estimates.
+    # The first candidate is dry run in full, which gives how many bytes the pipeline scans per stored shard byte.
+    # Narrower windows are scaled from the shard catalog with that ratio, and only the first one that looks like
+    # it fits is dry run to confirm, instead of dry running every candidate. A materialized event table is priced
+    # by the days it would merge; run it with drop_outside_window off so the window doesn't drop what it holds.
+    catalog = get_shard_catalog(client, project_id, dataset_id)
+    table_patterns = tuple(event_table_patterns) + tuple(pattern for pattern in user_table_pattern if pattern)
+    bytes_per_stored_byte = None
+    for candidate in candidates:
+        stored_bytes = get_window_bytes(catalog, table_patterns, candidate, utc_ts)
+        if bytes_per_stored_byte is not None and stored_bytes * bytes_per_stored_byte > budget_bytes:
+            logging.info(f"{describe_date_window(candidate)} holds {stored_bytes} stored bytes, skipped as over the budget")
+            continue
+        estimates = plan_pipeline_costs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, pivot_strategy=pivot_strategy, date_window=candidate, pivot_arrays=pivot_arrays, event_mode=event_mode)
+        if sum(estimates.values()) <= budget_bytes:
+            logging.info(f"{describe_date_window(candidate)} fits the budget of {budget_bytes} bytes")
+            return candidate, estimates
+        if stored_bytes:
+            bytes_per_stored_byte = sum(estimates.values()) / stored_bytes
+    raise DatasetCheckError(f"Even {describe_date_window(candidates[-1])} is estimated to scan over the budget of {budget_bytes} bytes")
+
+def build_pipeline_jobs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, date_window=None, event_mode="view", pivot_strategy="unnest", sample_percent=None, user_mode="view", min_key_occurrences=None, max_keys=None, rollups=False, job_records=None, keys_and_types=None, column_profiles=(), pivot_arrays=(), event_name_views=(), budget=None, drop_outside_window=True):
+    # The pipeline as a job graph for ga4jobs.run_jobs. Each step is a BigQuery job, independent ones run
+    # side by side and the rest wait for what they need. min_key_occurrences and max_keys limit which
+    # event_params keys get their own column, the rest go to event_params_other. rollups adds the daily
+    # rollup tables for dashboards. The statistics of every BigQuery job a step runs are appended to
+    # job_records, tagged with the step's name. keys_and_types skips discovery with what discover_keys_and_types
+    # returned earlier. column_profiles adds a narrower event_table_view_{profile} for each of those
+    # ga4queries.EVENT_COLUMN_PROFILES. pivot_arrays also pivots those ga4queries.PIVOT_ARRAYS into columns.
+    # event_name_views adds a {event_name}_event_view for each of those event names with only the keys it carries.
+    # Every job is charged to budget (ga4telemetry.byte_budget) if given. drop_outside_window off keeps the days and
+    # users of the materialized tables date_window doesn't cover, for a window that was only narrowed to fit a budget.
+    def discover_keys(results):
+        if keys_and_types:
+            return keys_and_types
+        return discover_keys_and_types(client, project_id, dataset_id, event_table_patterns, user_table_pattern, utc_ts, date_window, pivot_arrays, min_key_occurrences, max_keys)
+
+    def get_user_array_keys(results):
+        return results["Key discovery"] if "audiences" in pivot_arrays else None
+
+    def build_user_table(results):
+        logging.info(user_table_pattern)
+        if user_mode == "materialized":
+            create_user_table_materialized(client, project_id, dataset_id, user_table_pattern, utc_ts, date_window, array_keys=get_user_array_keys(results), drop_outside_window=drop_outside_window)
+            return "user_table"
+        create_user_table_view(client, project_id, dataset_id, user_table_pattern, utc_ts, date_window, get_user_array_keys(results))
+        return "user_table_view"
+
+    def build_event_table(results):
+        logging.info(event_table_patterns)
+        if event_mode == "materialized":
+            create_event_table_materialized(client, project_id, dataset_id, event_table_patterns, userid_sub, results["Key discovery"]["event_params"], utc_ts, pivot_strategy, date_window, array_keys=results["Key discovery"], drop_outside_window=drop_outside_window)
+            # Profile the table itself, so its _mini view reads the partitioned table and sampling can apply
+            return "event_table"
+        create_event_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, results["Key discovery"]["event_params"], utc_ts, pivot_strategy, date_window, results["Key discovery"])
+        return "event_table_view"
+
+    def build_event_profiles(results):
+        source_table = results["Event table"] if event_mode == "materialized" else None
+        return create_event_profile_views(client, project_id, dataset_id, event_table_patterns, userid_sub, results["Key discovery"]["event_params"], utc_ts, column_profiles, pivot_strategy, date_window, source_table)
+
+    def build_event_name_views(results):
+        # The keys of each event name were counted in the key manifest by discovery
+        event_name_keys = get_event_name_keys_and_types(client, project_id, dataset_id, event_table_patterns, event_name_views, date_window, utc_ts, min_key_occurrences, max_keys)
+        source_table = results["Event table"] if event_mode == "materialized" else None
+        return create_event_name_views(client, project_id, dataset_id, event_table_patterns, userid_sub, event_name_keys, utc_ts, pivot_strategy, date_window, source_table, results["Key discovery"]["event_params"])
+
+    def check_ecommerce(results):
+        itemcheckquery = generate_item_check_query(project_id, dataset_id, item_check_table)
+        return next(iter(run_query(client, itemcheckquery, name="ecommerce check")), None) is not None
+
+    def build_item_table(results):
+        if not results["Ecommerce check"]:
+            logging.info("No items found in event table")
+            return None
+        create_item_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, results["Key discovery"]["event_params"], utc_ts, date_window, results["Key discovery"])
+        return "item_table_view"
+
+    def build_rollups(results):
+        return create_rollup_tables(client, project_id, dataset_id, event_table_patterns, utc_ts, date_window, include_items=results["Ecommerce check"], drop_outside_window=drop_outside_window)
+
+    def profile(results):
+        profiled_views = [results[step] for step in ("User table", "Event table", "Item table") if results[step]]
+        return profile_views(client, project_id, dataset_id, profiled_views, sample_percent)
+
+    def generate_mini_query(view_name, columns_to_exclude, results):
+        # The view's query regenerated from the shards without columns_to_exclude, None for materialized tables
+        if view_name == "user_table_view":
+            return generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, date_window, columns_to_exclude, get_user_array_keys(results))
+        keys = results["Key discovery"]
+        if view_name == "event_table_view":
+            return generate_event_table_query(keys["event_params"], project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window, excluded_columns=columns_to_exclude, array_keys=keys)
+        if view_name == "item_table_view":
+            return generate_item_table_query(keys["event_params"], project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window, columns_to_exclude, keys)
+        return None
+
+    def build_mini_view(view_step, mini_view_name):
+        # mini_view_name is the same whether the step profiled a view or a materialized table
+        def build(results):
+            view_name = results[view_step]
+            if view_name and view_name in results["Summary statistics"]:
+                columns_to_exclude = get_columns_to_exclude(results["Summary statistics"][view_name])
+                source_query = generate_mini_query(view_name, columns_to_exclude, results) if columns_to_exclude else None
+                create_updated_view(client, project_id, dataset_id, view_name, columns_to_exclude, source_query, mini_view_name)
+            return view_name
+        return build
+
+    jobs = {
+        "Key discovery": (discover_keys, []),
+        "User table": (build_user_table, ["Key discovery"] if "audiences" in pivot_arrays else []),
+        "Event table": (build_event_table, ["Key discovery"]),
+        "Ecommerce check": (check_ecommerce, []),
+        "Item table": (build_item_table, ["Key discovery", "Ecommerce check"]),
+        "Summary statistics": (profile, ["User table", "Event table", "Item table"]),
+        "User table mini": (build_mini_view("User table", "user_table_view_mini"), ["User table", "Summary statistics"]),
+        "Event table mini": (build_mini_view("Event table", "event_table_view_mini"), ["Event table", "Summary statistics"]),
+        "Item table mini": (build_mini_view("Item table", "item_table_view_mini"), ["Item table", "Summary statistics"]),
+    }
+    if column_profiles:
+        jobs["Event profiles"] = (build_event_profiles, ["Key discovery", "Event table"])
+    if event_name_views:
+        jobs["Event name views"] = (build_event_name_views, ["Key discovery", "Event table"])
+    if rollups:
+        jobs["Daily rollups"] = (build_rollups, ["Ecommerce check"])
+    target = f"{project_id}.{dataset_id}"
+    return {name: (tracked(name, fn, job_records, target, budget), dependencies) for name, (fn, dependencies) in jobs.items()}
+
+def summarize_jobs(status):
+    # Job status table without the raw results, safe to serialize
+    return {
+        name: {"status": entry["status"], "elapsed_seconds": round(entry["elapsed"], 3), "error": entry["error"]}
+        for name, entry in status.items()
+    }
+
+def run_pipeline(client, project_id, dataset_id, utc_ts="UTC", date_window=None, event_mode="view", pivot_strategy="unnest", sample_percent=None, budget_bytes=None, max_workers=4, on_update=None, initializer=None, user_mode="view", min_key_occurrences=None, max_keys=None, rollups=False, column_profiles=(), pivot_arrays=(), event_name_views=()):
+    # Check, plan and run everything for one project.dataset. Never raises for pipeline failures,
+    # the returned report says what happened.
+    report = {"target": f"{project_id}.{dataset_id}", "status": "failed", "error": None, "date_window": date_window}
+    job_records = []
+    # Jobs are capped at what is left of the budget, so the whole run can't bill more than it
+    budget = byte_budget(budget_bytes) if budget_bytes else None
+    try:
+        with recording(job_records, "Planning", report["target"], budget):
+            dataset = check_dataset(client, project_id, dataset_id, utc_ts)
+            event_table_patterns, user_table_pattern, userid_sub = get_table_patterns(dataset["known_users"])
+            report["known_users"] = dataset["known_users"]
+
+            if budget_bytes:
+                date_window, estimates = choose_date_window(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, dataset["item_check_table"], budget_bytes, pivot_strategy, pivot_arrays=pivot_arrays, event_mode=event_mode)
+            else:
+                estimates = plan_pipeline_costs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, dataset["item_check_table"], pivot_strategy=pivot_strategy, date_window=date_window, pivot_arrays=pivot_arrays, event_mode=event_mode)
+            report["date_window"] = date_window
+            report["estimated_bytes"] = estimates
+
+        jobs = build_pipeline_jobs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, dataset["item_check_table"], date_window, event_mode, pivot_strategy, sample_percent, user_mode, min_key_occurrences, max_keys, rollups, job_records, column_profiles=column_profiles, pivot_arrays=pivot_arrays, event_name_views=event_name_views, budget=budget, drop_outside_window=not budget_bytes)
+        status = run_jobs(jobs, max_workers=max_workers, on_update=on_update, initializer=initializer)
+        report["steps"] = summarize_jobs(status)
+        if status["Summary statistics"]["status"] == DONE:
+            report["data_quality_checks"] = get_data_quality_checks(status["Summary statistics"]["result"])
+        if all(entry["status"] == DONE for entry in status.values()):
+            report["status"] = "ok"
+        else:
+            report["error"] = "Some steps did not finish"
+    except Exception as e:
+        logging.error(f"Pipeline failed for {project_id}.{dataset_id}: {e}")
+        report["error"] = str(e)
+    # What every BigQuery job cost, per step and one by one
+    report["job_totals"] = summarize_job_records(job_records)
+    report["jobs"] = job_records
+    return report
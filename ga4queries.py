@@ -1,119 +1,451 @@
-import streamlit as st
-import pandas as pd
-import os
+import hashlib
 import json
-import tempfile
 import logging
+import os
 import pytz 
+import re
+import time
 
 from datetime import datetime, timedelta
-from google.cloud import bigquery
-from google.api_core.exceptions import NotFound, BadRequest, GoogleAPICallError
-from io import StringIO
+from fnmatch import fnmatch
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, filename='script.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+from ga4telemetry import record_job, run_query
 
-# 
-def get_unique_keys_and_types(client, project_id, dataset_id, event_table_patterns):
-    st.write("Getting unique keys and their types...")
+# No UI imports here, this module is shared by the Streamlit app and the command line.
+# google.cloud.bigquery is imported inside the functions that need it so importing this module stays fast.
+# Logging is configured by the app or the command line. Generated SQL is logged at DEBUG, and every query runs
+# through ga4telemetry.run_query so its job statistics are recorded.
+
+# Date windows restrict the wildcard tables to a range of daily shards:
+#   None                                    - every shard
+#   {"days": 30}                            - the last 30 days including today, rolling forward every day
+#   {"start": "20260101", "end": "20260131"} - a fixed range of shard suffixes
+#   {"suffixes": ["20260101", "20260105"]}   - exactly these shard suffixes
+def generate_table_suffix_filter(date_window, utc_ts, keyword="WHERE"):
+    # Rolling windows are computed from CURRENT_DATE when the query runs, so a deployed view keeps moving
+    # without being redeployed. Both forms are constant expressions, so BigQuery only reads the shards in range.
+    if not date_window:
+        return ""
+    if "suffixes" in date_window:
+        suffix_list = ", ".join(f"'{suffix}'" for suffix in date_window["suffixes"])
+        return f"{keyword} _TABLE_SUFFIX IN ({suffix_list})"
+    if "days" in date_window:
+        start = f"""FORMAT_DATE('%Y%m%d', DATE_SUB(CURRENT_DATE("{utc_ts}"), INTERVAL {int(date_window["days"]) - 1} DAY))"""
+        end = f"""FORMAT_DATE('%Y%m%d', CURRENT_DATE("{utc_ts}"))"""
+    else:
+        start = f"'{date_window['start']}'"
+        end = f"'{date_window['end']}'"
+    return f"{keyword} _TABLE_SUFFIX BETWEEN {start} AND {end}"
+
+def generate_intraday_bound(project_id, dataset_id):
+    # A constant condition on the intraday _TABLE_SUFFIX for the days without a daily events shard in the catalog
+    # this process last fetched: every day after the newest daily shard, and any earlier one GA4 hasn't finalised
+    # yet. None without a catalog.
+    catalog = _shard_catalogs.get((project_id, dataset_id), (None, {}))[1]
+    daily = {table_id[len("events_"):] for table_id in catalog if re.match(r"^events_[0-9]{8}$", table_id)}
+    if not daily:
+        return None
+    intraday = {table_id[len("events_intraday_"):] for table_id in catalog if table_id.startswith("events_intraday_")}
+    latest_daily = max(daily)
+    pending = sorted(suffix for suffix in intraday - daily if suffix < latest_daily)
+    if not pending:
+        return f"_TABLE_SUFFIX > '{latest_daily}'"
+    suffix_list = ", ".join(f"'{suffix}'" for suffix in pending)
+    return f"(_TABLE_SUFFIX > '{latest_daily}' OR _TABLE_SUFFIX IN ({suffix_list}))"
+
+def generate_shard_filter(project_id, dataset_id, table_pattern, date_window, utc_ts, keyword="WHERE"):
+    # The date window, plus only one copy of each day of events. events_* also matches the intraday tables (their
+    # _TABLE_SUFFIX is intraday_YYYYMMDD), which a constant filter prunes. An intraday table whose day already has
+    # its daily table holds the same events again until GA4 drops it. The days without one in the shard catalog
+    # are a constant bound, so BigQuery only reads those intraday tables. The subquery on __TABLES__ doesn't prune,
+    # it only keeps a day finalised after the query was generated from being counted twice until the next deploy
+    # moves the bound.
+    conditions = []
+    window_filter = generate_table_suffix_filter(date_window, utc_ts, keyword="")
+    if window_filter:
+        conditions.append(window_filter.strip())
+    if table_pattern == "events_*":
+        conditions.append("_TABLE_SUFFIX NOT LIKE 'intraday%'")
+    elif table_pattern == "events_intraday_*":
+        intraday_bound = generate_intraday_bound(project_id, dataset_id)
+        if intraday_bound:
+            conditions.append(intraday_bound)
+        conditions.append(f"_TABLE_SUFFIX NOT IN (SELECT SUBSTR(table_id, {len('events_') + 1}) FROM `{project_id}.{dataset_id}.__TABLES__` WHERE REGEXP_CONTAINS(table_id, r'^events_[0-9]{{8}}$'))")
+    return f"{keyword} {' AND '.join(conditions)}" if conditions else ""
+
+# The fields that identify an event. Their fingerprint is the event's ueid, the same in every view and on every run,
+# so the event and item views can be joined on it and dashboard queries over them can come from the result cache.
+# They are all scalar, so the item view doesn't read event_params for the key. Exact duplicates in the export get
+# the same ueid, which the unnest pivot's GROUP BY merges anyway. Dropping them anywhere else takes a shuffle over
+# every event in the window, so the other queries only do it when asked (deduplicate), which the materialized event
+# table does once per day as it writes it.
+EVENT_KEY_FIELDS = ["user_pseudo_id", "event_timestamp", "event_name", "stream_id", "event_bundle_sequence_id"]
+
+# Exports since mid 2024 also number the events of each batch, which tells apart events sharing everything above.
+# Older shards don't have them, where they are NULL just like in a wildcard read over old and new shards.
+EVENT_BATCH_FIELDS = ["batch_page_id", "batch_event_index"]
+
+def generate_event_key(batch_fields=True):
+    fields = EVENT_KEY_FIELDS + [field if batch_fields else f"CAST(NULL AS INT64) AS {field}" for field in EVENT_BATCH_FIELDS]
+    return f"FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({', '.join(fields)})))"
+
+def has_batch_fields(client, project_id, dataset_id, table_ids):
+    # Whether every one of the shards has the batch fields, from their schemas so nothing is scanned
+    for table_id in table_ids:
+        columns = {field.name for field in client.get_table(f"{project_id}.{dataset_id}.{table_id}").schema}
+        if not set(EVENT_BATCH_FIELDS) <= columns:
+            return False
+    return True
+
+def generate_event_source(project_id, dataset_id, table_pattern, date_window, utc_ts, deduplicate=False, columns=(), event_names=(), batch_fields=True):
+    # The events of one pattern with their ueid, and columns as (expression, alias) computed once per event.
+    # deduplicate keeps one of each set of exact duplicates. event_names keeps only events with those names.
+    # batch_fields off keys shards that predate the batch fields, see has_batch_fields.
+    shard_filter = generate_shard_filter(project_id, dataset_id, table_pattern, date_window, utc_ts)
+    if event_names:
+        shard_filter = f"{shard_filter or 'WHERE TRUE'} AND event_name IN ({', '.join(sql_string(event_name) for event_name in event_names)})"
+    qualify = ""
+    if deduplicate:
+        shard_filter = shard_filter or "WHERE TRUE"
+        qualify = "QUALIFY ROW_NUMBER() OVER (PARTITION BY ueid) = 1"
+    column_sql = "".join(f"{expression} AS {alias},\n                " for expression, alias in columns)
+    return f"""
+            SELECT
+                {generate_event_key(batch_fields)} AS ueid,
+                {column_sql}*
+            FROM 
+                `{project_id}.{dataset_id}.{table_pattern}`
+            {shard_filter}
+            {qualify}
+    """
+
+def date_window_bounds(date_window, utc_ts):
+    # The (start, end) suffixes the window covers right now, None for an open end
+    if not date_window:
+        return None, None
+    if "days" in date_window:
+        today = datetime.now(pytz.timezone(utc_ts)).date()
+        start = today - timedelta(days=int(date_window["days"]) - 1)
+        return start.strftime('%Y%m%d'), today.strftime('%Y%m%d')
+    if "suffixes" in date_window:
+        return min(date_window["suffixes"]), max(date_window["suffixes"])
+    return date_window["start"], date_window["end"]
+
+def describe_date_window(date_window):
+    if not date_window:
+        return "All"
+    if "days" in date_window:
+        return f"Last {date_window['days']} days"
+    if "suffixes" in date_window:
+        return f"{len(date_window['suffixes'])} selected days"
+    return f"{date_window['start']} to {date_window['end']}"
+
+# Repeated key/value fields that can be pivoted into one column per key. "table" is what a row of the pivoted
+# view is (an event, one of its items, a user), "parent" the array the field is nested in, "key" the field
+# holding the key and "values" the field of each value type, in the order a key's type is inferred. Columns are
+# named "prefix" + key. Audiences have no typed value, their column is the membership start time.
+NESTED_ARRAYS = {
+    "event_params": {"table": "events", "array": "event_params", "key": "key", "values": {"string": "value.string_value", "int": "value.int_value", "float": "value.float_value"}, "prefix": "event_param_"},
+    "user_properties": {"table": "events", "array": "user_properties", "key": "key", "values": {"string": "value.string_value", "int": "value.int_value", "float": "value.float_value"}, "prefix": "user_property_"},
+    "item_params": {"table": "items", "parent": "items", "array": "item_params", "key": "key", "values": {"string": "value.string_value", "int": "value.int_value", "float": "value.float_value"}, "prefix": "item_param_"},
+    "audiences": {"table": "users", "array": "audiences", "key": "name", "values": {"int": "membership_start_timestamp_micros"}, "prefix": "audience_"},
+}
+
+# The arrays that can be pivoted besides event_params
+PIVOT_ARRAYS = [source for source in NESTED_ARRAYS if source != "event_params"]
+
+def get_array_sources(sources, table_kinds):
+    # The sources found on the given kinds of table, in NESTED_ARRAYS order
+    return [source for source in NESTED_ARRAYS if source in sources and NESTED_ARRAYS[source]["table"] in table_kinds]
+
+def generate_array_key_entries(source, row_alias="sub"):
+    # (source, key, value_type) of every entry of one array of a row, as an array of structs so the entries of
+    # several arrays can be concatenated and counted in one pass over the rows
+    spec = NESTED_ARRAYS[source]
+    value_type = "NULL"
+    for type_name, field in reversed(list(spec["values"].items())):
+        value_type = f"IF(kv.{field} IS NOT NULL, '{type_name}', {value_type})"
+    if "parent" in spec:
+        entries = f"UNNEST({row_alias}.{spec['parent']}) AS parent, UNNEST(parent.{spec['array']}) AS kv"
+    else:
+        entries = f"UNNEST({row_alias}.{spec['array']}) AS kv"
+    return f"ARRAY(SELECT AS STRUCT '{source}' AS source, kv.{spec['key']} AS key, {value_type} AS value_type FROM {entries})"
+
+def generate_key_discovery_query(project_id, dataset_id, table_patterns, date_window=None, utc_ts="UTC", sources=("event_params",)):
+    # (source, key, value_type, occurrences) of every array in sources, all from one scan of each pattern
+    entries = ",\n            ".join(generate_array_key_entries(source) for source in sources)
     union_subqueries = [
         f"""
-        SELECT key, 
-               IF(ep.value.string_value IS NOT NULL, 'string', 
-                  IF(ep.value.int_value IS NOT NULL, 'int', 
-                     IF(ep.value.float_value IS NOT NULL, 'float', NULL)
-                  )
-               ) AS value_type
-        FROM `{project_id}.{dataset_id}.{table_pattern}`,
-        UNNEST(event_params) AS ep
-        GROUP BY key, value_type
+        SELECT found.source AS source,
+               found.key AS key,
+               found.value_type AS value_type,
+               COUNT(*) AS occurrences
+        FROM `{project_id}.{dataset_id}.{table_pattern}` sub
+        CROSS JOIN UNNEST(ARRAY_CONCAT(
+            {entries}
+        )) AS found
+        {generate_shard_filter(project_id, dataset_id, table_pattern, date_window, utc_ts)}
+        GROUP BY source, key, value_type
         """
-        for table_pattern in event_table_patterns
+        for table_pattern in table_patterns
     ]
-    query = " UNION ALL ".join(union_subqueries)
-    query_job = client.query(query)
-    keys_and_types = query_job.result()
-    logging.info("keys and types")
-    logging.info(query)
-    return {row.key: row.value_type for row in keys_and_types}
+    return " UNION ALL ".join(union_subqueries)
+
+def get_key_statistics(rows):
+    # {key: {"occurrences": n, "types": {value_type: n}}} from (key, value_type, occurrences) rows.
+    # The same key can come back once per pattern and value type, so counts are summed.
+    key_statistics = {}
+    for key, value_type, occurrences in rows:
+        statistics = key_statistics.setdefault(key, {"occurrences": 0, "types": {}})
+        statistics["occurrences"] += occurrences or 0
+        statistics["types"][value_type] = statistics["types"].get(value_type, 0) + (occurrences or 0)
+    return key_statistics
+
+def get_array_key_statistics(rows, sources):
+    # {source: get_key_statistics} from (source, key, value_type, occurrences) rows. Also groups the keys by event
+    # name, with event names in place of sources.
+    rows = list(rows)
+    return {source: get_key_statistics((key, value_type, occurrences) for row_source, key, value_type, occurrences in rows if row_source == source) for source in sources}
+
+def get_key_type(statistics):
+    # The value type a key is pivoted as: whichever typed value it carries most often
+    typed = {value_type: count for value_type, count in statistics["types"].items() if value_type in PARAM_SQL_TYPES}
+    return max(sorted(typed), key=typed.get) if typed else None
+
+def select_pivot_keys(key_statistics, min_occurrences=None, top_n=None, source="event_params"):
+    # {key: value_type} of the keys that get their own column. Keys are ranked by how often they occur and cut
+    # at min_occurrences and/or the top_n most frequent; the rest only show up in event_params_other.
+    # Keys come back in name order so the column order doesn't move when the counts do.
+    ranked = sorted(
+        (key for key, statistics in key_statistics.items() if get_key_type(statistics)),
+        key=lambda key: (-key_statistics[key]["occurrences"], key),
+    )
+    if min_occurrences:
+        ranked = [key for key in ranked if key_statistics[key]["occurrences"] >= min_occurrences]
+    if top_n:
+        ranked = ranked[:top_n]
+    logging.info(f"Pivoting {len(ranked)} of {len(key_statistics)} {source} keys")
+    return {key: get_key_type(key_statistics[key]) for key in sorted(ranked)}
+
+def select_array_pivot_keys(array_key_statistics, min_occurrences=None, top_n=None):
+    # {source: select_pivot_keys} with the same cut for every array
+    return {source: select_pivot_keys(key_statistics, min_occurrences, top_n, source) for source, key_statistics in array_key_statistics.items()}
+
+def get_array_keys_and_types(client, project_id, dataset_id, table_patterns, sources, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    # {source: {key: value_type}} of every array in sources, which must all be on the tables table_patterns match
+    logging.info(f"Getting unique keys and their types of {', '.join(sources)}...")
+    query = generate_key_discovery_query(project_id, dataset_id, table_patterns, date_window, utc_ts, sources)
+    rows = ((row.source, row.key, row.value_type, row.occurrences) for row in run_query(client, query, name="key discovery"))
+    return select_array_pivot_keys(get_array_key_statistics(rows, sources), min_occurrences, top_n)
+
+def get_unique_keys_and_types(client, project_id, dataset_id, event_table_patterns, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    return get_array_keys_and_types(client, project_id, dataset_id, event_table_patterns, ["event_params"], date_window, utc_ts, min_occurrences, top_n)["event_params"]
+
+# Flattened event columns shared by the event and item tables, as (source expression, column alias)
+EVENT_DIMENSIONS = [
+    ("sub.event_name", "event_name"),
+    ("sub.platform", "event_platform"),
+    ("sub.stream_id", "event_stream_id"),
+    ("sub.traffic_source.source", "traffic_source"),
+    ("sub.traffic_source.medium", "traffic_medium"),
+    ("sub.traffic_source.name", "traffic_name"),
+    ("sub.geo.country", "event_geo_country"),
+    ("sub.geo.region", "event_geo_region"),
+    ("sub.geo.city", "event_geo_city"),
+    ("sub.geo.sub_continent", "event_geo_sub_continent"),
+    ("sub.geo.metro", "event_geo_metro"),
+    ("sub.geo.continent", "event_geo_continent"),
+    ("sub.device.browser", "event_device_browser"),
+    ("sub.device.language", "event_device_language"),
+    ("sub.device.is_limited_ad_tracking", "event_device_is_limited_ad_tracking"),
+    ("sub.device.mobile_model_name", "event_device_mobile_model_name"),
+    ("sub.device.mobile_marketing_name", "event_device_mobile_marketing_name"),
+    ("sub.device.mobile_os_hardware_model", "event_device_mobile_os_hardware_model"),
+    ("sub.device.operating_system", "event_device_operating_system"),
+    ("sub.device.operating_system_version", "event_device_operating_system_version"),
+    ("sub.device.category", "event_device_category"),
+    ("sub.device.mobile_brand_name", "event_device_mobile_brand_name"),
+    ("sub.user_first_touch_timestamp", "event_user_first_touch_timestamp"),
+    ("sub.user_ltv.revenue", "event_user_ltv_revenue"),
+    ("sub.user_ltv.currency", "event_user_ltv_currency"),
+    ("sub.device.web_info.browser", "web_info_browser"),
+    ("sub.device.web_info.browser_version", "web_info_browser_version"),
+    ("sub.device.web_info.hostname", "web_info_hostname"),
+    ("sub.ecommerce.total_item_quantity", "total_item_quantity"),
+    ("sub.ecommerce.purchase_revenue_in_usd", "purchase_revenue_in_usd"),
+    ("sub.ecommerce.purchase_revenue", "purchase_revenue"),
+    ("sub.ecommerce.refund_value_in_usd", "refund_value_in_usd"),
+    ("sub.ecommerce.refund_value", "refund_value"),
+    ("sub.ecommerce.shipping_value_in_usd", "shipping_value_in_usd"),
+    ("sub.ecommerce.shipping_value", "shipping_value"),
+    ("sub.ecommerce.tax_value_in_usd", "tax_value_in_usd"),
+    ("sub.ecommerce.tax_value", "tax_value"),
+    ("sub.ecommerce.unique_items", "unique_items"),
+    ("sub.ecommerce.transaction_id", "transaction_id"),
+]
+
+# Named subsets of EVENT_DIMENSIONS for narrower event views. In the unnest pivot every dimension is carried through
+# the expansion and the GROUP BY, so a view with only what a dashboard reads also only scans and shuffles that.
+EVENT_CORE_DIMENSIONS = ["event_name", "event_platform", "event_stream_id", "event_geo_country", "event_device_category"]
+EVENT_COLUMN_PROFILES = {
+    "core": EVENT_CORE_DIMENSIONS,
+    "acquisition": EVENT_CORE_DIMENSIONS + [
+        "traffic_source", "traffic_medium", "traffic_name", "event_geo_region", "event_geo_city",
+        "event_device_browser", "event_device_operating_system", "event_device_language", "web_info_hostname",
+        "event_user_first_touch_timestamp",
+    ],
+    "ecommerce": EVENT_CORE_DIMENSIONS + [
+        "traffic_source", "traffic_medium", "event_user_ltv_revenue", "event_user_ltv_currency",
+        "total_item_quantity", "purchase_revenue_in_usd", "purchase_revenue", "refund_value_in_usd", "refund_value",
+        "shipping_value_in_usd", "shipping_value", "tax_value_in_usd", "tax_value", "unique_items", "transaction_id",
+    ],
+    "full": [alias for _, alias in EVENT_DIMENSIONS],
+}
+
+def get_event_dimensions(column_profile="full"):
+    # The (source expression, column alias) pairs of a column profile, in EVENT_DIMENSIONS order
+    if column_profile not in EVENT_COLUMN_PROFILES:
+        raise ValueError(f"Unknown column profile {column_profile!r}, expected one of {list(EVENT_COLUMN_PROFILES)}")
+    aliases = set(EVENT_COLUMN_PROFILES[column_profile])
+    return [(expression, alias) for expression, alias in EVENT_DIMENSIONS if alias in aliases]
+
+# Fields pulled out of each entry of the items array
+ITEM_COLUMNS = [
+    "item_id", "item_name", "item_brand", "item_variant",
+    "item_category", "item_category2", "item_category3", "item_category4", "item_category5",
+    "price_in_usd", "price", "quantity",
+    "item_revenue_in_usd", "item_revenue", "item_refund_in_usd", "item_refund",
+    "coupon", "affiliation", "location_id",
+    "item_list_id", "item_list_name", "item_list_index",
+    "promotion_id", "promotion_name", "creative_name", "creative_slot",
+]
+
+# BigQuery column types for the value types returned by get_unique_keys_and_types
+PARAM_SQL_TYPES = {"string": "STRING", "int": "INT64", "float": "FLOAT64"}
+
+def array_column_alias(source, key):
+    return NESTED_ARRAYS[source]["prefix"] + re.sub(r"[^0-9A-Za-z_]", "_", key)  # Ensure valid SQL identifier
+
+def param_column_alias(key):
+    return array_column_alias("event_params", key)
+
+def sql_string(value):
+    # A quoted string literal, keys and audience names can hold quotes
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def get_array_pivot_columns(source, keys_and_types, row_alias=None, excluded_columns=()):
+    # (expression, alias) of a column per key of one array: a lookup of the key in the row's own array, so every
+    # row stays one row. row_alias qualifies the array, e.g. "it" for the item_params of an unnested item.
+    spec = NESTED_ARRAYS[source]
+    array = f"{row_alias}.{spec['array']}" if row_alias else spec["array"]
+    columns = []
+    for key, value_type in keys_and_types.items():
+        column_alias = array_column_alias(source, key)
+        if value_type in spec["values"] and column_alias not in excluded_columns:
+            columns.append((f"(SELECT MAX(kv.{spec['values'][value_type]}) FROM UNNEST({array}) AS kv WHERE kv.{spec['key']} = {sql_string(key)})", column_alias))
+    return columns
+
+def get_table_array_columns(array_keys, table_kind, row_alias=None, excluded_columns=()):
+    # The pivot columns of every array in array_keys that is on table_kind, besides event_params
+    return [
+        column
+        for source in get_array_sources(array_keys or {}, [table_kind]) if source != "event_params"
+        for column in get_array_pivot_columns(source, array_keys[source], row_alias, excluded_columns)
+    ]
+
+# Params that don't get their own column, as a JSON object of key to value, e.g. {"coupon_code":"SUMMER","step":"3"}.
+# Values are strings whatever their type, read them with JSON_VALUE(event_params_other, '$.coupon_code').
+OTHER_PARAMS_COLUMN = "event_params_other"
+
+def generate_other_param_entry(keys_and_types, key, string_value, int_value, float_value):
+    # One "key":"value" member of event_params_other, NULL for keys that have their own column
+    pivoted = ", ".join(sql_string(param_key) for param_key, value_type in keys_and_types.items() if value_type in PARAM_SQL_TYPES)
+    entry = f"CONCAT(TO_JSON_STRING({key}), ':', TO_JSON_STRING(COALESCE({string_value}, CAST({int_value} AS STRING), CAST({float_value} AS STRING))))"
+    return f"IF({key} NOT IN ({pivoted}), {entry}, NULL)" if pivoted else entry
+
+def get_event_columns(userid_sub, utc_ts, column_profile="full", excluded_columns=()):
+    # (source expression, column alias) of every per-event column the event and item tables share: the event key,
+    # the timestamps, the user ids and the profile's dimensions, without excluded_columns
+    userid_columns = [col.strip() for col in userid_sub.split(",") if col.strip()]
+    columns = [
+        ("sub.ueid", "ueid"),
+        (f'DATETIME(TIMESTAMP_MICROS(sub.event_timestamp), "{utc_ts}")', "event_timezone"),
+        ("sub.event_timestamp", "event_timestamp"),
+        ("sub.event_date", "event_date"),
+    ] + [(col, col.replace("sub.", "")) for col in userid_columns] + get_event_dimensions(column_profile)
+    return [(expression, alias) for expression, alias in columns if alias not in excluded_columns]
+
+def get_pivot_keys(keys_and_types, excluded_columns=()):
+    # The keys that get their own column, without those whose column is excluded
+    return {
+        key: value_type for key, value_type in keys_and_types.items()
+        if value_type in PARAM_SQL_TYPES and param_column_alias(key) not in excluded_columns
+    }
+
+def event_table_columns(keys_and_types, userid_sub, column_profile="full", excluded_columns=(), array_keys=None):
+    # Column names of the event table, in the order generate_event_table_query projects them
+    event_columns = [alias for _, alias in get_event_columns(userid_sub, "UTC", column_profile, excluded_columns)]
+    param_columns = [param_column_alias(key) for key in get_pivot_keys(keys_and_types, excluded_columns)]
+    array_columns = [alias for _, alias in get_table_array_columns(array_keys, "events", excluded_columns=excluded_columns)]
+    columns = ["ueid_dcount"] + event_columns + param_columns + [OTHER_PARAMS_COLUMN] + array_columns
+    return [column for column in columns if column not in excluded_columns]
+
+# How the event_params array is turned into columns:
+#   unnest   - cross join every event with its params, then MAX(IF(...)) and GROUP BY back to one row
+#   subquery - look each param up inside the event's own array, one row in and one row out, no regroup
+PIVOT_STRATEGIES = ["unnest", "subquery"]
 
 # 
-def generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts):
+def generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy="unnest", date_window=None, column_profile="full", excluded_columns=(), array_keys=None, event_names=(), deduplicate=False, batch_fields=True):
+    # excluded_columns (e.g. the constant columns found by profiling) are left out of the expansion, the pivot and
+    # the GROUP BY altogether. Excluded param keys don't go to event_params_other either. array_keys
+    # ({source: keys_and_types}) pivots other arrays of the event, e.g. user_properties, after event_params_other.
+    # event_names only keeps the events with those names. deduplicate drops exact duplicate events from the
+    # subquery pivot, the unnest pivot always merges them. batch_fields goes to generate_event_source.
     logging.info("Generating the event table query...")
 
-    userid_q = userid_sub.replace("sub.", "")
-    
+    if pivot_strategy == "subquery":
+        return generate_event_table_query_subquery(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window, column_profile, excluded_columns, array_keys, event_names, deduplicate, batch_fields)
+
+    # ueid is regrouped on, so every row is one event and ueid_dcount, kept for the dashboards that sum it, is 1
     pivot_sections = []
-    for key, value_type in keys_and_types.items():
-        column_alias = "event_param_" + key.replace("-", "_")  # Ensure valid SQL identifier
+    if "ueid_dcount" not in excluded_columns:
+        pivot_sections.append("1 AS ueid_dcount")
+    event_columns = get_event_columns(userid_sub, utc_ts, column_profile, excluded_columns)
+    pivot_sections += [alias for _, alias in event_columns]
+    for key, value_type in get_pivot_keys(keys_and_types, excluded_columns).items():
+        column_alias = param_column_alias(key)
         if value_type == 'string':
-            pivot_sections.append(f"MAX(IF(key = '{key}', string_value, NULL)) AS {column_alias}")
+            pivot_sections.append(f"MAX(IF(key = {sql_string(key)}, string_value, NULL)) AS {column_alias}")
         elif value_type == 'int':
-            pivot_sections.append(f"MAX(IF(key = '{key}', int_value, NULL)) AS {column_alias}")
+            pivot_sections.append(f"MAX(IF(key = {sql_string(key)}, int_value, NULL)) AS {column_alias}")
         elif value_type == 'float':
-            pivot_sections.append(f"MAX(IF(key = '{key}', float_value, NULL)) AS {column_alias}")
+            pivot_sections.append(f"MAX(IF(key = {sql_string(key)}, float_value, NULL)) AS {column_alias}")
+
+    # The long tail of keys collapses back into one JSON object per event, DISTINCT so a key seen twice
+    # (e.g. in both the daily and intraday shard) is only written once
+    if OTHER_PARAMS_COLUMN not in excluded_columns:
+        other_entry = generate_other_param_entry(keys_and_types, "key", "string_value", "int_value", "float_value")
+        pivot_sections.append(f"'{{' || STRING_AGG(DISTINCT {other_entry}, ',' ORDER BY {other_entry}) || '}}' AS {OTHER_PARAMS_COLUMN}")
 
-    pivot_sql = ",\n".join(pivot_sections)
+    # Other arrays are looked up once per event before the params fan out, and regrouped like a dimension
+    array_columns = get_table_array_columns(array_keys, "events", excluded_columns=excluded_columns)
+    event_columns += [(f"sub.{alias}", alias) for _, alias in array_columns]
+    pivot_sections += [alias for _, alias in array_columns]
+
+    pivot_sql = ",\n            ".join(pivot_sections)
+    column_sql = ",\n            ".join(f"{expression} AS {alias}" for expression, alias in event_columns)
+    group_sql = ", ".join(alias for _, alias in event_columns)
     
     union_subqueries = [
         f"""
         SELECT
-            sub.ueid,
-            DATETIME(TIMESTAMP_MICROS(sub.event_timestamp), "{utc_ts}") AS event_timezone,
-            sub.event_timestamp AS event_timestamp,
-            sub.event_date,
-            {userid_sub}
-            sub.event_name,
-            sub.platform AS event_platform,
-            sub.stream_id AS event_stream_id,
-            sub.traffic_source.source AS traffic_source,
-            sub.traffic_source.medium AS traffic_medium,
-            sub.traffic_source.name AS traffic_name,
-            sub.geo.country AS event_geo_country,
-            sub.geo.region AS event_geo_region,
-            sub.geo.city AS event_geo_city,
-            sub.geo.sub_continent AS event_geo_sub_continent,
-            sub.geo.metro AS event_geo_metro,
-            sub.geo.continent AS event_geo_continent,
-            sub.device.browser AS event_device_browser,
-            sub.device.language AS event_device_language,
-            sub.device.is_limited_ad_tracking AS event_device_is_limited_ad_tracking,
-            sub.device.mobile_model_name AS event_device_mobile_model_name,
-            sub.device.mobile_marketing_name AS event_device_mobile_marketing_name,
-            sub.device.mobile_os_hardware_model AS event_device_mobile_os_hardware_model,
-            sub.device.operating_system AS event_device_operating_system,
-            sub.device.operating_system_version AS event_device_operating_system_version,
-            sub.device.category AS event_device_category,
-            sub.device.mobile_brand_name AS event_device_mobile_brand_name,
-            sub.user_first_touch_timestamp AS event_user_first_touch_timestamp,
-            sub.user_ltv.revenue AS event_user_ltv_revenue,
-            sub.user_ltv.currency AS event_user_ltv_currency,
-            sub.device.web_info.browser AS web_info_browser,
-            sub.device.web_info.browser_version AS web_info_browser_version,
-            sub.device.web_info.hostname AS web_info_hostname,
-            sub.ecommerce.total_item_quantity AS total_item_quantity,
-            sub.ecommerce.purchase_revenue_in_usd AS purchase_revenue_in_usd,
-            sub.ecommerce.purchase_revenue AS purchase_revenue,			
-            sub.ecommerce.refund_value_in_usd AS refund_value_in_usd, 
-            sub.ecommerce.refund_value AS refund_value,	
-            sub.ecommerce.shipping_value_in_usd AS shipping_value_in_usd,		
-            sub.ecommerce.shipping_value AS shipping_value, 
-            sub.ecommerce.tax_value_in_usd AS tax_value_in_usd,		
-            sub.ecommerce.tax_value AS tax_value,
-            sub.ecommerce.unique_items AS unique_items,	
-            sub.ecommerce.transaction_id AS transaction_id,
+            {column_sql},
             ep.key AS key,
             ep.value.string_value AS string_value,
             ep.value.int_value AS int_value,
             ep.value.float_value AS float_value
-        FROM (
-            SELECT
-                GENERATE_UUID() as ueid,
-                *
-            FROM 
-                `{project_id}.{dataset_id}.{table_pattern}`
-        ) sub
+        FROM ({generate_event_source(project_id, dataset_id, table_pattern, date_window, utc_ts, columns=array_columns, event_names=event_names, batch_fields=batch_fields)}) sub
         CROSS JOIN UNNEST(sub.event_params) AS ep
         """
         for table_pattern in event_table_patterns
@@ -125,155 +457,137 @@ def generate_event_table_query(keys_and_types, project_id, dataset_id, event_tab
     ),
     pivot_table AS (
         SELECT 
-            COUNT(DISTINCT ueid) AS ueid_dcount,
-            event_timezone,
-            event_timestamp,
-            event_date,
-            {userid_q}
-            event_name,
-            event_platform,
-            event_stream_id,
-            traffic_source,
-            traffic_medium,
-            traffic_name,
-            event_geo_country,
-            event_geo_region,
-            event_geo_city,
-            event_geo_sub_continent,
-            event_geo_metro,
-            event_geo_continent,
-            event_device_browser,
-            event_device_language,
-            event_device_is_limited_ad_tracking,
-            event_device_mobile_model_name,
-            event_device_mobile_marketing_name,
-            event_device_mobile_os_hardware_model,
-            event_device_operating_system,
-            event_device_operating_system_version,
-            event_device_category,
-            event_device_mobile_brand_name,
-            event_user_first_touch_timestamp,
-            event_user_ltv_revenue,
-            event_user_ltv_currency,
-            web_info_browser,
-            web_info_browser_version,
-            web_info_hostname,
-            total_item_quantity,
-            purchase_revenue_in_usd,
-            purchase_revenue,			
-            refund_value_in_usd, 
-            refund_value,	
-            shipping_value_in_usd,		
-            shipping_value, 
-            tax_value_in_usd,		
-            tax_value,
-            unique_items,	
-            transaction_id,
             {pivot_sql}
         FROM 
             expanded
-       GROUP BY 
-    event_timezone, event_timestamp, event_date, {userid_q} event_name, event_platform, event_stream_id, traffic_source, traffic_medium, traffic_name, event_geo_country, event_geo_region, event_geo_city, event_geo_sub_continent, event_geo_metro, event_geo_continent, event_device_browser, event_device_language, event_device_is_limited_ad_tracking, event_device_mobile_model_name, event_device_mobile_marketing_name, event_device_mobile_os_hardware_model, event_device_operating_system, event_device_operating_system_version, event_device_category, event_device_mobile_brand_name, event_user_first_touch_timestamp, event_user_ltv_revenue, event_user_ltv_currency, web_info_browser, web_info_browser_version, web_info_hostname, total_item_quantity, purchase_revenue_in_usd, purchase_revenue, refund_value_in_usd, refund_value, shipping_value_in_usd,shipping_value, tax_value_in_usd, tax_value,unique_items, transaction_id
-)
+        GROUP BY 
+            {group_sql}
+    )
     SELECT 
         * 
     FROM 
         pivot_table
     """
 
-    logging.info(sql_query)
+    logging.debug(sql_query)
 
     return sql_query
 
-    logging.info("Event table query generated successfully...")
+def generate_event_table_query_subquery(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window=None, column_profile="full", excluded_columns=(), array_keys=None, event_names=(), deduplicate=False, batch_fields=True):
+    # Same columns as the unnest pivot, but each param is a correlated lookup into the event's own array.
+    # Every event stays a single output row, so there is no fan-out and no shuffle, unless deduplicate drops
+    # exact duplicates by ueid. ueid_dcount is kept for column compatibility and is always 1.
+    pivot_sections = []
+    if "ueid_dcount" not in excluded_columns:
+        pivot_sections.append("1 AS ueid_dcount")
+    pivot_sections += [f"{expression} AS {alias}" for expression, alias in get_event_columns(userid_sub, utc_ts, column_profile, excluded_columns)]
+    pivot_sections += [f"{expression} AS {alias}" for expression, alias in get_array_pivot_columns("event_params", get_pivot_keys(keys_and_types, excluded_columns), "sub")]
+    if OTHER_PARAMS_COLUMN not in excluded_columns:
+        other_entry = generate_other_param_entry(keys_and_types, "ep.key", "ep.value.string_value", "ep.value.int_value", "ep.value.float_value")
+        pivot_sections.append(f"(SELECT '{{' || STRING_AGG({other_entry}, ',' ORDER BY ep.key) || '}}' FROM UNNEST(sub.event_params) AS ep) AS {OTHER_PARAMS_COLUMN}")
+    pivot_sections += [f"{expression} AS {alias}" for expression, alias in get_table_array_columns(array_keys, "events", "sub", excluded_columns)]
+
+    pivot_sql = ",\n            ".join(pivot_sections)
 
-def generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts):
+    union_subqueries = [
+        f"""
+        SELECT
+            {pivot_sql}
+        FROM ({generate_event_source(project_id, dataset_id, table_pattern, date_window, utc_ts, deduplicate, event_names=event_names, batch_fields=batch_fields)}) sub
+        """
+        for table_pattern in event_table_patterns
+    ]
+
+    sql_query = f"""
+    WITH expanded AS (
+        {" UNION ALL ".join(union_subqueries)}
+    )
+    SELECT 
+        * 
+    FROM 
+        expanded
+    """
+
+    logging.debug(sql_query)
+
+    return sql_query
+
+# Flattened user columns shared by the users_ and pseudonymous_users_ snapshots, as (source expression, column alias).
+# {utc_ts} is filled in with the reporting timezone.
+USER_COLUMNS = [
+    ('DATETIME(TIMESTAMP_MICROS(user_info.last_active_timestamp_micros), "{utc_ts}")', "user_last_active_timestamp"),
+    ('DATETIME(TIMESTAMP_MICROS(user_info.user_first_touch_timestamp_micros), "{utc_ts}")', "user_first_touch_timestamp"),
+    ("user_info.first_purchase_date", "user_first_purchase_date"),
+    ("device.operating_system", "user_device_operating_system"),
+    ("device.category", "user_device_category"),
+    ("device.mobile_brand_name", "user_device_mobile_brand_name"),
+    ("device.mobile_model_name", "user_device_mobile_model_name"),
+    ("device.unified_screen_name", "user_device_unified_screen_name"),
+    ("geo.city", "user_geo_city"),
+    ("geo.country", "user_geo_country"),
+    ("geo.continent", "user_geo_continent"),
+    ("geo.region", "user_geo_region"),
+    ("user_ltv.revenue_in_usd", "user_ltv_revenue_in_usd"),
+    ("user_ltv.sessions", "user_ltv_sessions"),
+    ("user_ltv.engagement_time_millis", "user_ltv_engagement_time"),
+    ("user_ltv.purchases", "user_ltv_purchases"),
+    ("user_ltv.engaged_sessions", "user_ltv_engaged_sessions"),
+    ("user_ltv.session_duration_micros", "user_ltv_session_duration"),
+    ("predictions.in_app_purchase_score_7d", "user_prediction_in_app_purchase_score_7d"),
+    ("predictions.purchase_score_7d", "user_prediction_purchase_score_7d"),
+    ("predictions.churn_score_7d", "user_prediction_churn_score_7d"),
+    ("predictions.revenue_28d_in_usd", "user_prediction_revenue_28d"),
+    ("privacy_info.is_limited_ad_tracking", "is_limited_ad_tracking"),
+    ("privacy_info.is_ads_personalization_allowed", "is_ads_personalization_allowed"),
+    ("occurrence_date", "user_occurrence_date"),
+    ("last_updated_date", "user_last_updated_date"),
+]
+
+# The id column and user_type of each kind of user snapshot
+USER_TABLE_KINDS = {"pseudonymous_users": ("pseudo_user_id", "pseudo"), "users": ("user_id", "known")}
+
+def user_table_kind(pattern):
+    if "pseudonymous_users" in pattern:
+        return "pseudonymous_users"
+    elif "users" in pattern:
+        return "users"
+    return None
+
+def user_table_columns(excluded_columns=(), array_keys=None):
+    # Column names of the user table, in the order generate_user_table_query projects them
+    columns = ["user_id"] + [alias for _, alias in USER_COLUMNS] + ["user_type"]
+    columns += [alias for _, alias in get_table_array_columns(array_keys, "users", excluded_columns=excluded_columns)]
+    return [column for column in columns if column not in excluded_columns]
+
+def generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, date_window=None, excluded_columns=(), array_keys=None):
+    # Latest snapshot of every user. ROW_NUMBER keeps one row per user in a single pass over the wildcard,
+    # the most recently active first and the most recently updated snapshot on a tie. excluded_columns are
+    # left out, the ranking still reads what it needs. array_keys with audiences adds a column per audience,
+    # when the user joined it.
 
     union_subqueries = []
 
     for pattern in user_table_pattern:
-        if "pseudonymous_users" in pattern:
-            subquery = f"""
-            SELECT
-                pseudo_user_id AS user_id,
-                DATETIME(TIMESTAMP_MICROS(user_info.last_active_timestamp_micros), "{utc_ts}") AS user_last_active_timestamp,
-                DATETIME(TIMESTAMP_MICROS(user_info.user_first_touch_timestamp_micros), "{utc_ts}") AS user_first_touch_timestamp,
-                user_info.first_purchase_date AS user_first_purchase_date,
-                device.operating_system AS user_device_operating_system,
-                device.category AS user_device_category,
-                device.mobile_brand_name AS user_device_mobile_brand_name,
-                device.mobile_model_name AS user_device_mobile_model_name,
-                device.unified_screen_name AS user_device_unified_screen_name,
-                geo.city AS user_geo_city,
-                geo.country AS user_geo_country,
-                geo.continent AS user_geo_continent,
-                geo.region AS user_geo_region,
-                user_ltv.revenue_in_usd AS user_ltv_revenue_in_usd,
-                user_ltv.sessions AS user_ltv_sessions,
-                user_ltv.engagement_time_millis AS user_ltv_engagement_time,
-                user_ltv.purchases AS user_ltv_purchases,
-                user_ltv.engaged_sessions AS user_ltv_engaged_sessions,
-                user_ltv.session_duration_micros AS user_ltv_session_duration,
-                predictions.in_app_purchase_score_7d AS user_prediction_in_app_purchase_score_7d,
-                predictions.purchase_score_7d AS user_prediction_purchase_score_7d,
-                predictions.churn_score_7d AS user_prediction_churn_score_7d,
-                predictions.revenue_28d_in_usd AS user_prediction_revenue_28d,
-                privacy_info.is_limited_ad_tracking, 
-                privacy_info.is_ads_personalization_allowed,
-                occurrence_date AS user_occurrence_date,
-                last_updated_date AS user_last_updated_date,
-                "pseudo" as user_type,
-            FROM 
-                `{project_id}.{dataset_id}.{pattern}` AS main_table
-            WHERE
-            user_info.last_active_timestamp_micros = (
-                SELECT MAX(user_info.last_active_timestamp_micros)
-                FROM `{project_id}.{dataset_id}.{pattern}`
-                WHERE pseudo_user_id = main_table.pseudo_user_id
-            )
-            """
-            union_subqueries.append(subquery)
-        elif "users" in pattern:
-            subquery = f"""
+        kind = user_table_kind(pattern)
+        if kind is None:
+            continue
+        id_column, user_type = USER_TABLE_KINDS[kind]
+        columns = [(id_column, "user_id")] + [(expression.format(utc_ts=utc_ts), alias) for expression, alias in USER_COLUMNS] + [(f'"{user_type}"', "user_type")]
+        columns += get_table_array_columns(array_keys, "users")
+        column_sql = ",\n                ".join(f"{expression} AS {alias}" for expression, alias in columns if alias not in excluded_columns)
+        subquery = f"""
             SELECT
-                user_id AS user_id,
-                DATETIME(TIMESTAMP_MICROS(user_info.last_active_timestamp_micros), "{utc_ts}") AS user_last_active_timestamp,
-                DATETIME(TIMESTAMP_MICROS(user_info.user_first_touch_timestamp_micros), "{utc_ts}") AS user_first_touch_timestamp,
-                user_info.first_purchase_date AS user_first_purchase_date,
-                device.operating_system AS user_device_operating_system,
-                device.category AS user_device_category,
-                device.mobile_brand_name AS user_device_mobile_brand_name,
-                device.mobile_model_name AS user_device_mobile_model_name,
-                device.unified_screen_name AS user_device_unified_screen_name,
-                geo.city AS user_geo_city,
-                geo.country AS user_geo_country,
-                geo.continent AS user_geo_continent,
-                geo.region AS user_geo_region,
-                user_ltv.revenue_in_usd AS user_ltv_revenue_in_usd,
-                user_ltv.sessions AS user_ltv_sessions,
-                user_ltv.engagement_time_millis AS user_ltv_engagement_time,
-                user_ltv.purchases AS user_ltv_purchases,
-                user_ltv.engaged_sessions AS user_ltv_engaged_sessions,
-                user_ltv.session_duration_micros AS user_ltv_session_duration,
-                predictions.in_app_purchase_score_7d AS user_prediction_in_app_purchase_score_7d,
-                predictions.purchase_score_7d AS user_prediction_purchase_score_7d,
-                predictions.churn_score_7d AS user_prediction_churn_score_7d,
-                predictions.revenue_28d_in_usd AS user_prediction_revenue_28d,
-                privacy_info.is_limited_ad_tracking, 
-                privacy_info.is_ads_personalization_allowed,
-                occurrence_date AS user_occurrence_date,
-                last_updated_date AS user_last_updated_date,
-                "known" as user_type,
+                {column_sql},
             FROM 
                 `{project_id}.{dataset_id}.{pattern}` AS main_table
-            WHERE
-            user_info.last_active_timestamp_micros = (
-                SELECT MAX(user_info.last_active_timestamp_micros)
-                FROM `{project_id}.{dataset_id}.{pattern}`
-                WHERE user_id = main_table.user_id
-            )
+            WHERE TRUE
+            {generate_table_suffix_filter(date_window, utc_ts, keyword="AND")}
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY {id_column}
+                ORDER BY user_info.last_active_timestamp_micros DESC, last_updated_date DESC
+            ) = 1
             """
-            union_subqueries.append(subquery)
+        union_subqueries.append(subquery)
 
     # Join the individual subqueries with a "UNION ALL"
     combined_subqueries = " UNION ALL ".join(union_subqueries)
@@ -288,95 +602,27 @@ def generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts
         expanded
     """
 
-    logging.info(sql_query)
+    logging.debug(sql_query)
 
     return sql_query
 
     logging.info("User table query generated successfully...")
 
-def generate_item_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts):
+def generate_item_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window=None, excluded_columns=(), array_keys=None, batch_fields=True):
+    # array_keys with item_params adds a column per item_params key. Exact duplicate events are kept, see
+    # EVENT_KEY_FIELDS, so their items are in here twice with the same ueid.
     logging.info("Generating the item table query...")
 
+    columns = get_event_columns(userid_sub, utc_ts, excluded_columns=excluded_columns)
+    columns += [(f"it.{column}", column) for column in ITEM_COLUMNS if column not in excluded_columns]
+    columns += get_table_array_columns(array_keys, "items", "it", excluded_columns)
+    column_sql = ",\n            ".join(f"{expression} AS {alias}" for expression, alias in columns if alias not in excluded_columns)
+
     union_subqueries = [
         f"""
         SELECT
-            sub.ueid,
-            DATETIME(TIMESTAMP_MICROS(sub.event_timestamp), "{utc_ts}") AS event_timezone,
-            sub.event_timestamp AS event_timestamp,
-            sub.event_date,
-            {userid_sub}
-            sub.event_name,
-            sub.platform AS event_platform,
-            sub.stream_id AS event_stream_id,
-            sub.traffic_source.source AS traffic_source,
-            sub.traffic_source.medium AS traffic_medium,
-            sub.traffic_source.name AS traffic_name,
-            sub.geo.country AS event_geo_country,
-            sub.geo.region AS event_geo_region,
-            sub.geo.city AS event_geo_city,
-            sub.geo.sub_continent AS event_geo_sub_continent,
-            sub.geo.metro AS event_geo_metro,
-            sub.geo.continent AS event_geo_continent,
-            sub.device.browser AS event_device_browser,
-            sub.device.language AS event_device_language,
-            sub.device.is_limited_ad_tracking AS event_device_is_limited_ad_tracking,
-            sub.device.mobile_model_name AS event_device_mobile_model_name,
-            sub.device.mobile_marketing_name AS event_device_mobile_marketing_name,
-            sub.device.mobile_os_hardware_model AS event_device_mobile_os_hardware_model,
-            sub.device.operating_system AS event_device_operating_system,
-            sub.device.operating_system_version AS event_device_operating_system_version,
-            sub.device.category AS event_device_category,
-            sub.device.mobile_brand_name AS event_device_mobile_brand_name,
-            sub.user_first_touch_timestamp AS event_user_first_touch_timestamp,
-            sub.user_ltv.revenue AS event_user_ltv_revenue,
-            sub.user_ltv.currency AS event_user_ltv_currency,
-            sub.device.web_info.browser AS web_info_browser,
-            sub.device.web_info.browser_version AS web_info_browser_version,
-            sub.device.web_info.hostname AS web_info_hostname,
-            sub.ecommerce.total_item_quantity AS total_item_quantity,
-            sub.ecommerce.purchase_revenue_in_usd AS purchase_revenue_in_usd,
-            sub.ecommerce.purchase_revenue AS purchase_revenue,			
-            sub.ecommerce.refund_value_in_usd AS refund_value_in_usd, 
-            sub.ecommerce.refund_value AS refund_value,	
-            sub.ecommerce.shipping_value_in_usd AS shipping_value_in_usd,		
-            sub.ecommerce.shipping_value AS shipping_value, 
-            sub.ecommerce.tax_value_in_usd AS tax_value_in_usd,		
-            sub.ecommerce.tax_value AS tax_value,
-            sub.ecommerce.unique_items AS unique_items,	
-            sub.ecommerce.transaction_id AS transaction_id,
-            it.item_id AS item_id,
-            it.item_name AS item_name,
-            it.item_brand AS item_brand,
-            it.item_variant AS item_variant,
-            it.item_category AS item_category,
-            it.item_category2 AS item_category2,
-            it.item_category3 AS item_category3,
-            it.item_category4 AS item_category4,
-            it.item_category5 AS item_category5,
-            it.price_in_usd AS price_in_usd,
-            it.price AS price,
-            it.quantity AS quantity,
-            it.item_revenue_in_usd AS item_revenue_in_usd,
-            it.item_revenue AS item_revenue,
-            it.item_refund_in_usd AS item_refund_in_usd,
-            it.item_refund AS item_refund,
-            it.coupon AS coupon,
-            it.affiliation AS affiliation,
-            it.location_id AS location_id,
-            it.item_list_id AS item_list_id,
-            it.item_list_name AS item_list_name,
-            it.item_list_index AS item_list_index,
-            it.promotion_id AS promotion_id,
-            it.promotion_name AS promotion_name,
-            it.creative_name AS creative_name,
-            it.creative_slot AS creative_slot,
-        FROM (
-            SELECT
-                GENERATE_UUID() as ueid,
-                *
-            FROM 
-                `{project_id}.{dataset_id}.{table_pattern}`
-        ) sub
+            {column_sql},
+        FROM ({generate_event_source(project_id, dataset_id, table_pattern, date_window, utc_ts, batch_fields=batch_fields)}) sub
         CROSS JOIN UNNEST(sub.items) AS it
         """
         for table_pattern in event_table_patterns
@@ -393,7 +639,7 @@ def generate_item_table_query(keys_and_types, project_id, dataset_id, event_tabl
         expanded
     """
 
-    logging.info(sql_query)
+    logging.debug(sql_query)
 
     return sql_query
 
@@ -402,123 +648,1097 @@ def generate_item_table_query(keys_and_types, project_id, dataset_id, event_tabl
 # Function to retrieve schema columns
 def get_schema_columns(client, project_id, dataset_id, table_name):
     query = f"SELECT column_name FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS` WHERE table_name = '{table_name}'"
-    query_job = client.query(query)
-    return [row for row in query_job.result()]
+    return [row for row in run_query(client, query, name=f"{table_name} columns")]
 
-def get_distinct_counts(client, project_id, dataset_id, view_name):
-    try:
-        # Retrieve the column names in the view
-        view_columns = [column.column_name for column in get_schema_columns(client, project_id, dataset_id, view_name)]
-        if not view_columns:
-            logging.error(f"No columns found in the view: {view_name}")
-            st.error(f"No columns found in a view")
-            return {}
+# Columns whose type can't be compared or counted are left out of the profile
+UNPROFILED_TYPE_PREFIXES = ("ARRAY", "STRUCT", "RECORD", "JSON", "GEOGRAPHY")
 
-        # Create a query to get distinct counts for each column
-        distinct_count_query = ", ".join([f"COUNT(DISTINCT {col}) AS {col}" for col in view_columns])
-        query = f"""
+# Share of NULLs above which a column is reported as mostly empty
+MOSTLY_NULL_RATIO = 0.95
+
+def get_views_columns(client, project_id, dataset_id, view_names):
+    # {view_name: [(column_name, data_type), ...]} for several views in one metadata query
+    view_list = ", ".join(f"'{view_name}'" for view_name in view_names)
+    query = f"""
+    SELECT table_name, column_name, data_type
+    FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS`
+    WHERE table_name IN ({view_list})
+    ORDER BY table_name, ordinal_position
+    """
+    views_columns = {}
+    for row in run_query(client, query, name="view columns"):
+        views_columns.setdefault(row.table_name, []).append((row.column_name, row.data_type))
+    return views_columns
+
+def generate_profile_query(profile_sources):
+    # One job profiling every view: each UNION ALL branch scans its view once and returns one row with an
+    # array of per-column stats. A column with 0 or 1 distinct values is exactly COUNT(col) = 0 OR MIN = MAX,
+    # so the expensive exact COUNT(DISTINCT) isn't needed; APPROX_COUNT_DISTINCT is only there for reporting.
+    # profile_sources is a list of (view_name, FROM clause, [(column_name, data_type), ...]).
+    union_subqueries = []
+    for view_name, source, columns in profile_sources:
+        column_stats = ",\n                ".join(
+            f"STRUCT('{column}' AS column_name, APPROX_COUNT_DISTINCT({column}) AS approx_distinct, COUNTIF({column} IS NULL) AS null_count, IFNULL(MIN({column}) = MAX({column}), TRUE) AS is_constant)"
+            for column, data_type in columns
+            if not data_type.upper().startswith(UNPROFILED_TYPE_PREFIXES)
+        )
+        union_subqueries.append(f"""
         SELECT
-            {distinct_count_query}
+            '{view_name}' AS view_name,
+            COUNT(*) AS row_count,
+            [
+                {column_stats}
+            ] AS columns
         FROM
-            `{project_id}.{dataset_id}.{view_name}`
-        """
-        
-        query_job = client.query(query)
-        result = query_job.result()
-
-        # Convert result to a dictionary
-        for row in result:
-            distinct_counts = dict(row.items())
-            logging.info(f"Distinct counts for view {view_name}: {distinct_counts}")
-            return distinct_counts
-    except Exception as e:
-        logging.error(f"An error occurred while getting distinct counts for {view_name}: {e}")
-        st.error(f"An error occurred while getting distinct counts")
+            {source}
+        """)
+    return " UNION ALL ".join(union_subqueries)
+
+# Deployed views carry a fingerprint of the SQL and inputs they were generated from as a label, so a run that
+# would deploy the same thing again leaves them alone. BigQuery label values are at most 63 characters.
+FINGERPRINT_LABEL = "ga4tobq_fingerprint"
+FINGERPRINT_LENGTH = 40
+
+def get_fingerprint(query, inputs=None):
+    # sha256 of the SQL with its whitespace normalized, plus anything else it was generated from
+    payload = json.dumps({"sql": " ".join(query.split()), "inputs": inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:FINGERPRINT_LENGTH]
+
+# The last profile, reused while the profiled objects and the shards under them haven't changed
+PROFILE_STATE_TABLE = "ga4tobq_profile_state"
+
+def get_profile_fingerprint(client, project_id, dataset_id, query, tables):
+    # Views are what their fingerprint says, tables whatever they held when last modified, and both read shards.
+    # Intraday shards are left out, streaming rewrites them every few minutes and the profile would never be reused.
+    objects = {
+        table.table_id: table.labels.get(FINGERPRINT_LABEL) if table.table_type == "VIEW" else table.modified
+        for table in tables
+    }
+    shards = {
+        table_id: shard["last_modified_time"]
+        for table_id, shard in get_shard_catalog(client, project_id, dataset_id).items()
+        if not table_id.startswith("events_intraday_")
+    }
+    return get_fingerprint(query, {"objects": objects, "shards": shards})
+
+def get_saved_profile(client, project_id, dataset_id, fingerprint):
+    from google.api_core.exceptions import NotFound
+
+    query = f"SELECT profile FROM `{project_id}.{dataset_id}.{PROFILE_STATE_TABLE}` WHERE fingerprint = '{fingerprint}' LIMIT 1"
+    try:
+        rows = list(run_query(client, query, name=f"{PROFILE_STATE_TABLE} lookup"))
+    except NotFound:
+        return None
+    return json.loads(rows[0].profile) if rows else None
+
+def save_profile(client, project_id, dataset_id, fingerprint, profiles):
+    from google.cloud import bigquery
+
+    table_id = f"`{project_id}.{dataset_id}.{PROFILE_STATE_TABLE}`"
+    run_query(client, f"CREATE TABLE IF NOT EXISTS {table_id} (fingerprint STRING, profile STRING, profiled_at TIMESTAMP)", name=PROFILE_STATE_TABLE)
+    # Only the latest profile is kept, the JSON goes in as a parameter rather than an escaped literal
+    script = f"""
+    BEGIN TRANSACTION;
+    DELETE FROM {table_id} WHERE TRUE;
+    INSERT INTO {table_id} (fingerprint, profile, profiled_at) VALUES (@fingerprint, @profile, CURRENT_TIMESTAMP());
+    COMMIT TRANSACTION;
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("fingerprint", "STRING", fingerprint),
+        bigquery.ScalarQueryParameter("profile", "STRING", json.dumps(profiles)),
+    ])
+    run_query(client, script, job_config=job_config, name=f"{PROFILE_STATE_TABLE} update")
+
+def profile_views(client, project_id, dataset_id, view_names, sample_percent=None):
+    # {view_name: {"row_count": n, "columns": {column: {"approx_distinct", "null_count", "null_ratio", "is_constant"}}}}
+    # sample_percent only applies to objects that are tables, TABLESAMPLE can't read a view, and their profile is
+    # marked "sampled". The profile is only run again when the profile query, a profiled object or a shard has
+    # changed since the last one.
+    views_columns = get_views_columns(client, project_id, dataset_id, view_names)
+    profile_sources = []
+    tables = []
+    sampled = set()
+    for view_name in view_names:
+        if not views_columns.get(view_name):
+            logging.error(f"No columns found in the view: {view_name}")
+            continue
+        table = client.get_table(f"{project_id}.{dataset_id}.{view_name}")
+        source = f"`{project_id}.{dataset_id}.{view_name}`"
+        if sample_percent and table.table_type == "TABLE":
+            source += f" TABLESAMPLE SYSTEM ({sample_percent} PERCENT)"
+            sampled.add(view_name)
+        profile_sources.append((view_name, source, views_columns[view_name]))
+        tables.append(table)
+    if not profile_sources:
         return {}
 
-def identify_useless_columns(distinct_counts):
-    useless_columns = [column for column, count in distinct_counts.items() if count in (0, 1)]
+    query = generate_profile_query(profile_sources)
+    fingerprint = get_profile_fingerprint(client, project_id, dataset_id, query, tables)
+    saved = get_saved_profile(client, project_id, dataset_id, fingerprint)
+    if saved is not None:
+        logging.info(f"Nothing profiled has changed, reusing the profile {fingerprint}")
+        return saved
+
+    profiles = {}
+    for row in run_query(client, query, name="profile"):
+        profiles[row.view_name] = {
+            "row_count": row.row_count,
+            "sampled": row.view_name in sampled,
+            "columns": {
+                column["column_name"]: {
+                    "approx_distinct": column["approx_distinct"],
+                    "null_count": column["null_count"],
+                    "null_ratio": column["null_count"] / row.row_count if row.row_count else 1.0,
+                    "is_constant": column["is_constant"],
+                }
+                for column in row.columns
+            },
+        }
+        logging.info(f"Profile for view {row.view_name}: {profiles[row.view_name]}")
+    save_profile(client, project_id, dataset_id, fingerprint, profiles)
+    return profiles
+
+def identify_useless_columns(column_profiles):
+    useless_columns = [column for column, profile in column_profiles.items() if profile["is_constant"]]
     logging.info(f"Identified columns with 0 or 1 distinct values: {useless_columns}")
     return useless_columns
 
-def create_updated_view(client, project_id, dataset_id, view_name, columns_to_exclude):
+def get_columns_to_exclude(profile):
+    # The columns a _mini view drops. A sparse column can look all null or constant in a sample, so a sampled
+    # profile only feeds the data quality checks and never drops anything.
+    if profile.get("sampled"):
+        logging.info("The profile is of a sample, no columns are excluded from it")
+        return []
+    return identify_useless_columns(profile["columns"])
+
+def get_data_quality_checks(profiles):
+    # Findings for the Explanation tab's data quality promise, straight from the profile pass
+    checks = []
+    for view_name, profile in profiles.items():
+        # A sample can miss the few rows a sparse column is set on
+        view_name = f"{view_name} (sampled)" if profile.get("sampled") else view_name
+        if not profile["row_count"]:
+            checks.append({"view": view_name, "column": "", "check": "empty", "detail": "no rows in the selected date range"})
+            continue
+        for column, column_profile in profile["columns"].items():
+            if column_profile["null_count"] == profile["row_count"]:
+                checks.append({"view": view_name, "column": column, "check": "all null", "detail": "never populated"})
+            elif column_profile["is_constant"]:
+                checks.append({"view": view_name, "column": column, "check": "constant", "detail": "a single value in every populated row"})
+            elif column_profile["null_ratio"] >= MOSTLY_NULL_RATIO:
+                checks.append({"view": view_name, "column": column, "check": "mostly null", "detail": f"{column_profile['null_ratio']:.1%} null"})
+    return checks
+
+def create_updated_view(client, project_id, dataset_id, view_name, columns_to_exclude, source_query=None, mini_view_name=None):
+    # source_query is the view's own query regenerated without columns_to_exclude, so the _mini view reads the
+    # shards directly and doesn't unnest or group what it then throws away. Without one (a materialized table)
+    # the _mini view selects the remaining columns from view_name. mini_view_name is {view_name}_mini by default.
     try:
         if columns_to_exclude:
-            # Retrieve all column names
-            view_columns = [column.column_name for column in get_schema_columns(client, project_id, dataset_id, view_name)]
-            
-            # Generate the SELECT statement for the updated view excluding the identified columns
-            select_statement = ", ".join([col for col in view_columns if col not in columns_to_exclude])
-
-            # Create or replace the view with the updated SELECT statement
-            query = f"""
-            CREATE OR REPLACE VIEW `{project_id}.{dataset_id}.{view_name}_mini` AS
-            SELECT
-                {select_statement}
-            FROM
-                `{project_id}.{dataset_id}.{view_name}`
-            """
-            query_job = client.query(query)
-            query_job.result()
+            if source_query:
+                query = source_query
+            else:
+                # Retrieve all column names
+                view_columns = [column.column_name for column in get_schema_columns(client, project_id, dataset_id, view_name)]
+                
+                # Generate the SELECT statement for the updated view excluding the identified columns
+                select_statement = ", ".join([col for col in view_columns if col not in columns_to_exclude])
+
+                query = f"""
+                SELECT
+                    {select_statement}
+                FROM
+                    `{project_id}.{dataset_id}.{view_name}`
+                """
+            # Create or replace the view, left alone if it wouldn't change
+            create_or_replace_view(client, project_id, dataset_id, mini_view_name or f"{view_name}_mini", query)
             logging.info(f"Excluded columns with unique counts of 0 or 1 from the view: {', '.join(columns_to_exclude)}")
         else:
             logging.info(f"No columns to exclude in the view: {view_name}")
     except Exception as e:
         logging.error(f"An error occurred while creating the updated view for {view_name}: {e}")
-        st.error(f"An error occurred while creating or updating views")
+        raise
 
-# Your create_summary_statistics function remains the same
-
-def create_summary_statistics(client, project_id, dataset_id, view_names):
+def create_summary_statistics(client, project_id, dataset_id, view_names, sample_percent=None):
     logging.info("Creating summary statistics...")
 
-    for view_name in view_names:
+    profiles = profile_views(client, project_id, dataset_id, view_names, sample_percent)
+    for view_name, profile in profiles.items():
         logging.info(f"Creating summary statistics for view: {view_name}...")
-        distinct_counts = get_distinct_counts(client, project_id, dataset_id, view_name)
-        columns_to_exclude = identify_useless_columns(distinct_counts)
+        columns_to_exclude = get_columns_to_exclude(profile)
         create_updated_view(client, project_id, dataset_id, view_name, columns_to_exclude)
+    return profiles
 
 
-def create_or_replace_view(client, project_id, dataset_id, view_name, query):
+def create_or_replace_view(client, project_id, dataset_id, view_name, query, fingerprint_inputs=None):
+    # Returns whether the view was created or changed. A view already deployed from the same SQL and
+    # fingerprint_inputs is left as it is, which also keeps BigQuery's cached results for it.
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound, BadRequest, GoogleAPICallError
+
     logging.info(f"Creating/Modifying view: {view_name}...")
+    logging.debug(query)
     view_id = f"{project_id}.{dataset_id}.{view_name}"
-
-    view = bigquery.Table(view_id)
-    view.view_query = query
+    started = time.monotonic()
+    fingerprint = get_fingerprint(query, fingerprint_inputs)
 
     try:
-        # Check if the view already exists
-        client.get_table(view_id)
-        view_exists = True
+        # Check if the view already exists, and what it was deployed from
+        existing = client.get_table(view_id)
     except NotFound:
-        view_exists = False
+        existing = None
+    if existing is not None and existing.table_type == "VIEW" and existing.labels.get(FINGERPRINT_LABEL) == fingerprint:
+        logging.info(f"View {view_id} is up to date, skipping.")
+        record_job("view", view_name, time.monotonic() - started, {"skipped": True})
+        return False
+
+    view = bigquery.Table(view_id)
+    view.view_query = query
+    view.labels = {**(existing.labels if existing is not None else {}), FINGERPRINT_LABEL: fingerprint}
 
     try:
-        if view_exists:
-            view = client.update_table(view, ["view_query"])
+        if existing is not None:
+            view = client.update_table(view, ["view_query", "labels"])
             logging.info(f"Modified view {view_id} successfully.")
         else:
             view = client.create_table(view)
             logging.info(f"Created view {view_id} successfully.")
     except BadRequest as e:
         logging.error("Error: Bad request (e.g., schema or query issue). Details: %s", e)
-        st.error("Error: Bad request (e.g., schema or query issue). Check your logs")
+        record_job("view", view_name, time.monotonic() - started, error=str(e))
+        raise
     except GoogleAPICallError as e:
         logging.error("Error: API call failed. Details: %s", e)
-        st.error("Error: API call failed. Check your logs")
+        record_job("view", view_name, time.monotonic() - started, error=str(e))
+        raise
     except Exception as e:
         logging.error("An unexpected error occurred: %s", e)
-        st.error("Error: An unexpected error occurred. Check your logs")
+        record_job("view", view_name, time.monotonic() - started, error=str(e))
+        raise
+    record_job("view", view_name, time.monotonic() - started)
+    return True
+
+def create_user_table_view(client, project_id, dataset_id, user_table_pattern, utc_ts, date_window=None, array_keys=None):
+    user_table_query = generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, date_window, array_keys=array_keys)
+    return create_or_replace_view(client, project_id, dataset_id, "user_table_view", user_table_query, {"timezone": utc_ts, "date_window": date_window})
 
-def create_user_table_view(client, project_id, dataset_id, user_table_pattern, utc_ts):
-    user_table_query = generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts)
-    create_or_replace_view(client, project_id, dataset_id, "user_table_view", user_table_query)
+def create_event_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts, pivot_strategy="unnest", date_window=None, array_keys=None):
+    event_table_query = generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window, array_keys=array_keys)
+    return create_or_replace_view(client, project_id, dataset_id, "event_table_view", event_table_query, {"keys": keys_and_types, "timezone": utc_ts, "date_window": date_window})
+
+def create_item_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts, date_window=None, array_keys=None):
+    item_table_query = generate_item_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window, array_keys=array_keys)
+    logging.debug(item_table_query)
+    return create_or_replace_view(client, project_id, dataset_id, "item_table_view", item_table_query, {"keys": keys_and_types, "timezone": utc_ts, "date_window": date_window})
+
+def create_event_profile_views(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts, column_profiles, pivot_strategy="unnest", date_window=None, source_table=None):
+    # event_table_view_{profile} for each narrower column profile. Over the shards the profile's own query is
+    # generated so the pivot only carries its dimensions; over a materialized source_table the columns are simply
+    # projected, which is all the pruning a columnar table needs. Returns the view names.
+    view_names = []
+    for column_profile in column_profiles:
+        if column_profile == "full":
+            continue
+        if source_table:
+            columns = ", ".join(event_table_columns(keys_and_types, userid_sub, column_profile))
+            query = f"SELECT {columns} FROM `{project_id}.{dataset_id}.{source_table}`"
+        else:
+            query = generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window, column_profile)
+        view_name = f"event_table_view_{column_profile}"
+        create_or_replace_view(client, project_id, dataset_id, view_name, query, {"keys": keys_and_types, "timezone": utc_ts, "date_window": date_window})
+        view_names.append(view_name)
+    return view_names
+
+def event_name_view_name(event_name):
+    return re.sub(r"[^0-9A-Za-z_]", "_", event_name) + "_event_view"
+
+def create_event_name_views(client, project_id, dataset_id, event_table_patterns, userid_sub, event_name_keys, utc_ts, pivot_strategy="unnest", date_window=None, source_table=None, keys_and_types=None):
+    # {event_name}_event_view for each event name in event_name_keys ({event_name: keys_and_types}), with only the
+    # events of that name and a column for only the keys they carry. Over a materialized source_table, clustered by
+    # event_name, the view only reads that event's blocks; the table only has columns for keys_and_types, so the
+    # event's other keys stay in event_params_other. Returns the view names.
+    view_names = []
+    for event_name, event_keys in event_name_keys.items():
+        if source_table:
+            event_keys = {key: keys_and_types[key] for key in event_keys if key in keys_and_types}
+            columns = ", ".join(event_table_columns(event_keys, userid_sub))
+            query = f"SELECT {columns} FROM `{project_id}.{dataset_id}.{source_table}` WHERE event_name = {sql_string(event_name)}"
+        else:
+            query = generate_event_table_query(event_keys, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window, event_names=[event_name])
+        view_name = event_name_view_name(event_name)
+        create_or_replace_view(client, project_id, dataset_id, view_name, query, {"keys": event_keys, "timezone": utc_ts, "date_window": date_window})
+        view_names.append(view_name)
+    return view_names
+
+##############################################################################################################################################
+# Materialized event table
+##############################################################################################################################################
+
+# Tracks which source shard versions have been merged into each materialized table
+SHARD_STATE_TABLE = "ga4tobq_shard_state"
+
+def get_shard_metadata(client, project_id, dataset_id):
+    # One metadata read for every dated GA4 export shard in the dataset, no data is scanned
+    query = f"""
+    SELECT table_id, row_count, size_bytes, last_modified_time
+    FROM `{project_id}.{dataset_id}.__TABLES__`
+    WHERE REGEXP_CONTAINS(table_id, r'^(events|events_intraday|users|pseudonymous_users)_[0-9]{{8}}$')
+    """
+    return {
+        row.table_id: {"row_count": row.row_count, "size_bytes": row.size_bytes, "last_modified_time": row.last_modified_time}
+        for row in run_query(client, query, name="shard metadata")
+    }
+
+# How long a shard catalog is reused before __TABLES__ is read again. GA4 writes shards a few times a day at most,
+# and a stale catalog only means a new shard waits for the next refresh or a restated one is merged again.
+SHARD_CATALOG_TTL_SECONDS = 300
+
+# Catalogs fetched in this process, {(project_id, dataset_id): (fetched_at, catalog)}
+_shard_catalogs = {}
+
+def get_shard_catalog(client, project_id, dataset_id, max_age_seconds=SHARD_CATALOG_TTL_SECONDS):
+    # get_shard_metadata, reused for max_age_seconds so the checks, planning and refresh steps of a run share one
+    # metadata query. If GA4TOBQ_CACHE_DIR is set the catalog is also kept there as JSON, shared between runs.
+    cache_key = (project_id, dataset_id)
+    if cache_key in _shard_catalogs and time.time() - _shard_catalogs[cache_key][0] <= max_age_seconds:
+        return _shard_catalogs[cache_key][1]
+
+    cache_dir = os.environ.get("GA4TOBQ_CACHE_DIR")
+    cache_path = os.path.join(cache_dir, f"{project_id}.{dataset_id}.shards.json") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if time.time() - cached["fetched_at"] <= max_age_seconds:
+            _shard_catalogs[cache_key] = (cached["fetched_at"], cached["shards"])
+            return cached["shards"]
+
+    fetched_at = time.time()
+    catalog = get_shard_metadata(client, project_id, dataset_id)
+    logging.info(f"Shard catalog for {project_id}.{dataset_id}: {len(catalog)} shards")
+    _shard_catalogs[cache_key] = (fetched_at, catalog)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump({"fetched_at": fetched_at, "shards": catalog}, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    return catalog
+
+def get_window_bytes(catalog, table_patterns, date_window=None, utc_ts="UTC"):
+    # Stored bytes of the shards a window covers, an upper bound on what one full read of them scans
+    return sum(
+        catalog[table_id]["size_bytes"] or 0
+        for table_ids in match_shards(catalog, table_patterns, date_window, utc_ts).values()
+        for table_id in table_ids
+    )
+
+def match_shards(table_ids, table_patterns, date_window=None, utc_ts="UTC"):
+    # Group the shards matched by the wildcard patterns and date window by their date suffix: {suffix: [table_id, ...]}
+    start, end = date_window_bounds(date_window, utc_ts)
+    shards = {}
+    for table_id in table_ids:
+        table_prefix, _, suffix = table_id.rpartition("_")
+        if (start and suffix < start) or (end and suffix > end):
+            continue
+        if date_window and "suffixes" in date_window and suffix not in date_window["suffixes"]:
+            continue
+        for table_pattern in table_patterns:
+            pattern_prefix, _, pattern_suffix = table_pattern.rpartition("_")
+            if table_pattern and table_prefix == pattern_prefix and fnmatch(suffix, pattern_suffix):
+                shards.setdefault(suffix, []).append(table_id)
+    return shards
+
+def prefer_daily_shards(shards):
+    # Once GA4 has finalised a day its intraday table holds the same events again, so only the daily one is read
+    return {
+        suffix: [table_id for table_id in table_ids if not table_id.startswith("events_intraday_")] or table_ids
+        for suffix, table_ids in shards.items()
+    }
+
+def ensure_shard_state_table(client, project_id, dataset_id):
+    query = f"""
+    CREATE TABLE IF NOT EXISTS `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}` (
+        target_table STRING,
+        shard_suffix STRING,
+        table_id STRING,
+        last_modified_time INT64,
+        config STRING,
+        merged_at TIMESTAMP
+    )
+    """
+    run_query(client, query, name=SHARD_STATE_TABLE)
+
+def get_shard_state(client, project_id, dataset_id, target_table):
+    # {suffix: {"tables": {table_id: last_modified_time}, "config": config}} for everything merged into target_table
+    query = f"""
+    SELECT shard_suffix, table_id, last_modified_time, config
+    FROM `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}`
+    WHERE target_table = '{target_table}'
+    """
+    state = {}
+    for row in run_query(client, query, name=f"{target_table} shard state"):
+        entry = state.setdefault(row.shard_suffix, {"tables": {}, "config": row.config})
+        entry["tables"][row.table_id] = row.last_modified_time
+    return state
+
+def get_changed_shards(shards, shard_metadata, state, config):
+    # Suffixes that are new, whose source tables were added, dropped or restated, or that were merged with another config
+    changed = []
+    for suffix in sorted(shards):
+        current = {table_id: shard_metadata[table_id]["last_modified_time"] for table_id in shards[suffix]}
+        recorded = state.get(suffix)
+        if recorded is None or recorded["tables"] != current or recorded["config"] != config:
+            changed.append(suffix)
+    return changed
+
+def generate_shard_state_update(project_id, dataset_id, target_table, suffix, table_ids, shard_metadata, config):
+    values = ",\n        ".join(
+        f"('{target_table}', '{suffix}', '{table_id}', {shard_metadata[table_id]['last_modified_time']}, '{config}', CURRENT_TIMESTAMP())"
+        for table_id in table_ids
+    )
+    return f"""
+    DELETE FROM `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}`
+    WHERE target_table = '{target_table}' AND shard_suffix = '{suffix}';
+    INSERT INTO `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}` (target_table, shard_suffix, table_id, last_modified_time, config, merged_at)
+    VALUES
+        {values};
+    """
+
+# BigQuery reports some column types by their legacy names
+LEGACY_SQL_TYPES = {"INTEGER": "INT64", "FLOAT": "FLOAT64"}
+
+def fit_column_types(keys_and_types, column_types, source="event_params"):
+    # keys_and_types without the keys whose column in an existing table ({column: type}) has another type. A key's
+    # most common type can change as traffic does, and no MERGE can write the new type into the old column, so the
+    # key is left unpivoted: event_params keys go to event_params_other, other arrays' keys stay empty.
+    fitted = {}
+    for key, value_type in keys_and_types.items():
+        column_alias = array_column_alias(source, key)
+        column_type = column_types.get(column_alias)
+        if column_type and value_type in PARAM_SQL_TYPES and LEGACY_SQL_TYPES.get(column_type, column_type) != PARAM_SQL_TYPES[value_type]:
+            logging.warning(f"{column_alias} is {column_type} but {key} is now mostly {value_type}, leaving it out of the pivot")
+            continue
+        fitted[key] = value_type
+    return fitted
+
+def ensure_event_table(client, project_id, dataset_id, table_name, keys_and_types, seed_query, array_keys=None):
+    from google.api_core.exceptions import NotFound
+
+    table_id = f"{project_id}.{dataset_id}.{table_name}"
+    try:
+        existing_columns = {field.name for field in client.get_table(table_id).schema}
+    except NotFound:
+        # Empty table with the schema of the generated query, partitioned by day and clustered for the dashboards
+        query = f"""
+        CREATE TABLE IF NOT EXISTS `{table_id}`
+        PARTITION BY event_partition_date
+        CLUSTER BY event_name, user_pseudo_id
+        AS
+        SELECT *, CAST(NULL AS DATE) AS event_partition_date FROM ({seed_query}) WHERE FALSE
+        """
+        run_query(client, query, name=table_name)
+        logging.info(f"Created materialized table {table_id}")
+        return
+
+    # Newly discovered event params become new nullable columns
+    missing_columns = [] if "ueid" in existing_columns else ["ADD COLUMN IF NOT EXISTS ueid INT64"]
+    missing_columns += [
+        f"ADD COLUMN IF NOT EXISTS {param_column_alias(key)} {PARAM_SQL_TYPES[value_type]}"
+        for key, value_type in keys_and_types.items()
+        if value_type in PARAM_SQL_TYPES and param_column_alias(key) not in existing_columns
+    ]
+    if OTHER_PARAMS_COLUMN not in existing_columns:
+        missing_columns.append(f"ADD COLUMN IF NOT EXISTS {OTHER_PARAMS_COLUMN} STRING")
+    missing_columns += [
+        f"ADD COLUMN IF NOT EXISTS {array_column_alias(source, key)} {PARAM_SQL_TYPES[value_type]}"
+        for source in get_array_sources(array_keys or {}, ["events"]) if source != "event_params"
+        for key, value_type in array_keys[source].items()
+        if value_type in PARAM_SQL_TYPES and array_column_alias(source, key) not in existing_columns
+    ]
+    if missing_columns:
+        run_query(client, f"ALTER TABLE `{table_id}` {', '.join(missing_columns)}", name=f"{table_name} columns")
+        logging.info(f"Added {len(missing_columns)} event param columns to {table_id}")
+
+def create_pass_through_view(client, project_id, dataset_id, view_name, table_name):
+    # SELECT * over table_name. Its SQL never changes, but BigQuery keeps the schema a view had when it was
+    # created, so the table's columns are part of the fingerprint and new columns redeploy it.
+    columns = [f"{field.name} {field.field_type}" for field in client.get_table(f"{project_id}.{dataset_id}.{table_name}").schema]
+    return create_or_replace_view(client, project_id, dataset_id, view_name, f"SELECT * FROM `{project_id}.{dataset_id}.{table_name}`", {"columns": columns})
+
+def generate_partition_date(suffix):
+    return f"DATE '{suffix[:4]}-{suffix[4:6]}-{suffix[6:]}'"
+
+def generate_event_partition_merge(project_id, dataset_id, table_name, shard_query, suffix, columns):
+    # Replace one daily partition with the contents of its shard(s) in a single MERGE.
+    # The partition date comes from the shard suffix so a rerun always replaces exactly what it wrote before.
+    partition_date = generate_partition_date(suffix)
+    column_sql = ", ".join(columns + ["event_partition_date"])
+    return f"""
+    MERGE `{project_id}.{dataset_id}.{table_name}` T
+    USING (
+        SELECT *, {partition_date} AS event_partition_date FROM ({shard_query})
+    ) S
+    ON FALSE
+    WHEN NOT MATCHED BY SOURCE AND T.event_partition_date = {partition_date} THEN
+        DELETE
+    WHEN NOT MATCHED THEN
+        INSERT ({column_sql}) VALUES ({column_sql})
+    """
+
+def generate_partition_drop(project_id, dataset_id, table_name, suffixes):
+    # Delete the partitions of suffixes and what was recorded about them
+    partition_list = ", ".join(generate_partition_date(suffix) for suffix in suffixes)
+    suffix_list = ", ".join(f"'{suffix}'" for suffix in suffixes)
+    return f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{project_id}.{dataset_id}.{table_name}`
+    WHERE event_partition_date IN ({partition_list});
+    DELETE FROM `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}`
+    WHERE target_table = '{table_name}' AND shard_suffix IN ({suffix_list});
+    COMMIT TRANSACTION;
+    """
+
+def get_event_table_config(userid_sub, utc_ts, pivot_strategy):
+    # A different event key rewrites every partition, so no day keeps the old ueids. Pivoted keys don't: a newly
+    # discovered key gets its column from ensure_event_table and is filled from the day it is merged on, the days
+    # before keep its values in event_params_other, so a new key or a shift in the top keys never rescans history.
+    return f"{utc_ts}|{userid_sub}|{pivot_strategy}|{','.join(EVENT_KEY_FIELDS + EVENT_BATCH_FIELDS)}"
+
+def get_changed_event_shards(client, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy="unnest", date_window=None, table_name="event_table"):
+    # (shards, changed) of the materialized event table: {suffix: table_ids} in the window, and the suffixes a
+    # refresh would merge
+    from google.api_core.exceptions import NotFound
+
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    shards = prefer_daily_shards(match_shards(shard_metadata, event_table_patterns, date_window, utc_ts))
+    try:
+        client.get_table(f"{project_id}.{dataset_id}.{table_name}")
+        state = get_shard_state(client, project_id, dataset_id, table_name)
+    except NotFound:
+        state = {}
+    return shards, get_changed_shards(shards, shard_metadata, state, get_event_table_config(userid_sub, utc_ts, pivot_strategy))
+
+def create_event_table_materialized(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts, pivot_strategy="unnest", date_window=None, table_name="event_table", array_keys=None, drop_outside_window=True):
+    from google.api_core.exceptions import NotFound
+
+    logging.info("Refreshing materialized event table...")
+    ensure_shard_state_table(client, project_id, dataset_id)
+
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    shards = prefer_daily_shards(match_shards(shard_metadata, event_table_patterns, date_window, utc_ts))
+    if not shards:
+        logging.info(f"No event shards match {event_table_patterns}")
+        return []
+
+    config = get_event_table_config(userid_sub, utc_ts, pivot_strategy)
+    try:
+        table = client.get_table(f"{project_id}.{dataset_id}.{table_name}")
+        state = get_shard_state(client, project_id, dataset_id, table_name)
+        column_types = {field.name: field.field_type for field in table.schema}
+    except NotFound:
+        # The table was never built or has been dropped, so nothing recorded for it can be trusted
+        state = {}
+        column_types = {}
+    keys_and_types = fit_column_types(keys_and_types, column_types)
+    if array_keys:
+        array_keys = {source: fit_column_types(keys, column_types, source) for source, keys in array_keys.items()}
+    columns = event_table_columns(keys_and_types, userid_sub, array_keys=array_keys)
+    changed = get_changed_shards(shards, shard_metadata, state, config)
+    logging.info(f"{len(changed)} of {len(shards)} event shards are new or changed: {changed}")
+    if column_types:
+        # New keys get their column even on a run that merges no day, the views over the table select it
+        ensure_event_table(client, project_id, dataset_id, table_name, keys_and_types, None, array_keys)
+
+    for i, suffix in enumerate(changed):
+        logging.info(f"Merging events for {suffix} ({i + 1}/{len(changed)})")
+        # Duplicates are dropped once here, a day at a time, instead of in every read of the table
+        batch_fields = has_batch_fields(client, project_id, dataset_id, shards[suffix])
+        shard_query = generate_event_table_query(keys_and_types, project_id, dataset_id, shards[suffix], userid_sub, utc_ts, pivot_strategy, array_keys=array_keys, deduplicate=True, batch_fields=batch_fields)
+        if i == 0 and not column_types:
+            ensure_event_table(client, project_id, dataset_id, table_name, keys_and_types, shard_query, array_keys)
+        script = f"""
+        BEGIN TRANSACTION;
+        {generate_event_partition_merge(project_id, dataset_id, table_name, shard_query, suffix, columns)};
+        {generate_shard_state_update(project_id, dataset_id, table_name, suffix, shards[suffix], shard_metadata, config)}
+        COMMIT TRANSACTION;
+        """
+        run_query(client, script, name=f"{table_name} {suffix}")
+
+    # Days a windowed table no longer covers, e.g. the rolling window has moved past them. Not when the window was
+    # only narrowed to fit a byte budget (drop_outside_window), which would throw away history that is paid for.
+    dropped = sorted(suffix for suffix in state if suffix not in shards) if date_window and drop_outside_window else []
+    if dropped:
+        logging.info(f"Dropping {len(dropped)} event partitions outside the window: {dropped}")
+        run_query(client, generate_partition_drop(project_id, dataset_id, table_name, dropped), name=f"{table_name} dropped partitions")
+
+    # Keep the view name the dashboards and summary statistics already use, as a thin pass-through
+    create_pass_through_view(client, project_id, dataset_id, "event_table_view", table_name)
+    return changed
+
+##############################################################################################################################################
+# Event param key manifest
+##############################################################################################################################################
+
+# Keys, value types and their occurrence counts of each array (source) per event name in each event shard, plus one
+# marker row per shard and source (key IS NULL) with the last_modified_time of the version that was scanned
+KEY_MANIFEST_TABLE = "ga4tobq_key_manifest"
+
+def ensure_key_manifest_table(client, project_id, dataset_id):
+    query = f"""
+    CREATE TABLE IF NOT EXISTS `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}` (
+        table_id STRING,
+        last_modified_time INT64,
+        key STRING,
+        value_type STRING,
+        occurrences INT64,
+        source STRING,
+        event_name STRING
+    )
+    CLUSTER BY table_id
+    """
+    run_query(client, query, name=KEY_MANIFEST_TABLE)
+    # Manifests from before occurrences, sources or event names were recorded get the columns, their shards are
+    # rescanned to fill them
+    run_query(client, f"ALTER TABLE `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}` ADD COLUMN IF NOT EXISTS occurrences INT64, ADD COLUMN IF NOT EXISTS source STRING, ADD COLUMN IF NOT EXISTS event_name STRING", name=f"{KEY_MANIFEST_TABLE} columns")
+
+def get_key_manifest_shards(client, project_id, dataset_id):
+    # {source: {table_id: last_modified_time}} for every shard already in the manifest. Markers have occurrences = 0
+    # and an empty event_name, a NULL occurrences, source or event_name means the shard was scanned before those
+    # were recorded.
+    query = f"""
+    SELECT source, table_id, last_modified_time
+    FROM `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}`
+    WHERE key IS NULL AND occurrences IS NOT NULL AND source IS NOT NULL AND event_name IS NOT NULL
+    """
+    scanned = {}
+    for row in run_query(client, query, name=f"{KEY_MANIFEST_TABLE} shards"):
+        scanned.setdefault(row.source, {})[row.table_id] = row.last_modified_time
+    return scanned
+
+def generate_key_scan_query(project_id, dataset_id, table_ids, sources=("event_params",)):
+    # events_* covers both the daily and intraday shards, so _TABLE_SUFFIX is either YYYYMMDD or
+    # intraday_YYYYMMDD and the shard name is rebuilt from it. Every array in sources is counted per event name in
+    # the same scan.
+    suffix_list = ", ".join(f"'{table_id[len('events_'):]}'" for table_id in table_ids)
+    entries = ",\n        ".join(generate_array_key_entries(source) for source in sources)
+    return f"""
+    SELECT CONCAT('events_', _TABLE_SUFFIX) AS table_id,
+           NULL AS last_modified_time,
+           found.key AS key, 
+           found.value_type AS value_type,
+           COUNT(*) AS occurrences,
+           found.source AS source,
+           sub.event_name AS event_name
+    FROM `{project_id}.{dataset_id}.events_*` sub
+    CROSS JOIN UNNEST(ARRAY_CONCAT(
+        {entries}
+    )) AS found
+    WHERE _TABLE_SUFFIX IN ({suffix_list})
+    GROUP BY table_id, source, event_name, key, value_type
+    """
+
+def generate_key_manifest_update(project_id, dataset_id, table_ids, shard_metadata, dropped_table_ids=(), sources=("event_params",)):
+    # Rescan only the given shards and replace their rows for sources, the rows of other sources stay
+    table_list = ", ".join(f"'{table_id}'" for table_id in table_ids)
+    source_list = ", ".join(f"'{source}'" for source in sources)
+    condition = f"(table_id IN ({table_list}) AND (source IS NULL OR source IN ({source_list})))"
+    if dropped_table_ids:
+        dropped_list = ", ".join(f"'{table_id}'" for table_id in dropped_table_ids)
+        condition += f" OR table_id IN ({dropped_list})"
+    markers = ",\n        ".join(
+        f"('{table_id}', {shard_metadata[table_id]['last_modified_time']}, NULL, NULL, 0, '{source}', '')" for table_id in table_ids for source in sources
+    )
+    return f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}`
+    WHERE {condition};
+    INSERT INTO `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}` (table_id, last_modified_time, key, value_type, occurrences, source, event_name)
+    {generate_key_scan_query(project_id, dataset_id, table_ids, sources)};
+    INSERT INTO `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}` (table_id, last_modified_time, key, value_type, occurrences, source, event_name)
+    VALUES
+        {markers};
+    COMMIT TRANSACTION;
+    """
+
+def get_stale_key_shards(table_ids, shard_metadata, scanned):
+    return [table_id for table_id in table_ids if scanned.get(table_id) != shard_metadata[table_id]["last_modified_time"]]
+
+def get_stale_array_shards(table_ids, shard_metadata, scanned, sources):
+    # Shards that are new or changed for any of sources, rescanned for all of them at once
+    stale = {table_id for source in sources for table_id in get_stale_key_shards(table_ids, shard_metadata, scanned.get(source, {}))}
+    return sorted(stale)
+
+def get_key_manifest_table_ids(shard_metadata, event_table_patterns, date_window=None, utc_ts="UTC"):
+    # The event shards of the window whose keys count, intraday shards only for days without a daily shard
+    return sorted(table_id for shard in prefer_daily_shards(match_shards(shard_metadata, event_table_patterns, date_window, utc_ts)).values() for table_id in shard)
+
+def get_array_keys_and_types_incremental(client, project_id, dataset_id, event_table_patterns, sources, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    # Same result as get_array_keys_and_types, but only shards that are new or changed since the last run are scanned
+    logging.info(f"Getting unique keys and their types of {', '.join(sources)}...")
+    ensure_key_manifest_table(client, project_id, dataset_id)
+
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    table_ids = get_key_manifest_table_ids(shard_metadata, event_table_patterns, date_window, utc_ts)
+    if not table_ids:
+        return {source: {} for source in sources}
+
+    scanned = get_key_manifest_shards(client, project_id, dataset_id)
+    stale = get_stale_array_shards(table_ids, shard_metadata, scanned, sources)
+    logging.info(f"Key manifest: scanning {len(stale)} of {len(table_ids)} event shards: {stale}")
+    if stale:
+        logging.info(f"Scanning {len(stale)} new or changed event table(s) for keys")
+        # Shards GA4 has since deleted (usually intraday tables) are dropped from the manifest at the same time
+        dropped = sorted({table_id for source_shards in scanned.values() for table_id in source_shards if table_id not in shard_metadata})
+        run_query(client, generate_key_manifest_update(project_id, dataset_id, stale, shard_metadata, dropped, sources), name="key scan")
+
+    table_list = ", ".join(f"'{table_id}'" for table_id in table_ids)
+    source_list = ", ".join(f"'{source}'" for source in sources)
+    query = f"""
+    SELECT source, key, value_type, SUM(occurrences) AS occurrences
+    FROM `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}`
+    WHERE key IS NOT NULL AND source IN ({source_list}) AND table_id IN ({table_list})
+    GROUP BY source, key, value_type
+    """
+    rows = ((row.source, row.key, row.value_type, row.occurrences) for row in run_query(client, query, name="key discovery"))
+    return select_array_pivot_keys(get_array_key_statistics(rows, sources), min_occurrences, top_n)
+
+def get_unique_keys_and_types_incremental(client, project_id, dataset_id, event_table_patterns, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    return get_array_keys_and_types_incremental(client, project_id, dataset_id, event_table_patterns, ["event_params"], date_window, utc_ts, min_occurrences, top_n)["event_params"]
+
+def get_event_name_keys_and_types(client, project_id, dataset_id, event_table_patterns, event_names, date_window=None, utc_ts="UTC", min_occurrences=None, top_n=None):
+    # {event_name: {key: value_type}} of the event_params keys each of event_names carries, read from the key
+    # manifest, which get_array_keys_and_types_incremental must have brought up to date. min_occurrences and top_n
+    # cut the keys of each event name on their own.
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    table_ids = get_key_manifest_table_ids(shard_metadata, event_table_patterns, date_window, utc_ts)
+    if not table_ids:
+        return {event_name: {} for event_name in event_names}
+
+    table_list = ", ".join(f"'{table_id}'" for table_id in table_ids)
+    event_name_list = ", ".join(sql_string(event_name) for event_name in event_names)
+    query = f"""
+    SELECT event_name, key, value_type, SUM(occurrences) AS occurrences
+    FROM `{project_id}.{dataset_id}.{KEY_MANIFEST_TABLE}`
+    WHERE key IS NOT NULL AND source = 'event_params' AND event_name IN ({event_name_list}) AND table_id IN ({table_list})
+    GROUP BY event_name, key, value_type
+    """
+    rows = ((row.event_name, row.key, row.value_type, row.occurrences) for row in run_query(client, query, name="event name keys"))
+    event_name_statistics = get_array_key_statistics(rows, event_names)
+    return {event_name: select_pivot_keys(key_statistics, min_occurrences, top_n, f"{event_name} event_params") for event_name, key_statistics in event_name_statistics.items()}
+
+##############################################################################################################################################
+# Dry-run cost planning
+##############################################################################################################################################
+
+def generate_item_check_query(project_id, dataset_id, table_name):
+    # Reads only the items column of one shard, stopping at the first event that has any
+    return f"""
+        SELECT 1 AS has_items FROM `{project_id}.{dataset_id}.{table_name}` WHERE ARRAY_LENGTH(items) > 0 LIMIT 1
+        """
+
+def dry_run_query(client, query):
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(query, job_config=job_config)
+
+def plan_pipeline_costs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, item_check_table, keys_and_types=None, pivot_strategy="unnest", date_window=None, pivot_arrays=(), event_mode="view"):
+    from google.api_core.exceptions import NotFound
+
+    # Estimated bytes scanned by every statement the pipeline runs, from dry runs only.
+    # A pivot reads the whole array column whichever keys it pivots, so before discovery has run a placeholder
+    # key per array gives the same estimate as the real key sets. A materialized event table only reads the days
+    # it would merge.
+    if not keys_and_types:
+        keys_and_types = {"page_location": "string"}
+    array_keys = {source: {"placeholder": next(iter(NESTED_ARRAYS[source]["values"]))} for source in pivot_arrays}
+    estimates = {}
+
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    table_ids = sorted(table_id for shard in prefer_daily_shards(match_shards(shard_metadata, event_table_patterns, date_window, utc_ts)).values() for table_id in shard)
+    try:
+        scanned = get_key_manifest_shards(client, project_id, dataset_id)
+    except NotFound:
+        scanned = {}
+    sources = get_array_sources(["event_params", *pivot_arrays], ["events", "items"])
+    stale = get_stale_array_shards(table_ids, shard_metadata, scanned, sources)
+    estimates["Key discovery"] = dry_run_query(client, generate_key_scan_query(project_id, dataset_id, stale, sources)).total_bytes_processed if stale else 0
+    user_sources = get_array_sources(pivot_arrays, ["users"])
+    user_patterns = [pattern for pattern in user_table_pattern if pattern]
+    if user_sources and user_patterns:
+        estimates["Key discovery"] += dry_run_query(client, generate_key_discovery_query(project_id, dataset_id, user_patterns, date_window, utc_ts, user_sources)).total_bytes_processed
+
+    view_queries = {
+        "user_table_view": generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, date_window, array_keys=array_keys),
+        "event_table_view": generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window, array_keys=array_keys),
+        "item_table_view": generate_item_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, date_window, array_keys=array_keys),
+    }
+    estimates["Ecommerce check"] = dry_run_query(client, generate_item_check_query(project_id, dataset_id, item_check_table)).total_bytes_processed
+    profile_sources = []
+    for view_name, query in view_queries.items():
+        query_job = dry_run_query(client, query)
+        estimates[f"Query {view_name}"] = query_job.total_bytes_processed
+        profile_sources.append((view_name, f"({query})", [(field.name, "ARRAY" if field.mode == "REPEATED" else field.field_type) for field in query_job.schema]))
+    estimates["Summary statistics"] = dry_run_query(client, generate_profile_query(profile_sources)).total_bytes_processed
+    if event_mode == "materialized":
+        _, changed = get_changed_event_shards(client, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, date_window)
+        merge_query = generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts, pivot_strategy, {"suffixes": changed}, array_keys=array_keys)
+        del estimates["Query event_table_view"]
+        estimates["Merge event_table"] = dry_run_query(client, merge_query).total_bytes_processed if changed else 0
+
+    logging.info(f"Estimated bytes for {describe_date_window(date_window)}: {estimates}")
+    return estimates
+
+##############################################################################################################################################
+# Materialized latest user table
+##############################################################################################################################################
+
+def generate_user_table_merge(project_id, dataset_id, table_name, source_query, array_keys=None):
+    # Upsert the latest row per user from the new snapshots, keeping whichever row was active most recently. A stored
+    # row without a last active time is always replaced, no comparison with NULL would ever be true.
+    columns = user_table_columns(array_keys=array_keys)
+    update_sql = ",\n            ".join(f"{column} = S.{column}" for column in columns)
+    column_sql = ", ".join(columns)
+    return f"""
+    MERGE `{project_id}.{dataset_id}.{table_name}` T
+    USING ({source_query}) S
+    ON T.user_type = S.user_type AND T.user_id = S.user_id
+    WHEN MATCHED AND (T.user_last_active_timestamp IS NULL OR S.user_last_active_timestamp >= T.user_last_active_timestamp) THEN
+        UPDATE SET
+            {update_sql}
+    WHEN NOT MATCHED THEN
+        INSERT ({column_sql}) VALUES ({column_sql})
+    """
+
+def generate_user_eviction(project_id, dataset_id, table_name, start):
+    # Delete the users last active before the start suffix of a window
+    return f"""
+    DELETE FROM `{project_id}.{dataset_id}.{table_name}`
+    WHERE user_last_active_timestamp < DATETIME({generate_partition_date(start)})
+    """
+
+def create_user_table_materialized(client, project_id, dataset_id, user_table_pattern, utc_ts, date_window=None, table_name="user_table", array_keys=None, drop_outside_window=True):
+    # Latest state of every user, kept up to date by merging only the users_/pseudonymous_users_ snapshots
+    # that are new or restated instead of re-ranking every historical snapshot. Users last active before a
+    # date_window are deleted as the window moves past them, unless drop_outside_window is off.
+    from google.api_core.exceptions import NotFound
+
+    logging.info("Refreshing materialized user table...")
+    ensure_shard_state_table(client, project_id, dataset_id)
+
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    shards = match_shards(shard_metadata, user_table_pattern, date_window, utc_ts)
+    if not shards:
+        logging.info(f"No user shards match {user_table_pattern}")
+        return []
+
+    # New audiences are new columns, so like a new timezone they rebuild the table
+    config = utc_ts + "".join(f"|{alias}" for _, alias in get_table_array_columns(array_keys, "users"))
+    try:
+        client.get_table(f"{project_id}.{dataset_id}.{table_name}")
+        state = get_shard_state(client, project_id, dataset_id, table_name)
+    except NotFound:
+        state = {}
+
+    if not state or any(recorded["config"] != config for recorded in state.values()):
+        # First run, or the timezone changed every stored timestamp, so build from all snapshots at once
+        changed = sorted(shards)
+        source_query = generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, {"suffixes": changed}, array_keys=array_keys)
+        statement = f"""
+        CREATE OR REPLACE TABLE `{project_id}.{dataset_id}.{table_name}`
+        CLUSTER BY user_type, user_id
+        AS {source_query}
+        """
+        run_query(client, statement, name=table_name)
+        run_query(client, f"DELETE FROM `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}` WHERE target_table = '{table_name}'", name=f"{table_name} shard state")
+    else:
+        changed = get_changed_shards(shards, shard_metadata, state, config)
+        if changed:
+            source_query = generate_user_table_query(project_id, dataset_id, user_table_pattern, utc_ts, {"suffixes": changed}, array_keys=array_keys)
+            run_query(client, generate_user_table_merge(project_id, dataset_id, table_name, source_query, array_keys), name=table_name)
+    logging.info(f"Merged {len(changed)} of {len(shards)} user snapshot days into {table_name}: {changed}")
+
+    if changed:
+        state_updates = "".join(
+            generate_shard_state_update(project_id, dataset_id, table_name, suffix, shards[suffix], shard_metadata, config)
+            for suffix in changed
+        )
+        run_query(client, state_updates, name=f"{table_name} shard state")
+
+    start, _ = date_window_bounds(date_window, utc_ts)
+    if start and drop_outside_window:
+        run_query(client, generate_user_eviction(project_id, dataset_id, table_name, start), name=f"{table_name} eviction")
+
+    create_pass_through_view(client, project_id, dataset_id, "user_table_view", table_name)
+    return changed
+
+##############################################################################################################################################
+# Daily rollup tables
+##############################################################################################################################################
+
+# Small pre-aggregated tables for the dashboard tiles, one row per day and dimension combination, refreshed per day
+# like the materialized event table. Users and sessions are HyperLogLog sketches, so any range of days or subset
+# of dimensions can be re-aggregated with HLL_COUNT.MERGE(users_sketch) without counting anyone twice.
+# "source" is what one row is aggregated from: every event, or every item of every event.
+ROLLUP_TABLES = {
+    "daily_event_rollup": {
+        "source": "events",
+        "dimensions": [
+            ("traffic_source.source", "traffic_source"),
+            ("traffic_source.medium", "traffic_medium"),
+            ("device.category", "device_category"),
+            ("geo.country", "country"),
+            ("event_name", "event_name"),
+        ],
+        "metrics": [
+            ("COUNT(*)", "event_count"),
+            ("COUNTIF(event_name = 'first_visit')", "new_users"),
+            ("COUNTIF(event_name = 'purchase')", "purchases"),
+            ("SUM(ecommerce.purchase_revenue_in_usd)", "purchase_revenue_in_usd"),
+            ("HLL_COUNT.INIT(user_pseudo_id)", "users_sketch"),
+            ("HLL_COUNT.INIT(CONCAT(user_pseudo_id, '.', CAST(ga_session_id AS STRING)))", "sessions_sketch"),
+        ],
+        "cluster_by": ["event_name", "traffic_source", "traffic_medium"],
+    },
+    "daily_item_rollup": {
+        "source": "items",
+        "dimensions": [
+            ("event_name", "event_name"),
+            ("it.item_id", "item_id"),
+            ("it.item_name", "item_name"),
+            ("it.item_brand", "item_brand"),
+            ("it.item_category", "item_category"),
+            ("traffic_source.source", "traffic_source"),
+            ("traffic_source.medium", "traffic_medium"),
+        ],
+        "metrics": [
+            ("COUNT(*)", "item_events"),
+            ("SUM(it.quantity)", "quantity"),
+            ("SUM(it.item_revenue_in_usd)", "item_revenue_in_usd"),
+            ("HLL_COUNT.INIT(user_pseudo_id)", "users_sketch"),
+        ],
+        "cluster_by": ["event_name", "item_id"],
+    },
+}
+
+# Bump when a rollup definition changes, the tables are then recreated and every day rebuilt with the new one
+ROLLUP_VERSION = 1
+
+def rollup_columns(rollup):
+    return [alias for _, alias in rollup["dimensions"] + rollup["metrics"]]
+
+def generate_rollup_query(project_id, dataset_id, rollup, table_ids):
+    # One day of a rollup from its event shard(s). Grouped by position, since aliases like traffic_source
+    # are also the names of source columns.
+    sources = " UNION ALL ".join(
+        f"""
+            SELECT *, (SELECT ep.value.int_value FROM UNNEST(event_params) AS ep WHERE ep.key = 'ga_session_id') AS ga_session_id
+            FROM `{project_id}.{dataset_id}.{table_id}`"""
+        for table_id in table_ids
+    )
+    items_join = "CROSS JOIN UNNEST(events.items) AS it" if rollup["source"] == "items" else ""
+    dimension_sql = ",\n        ".join(f"{expression} AS {alias}" for expression, alias in rollup["dimensions"])
+    metric_sql = ",\n        ".join(f"{expression} AS {alias}" for expression, alias in rollup["metrics"])
+    return f"""
+    SELECT
+        {dimension_sql},
+        {metric_sql}
+    FROM ({sources}
+    ) AS events
+    {items_join}
+    GROUP BY {", ".join(str(position) for position in range(1, len(rollup["dimensions"]) + 1))}
+    """
+
+def ensure_rollup_table(client, project_id, dataset_id, table_name, rollup, seed_query, replace=False):
+    # replace recreates the table with the columns and clustering of the current definition
+    query = f"""
+    {"CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"} `{project_id}.{dataset_id}.{table_name}`
+    PARTITION BY event_partition_date
+    CLUSTER BY {", ".join(rollup["cluster_by"])}
+    AS
+    SELECT *, CAST(NULL AS DATE) AS event_partition_date FROM ({seed_query}) WHERE FALSE
+    """
+    run_query(client, query, name=table_name)
+
+def generate_rollup_view_query(project_id, dataset_id, table_name, rollup):
+    # Rollup rows with the sketches turned into counts, for charts that break down by the rollup's own dimensions.
+    # Totals over several rows (e.g. users in a month) must merge the sketches instead of adding these up.
+    sketches = [alias for _, alias in rollup["metrics"] if alias.endswith("_sketch")]
+    counts = ",\n        ".join(f"HLL_COUNT.EXTRACT({sketch}) AS {sketch[:-len('_sketch')]}" for sketch in sketches)
+    return f"""
+    SELECT
+        * EXCEPT ({", ".join(sketches)}),
+        {counts}
+    FROM `{project_id}.{dataset_id}.{table_name}`
+    """
+
+def generate_daily_totals_view_query(project_id, dataset_id):
+    # Site-wide totals per day, with users and sessions merged across every dimension so each is counted once
+    return f"""
+    SELECT
+        event_partition_date,
+        SUM(event_count) AS event_count,
+        SUM(new_users) AS new_users,
+        SUM(purchases) AS purchases,
+        SUM(purchase_revenue_in_usd) AS purchase_revenue_in_usd,
+        HLL_COUNT.MERGE(users_sketch) AS users,
+        HLL_COUNT.MERGE(sessions_sketch) AS sessions
+    FROM `{project_id}.{dataset_id}.daily_event_rollup`
+    GROUP BY event_partition_date
+    """
+
+def create_rollup_tables(client, project_id, dataset_id, event_table_patterns, utc_ts="UTC", date_window=None, include_items=True, drop_outside_window=True):
+    # Refresh every rollup for the days that are new or restated, then (re)point the views at them. Days outside
+    # date_window are dropped unless drop_outside_window is off. Returns {table_name: [suffixes merged]}.
+    from google.api_core.exceptions import NotFound
+
+    logging.info("Refreshing daily rollup tables...")
+    ensure_shard_state_table(client, project_id, dataset_id)
+    shard_metadata = get_shard_catalog(client, project_id, dataset_id)
+    shards = prefer_daily_shards(match_shards(shard_metadata, event_table_patterns, date_window, utc_ts))
+    config = f"rollup_v{ROLLUP_VERSION}"
+
+    merged = {}
+    for table_name, rollup in ROLLUP_TABLES.items():
+        if rollup["source"] == "items" and not include_items:
+            continue
+        try:
+            client.get_table(f"{project_id}.{dataset_id}.{table_name}")
+            state = get_shard_state(client, project_id, dataset_id, table_name)
+        except NotFound:
+            state = {}
+        # A table built by another version can have other columns, which no MERGE of this one could fill. It is
+        # recreated empty and everything recorded about it forgotten, days outside the window included, so the
+        # next run doesn't find the old version again.
+        if shards and any(entry["config"] != config for entry in state.values()):
+            logging.info(f"{table_name} was built by another rollup version, recreating it")
+            ensure_rollup_table(client, project_id, dataset_id, table_name, rollup, generate_rollup_query(project_id, dataset_id, rollup, shards[min(shards)]), replace=True)
+            run_query(client, f"DELETE FROM `{project_id}.{dataset_id}.{SHARD_STATE_TABLE}` WHERE target_table = '{table_name}'", name=f"{table_name} shard state")
+            state = {}
+        changed = get_changed_shards(shards, shard_metadata, state, config)
+        logging.info(f"{len(changed)} of {len(shards)} days of {table_name} are new or changed: {changed}")
+
+        for i, suffix in enumerate(changed):
+            shard_query = generate_rollup_query(project_id, dataset_id, rollup, shards[suffix])
+            if i == 0:
+                ensure_rollup_table(client, project_id, dataset_id, table_name, rollup, shard_query)
+            script = f"""
+            BEGIN TRANSACTION;
+            {generate_event_partition_merge(project_id, dataset_id, table_name, shard_query, suffix, rollup_columns(rollup))};
+            {generate_shard_state_update(project_id, dataset_id, table_name, suffix, shards[suffix], shard_metadata, config)}
+            COMMIT TRANSACTION;
+            """
+            run_query(client, script, name=f"{table_name} {suffix}")
+        merged[table_name] = changed
 
-def create_event_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts):
-    event_table_query = generate_event_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts)
-    create_or_replace_view(client, project_id, dataset_id, "event_table_view", event_table_query)
+        # Days a windowed rollup no longer covers, like the materialized event table
+        dropped = sorted(suffix for suffix in state if suffix not in shards) if date_window and drop_outside_window else []
+        if dropped:
+            logging.info(f"Dropping {len(dropped)} days of {table_name} outside the window: {dropped}")
+            run_query(client, generate_partition_drop(project_id, dataset_id, table_name, dropped), name=f"{table_name} dropped partitions")
 
-def create_item_table_view(client, project_id, dataset_id, event_table_patterns, userid_sub, keys_and_types, utc_ts):
-    item_table_query = generate_item_table_query(keys_and_types, project_id, dataset_id, event_table_patterns, userid_sub, utc_ts)
-    logging.info(item_table_query)
-    create_or_replace_view(client, project_id, dataset_id, "item_table_view", item_table_query)
\ No newline at end of file
+        # Without any shards in the window there is no table to put a view on
+        if changed or state:
+            create_or_replace_view(client, project_id, dataset_id, f"{table_name}_view", generate_rollup_view_query(project_id, dataset_id, table_name, rollup))
+            if table_name == "daily_event_rollup":
+                create_or_replace_view(client, project_id, dataset_id, "daily_totals_view", generate_daily_totals_view_query(project_id, dataset_id))
+    return merged
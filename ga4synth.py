@@ -0,0 +1,321 @@
+import argparse
+import logging
+import os
+
+from datetime import date, datetime, timedelta
+
+# Writes a synthetic GA4 BigQuery export as one Parquet file per shard, named like the BigQuery tables:
+#
+#   events_20261016.parquet, events_intraday_20261018.parquet, users_20261016.parquet, pseudonymous_users_20261016.parquet
+#
+# The columns and nesting follow the GA4 export schema closely enough for every query in ga4queries to run against it
+# with ga4local. All values are derived from hashes of the row number and the seed, so the same arguments always
+# write the same data. duckdb is only needed here and in ga4local, it is imported when data is generated.
+
+# Standard params every event carries on top of the custom keys, as (key, string_value, int_value) SQL over the event row
+STANDARD_EVENT_PARAMS = [
+    ("ga_session_id", "NULL::VARCHAR", "session_id"),
+    ("ga_session_number", "NULL::VARCHAR", "(1 + hash(u) % 20)::BIGINT"),
+    ("page_location", "page_location", "NULL::BIGINT"),
+    ("page_title", "page_title", "NULL::BIGINT"),
+    ("engagement_time_msec", "NULL::VARCHAR", "(hash(g) % 60000)::BIGINT"),
+]
+
+EVENT_NAMES = ["page_view", "page_view", "page_view", "user_engagement", "scroll", "session_start", "first_visit", "click", "form_submit"]
+ECOMMERCE_EVENT_NAMES = ["view_item", "view_item", "add_to_cart", "begin_checkout", "purchase"]
+
+def custom_param_key(index):
+    # Every seventh key has dashes, like the hand-named params real properties end up with
+    if index % 7 == 6:
+        return f"custom-param-{index}"
+    return f"custom_param_{index}"
+
+def sql_list(values):
+    return "[" + ", ".join(f"'{value}'" for value in values) + "]"
+
+def shard_days(days, end_date, intraday_days, overlap_days):
+    # [(suffix, has_daily, has_intraday)] oldest first. The last intraday_days days only have intraday shards,
+    # like an export that hasn't finalised them yet. overlap_days older days keep their intraday shard next to
+    # the daily one, like GA4 does for a while after finalising a day.
+    shards = []
+    for offset in range(days - 1, -1, -1):
+        suffix = (end_date - timedelta(days=offset)).strftime('%Y%m%d')
+        has_daily = offset >= intraday_days
+        has_intraday = not has_daily or offset < intraday_days + overlap_days
+        shards.append((suffix, has_daily, has_intraday))
+    return shards
+
+def generate_event_shard_query(suffix, day_index, events_per_day, users, param_keys, params_per_event, ecommerce_ratio, known_user_ratio, seed):
+    day_start_micros = int(datetime.strptime(suffix, '%Y%m%d').timestamp() * 1_000_000)
+    known_users = int(users * known_user_ratio)
+    params_per_event = min(params_per_event, param_keys)
+
+    # hash() is deterministic in duckdb, rnd gives a stable number in [0, 1) per row and purpose
+    rnd = lambda value, salt: f"((hash({value}, '{salt}', {seed}) % 1000003) / 1000003.0)"
+    pick = lambda options, value, salt: f"{sql_list(options)}[1 + (hash({value}, '{salt}', {seed}) % {len(options)})::INTEGER]"
+
+    custom_keys = sql_list(custom_param_key(index) for index in range(param_keys))
+    standard_params = ",\n                ".join(
+        f"{{'key': '{key}', 'value': {{'string_value': {string_value}, 'int_value': {int_value}, 'float_value': NULL::DOUBLE, 'double_value': NULL::DOUBLE}}}}"
+        for key, string_value, int_value in STANDARD_EVENT_PARAMS
+    )
+
+    # Custom keys are consecutive from a skewed start, so low numbered keys are common and high ones a long tail
+    custom_params = f"""list_transform(range({params_per_event}), k -> {{
+                'key': {custom_keys}[1 + ((key_start + k) % {param_keys})::INTEGER],
+                'value': {{
+                    'string_value': CASE WHEN (key_start + k) % {param_keys} % 3 = 0 THEN 'value_' || (hash(g, k) % 50) END,
+                    'int_value': CASE WHEN (key_start + k) % {param_keys} % 3 = 1 THEN (hash(g, k) % 1000)::BIGINT END,
+                    'float_value': CASE WHEN (key_start + k) % {param_keys} % 3 = 2 THEN (hash(g, k) % 100000) / 100.0 END,
+                    'double_value': NULL::DOUBLE
+                }}
+            }})""" if param_keys else "[]"
+
+    item_struct = f"""{{
+                'item_id': 'SKU_' || product,
+                'item_name': 'Product ' || product,
+                'item_brand': {pick(["Acme", "Globex", "Initech", "Umbrella"], "product", "brand")},
+                'item_variant': {pick(["red", "blue", "green", "(not set)"], "product", "variant")},
+                'item_category': {pick(["Apparel", "Home", "Electronics", "Toys"], "product", "category")},
+                'item_category2': {pick(["Sale", "New", "(not set)"], "product", "category2")},
+                'item_category3': NULL::VARCHAR,
+                'item_category4': NULL::VARCHAR,
+                'item_category5': NULL::VARCHAR,
+                'price_in_usd': (5 + hash(product) % 200)::DOUBLE,
+                'price': (5 + hash(product) % 200)::DOUBLE,
+                'quantity': (1 + hash(g, k, 'quantity') % 3)::BIGINT,
+                'item_revenue_in_usd': CASE WHEN event_name = 'purchase' THEN ((5 + hash(product) % 200) * (1 + hash(g, k, 'quantity') % 3))::DOUBLE END,
+                'item_revenue': CASE WHEN event_name = 'purchase' THEN ((5 + hash(product) % 200) * (1 + hash(g, k, 'quantity') % 3))::DOUBLE END,
+                'item_refund_in_usd': NULL::DOUBLE,
+                'item_refund': NULL::DOUBLE,
+                'coupon': CASE WHEN hash(g, 'coupon') % 10 = 0 THEN 'SUMMER' END,
+                'affiliation': 'Online Store',
+                'location_id': NULL::VARCHAR,
+                'item_list_id': 'list_' || (hash(g, 'list') % 5),
+                'item_list_name': 'List ' || (hash(g, 'list') % 5),
+                'item_list_index': (k + 1)::VARCHAR,
+                'promotion_id': NULL::VARCHAR,
+                'promotion_name': NULL::VARCHAR,
+                'creative_name': NULL::VARCHAR,
+                'creative_slot': NULL::VARCHAR,
+                'item_params': [{{'key': 'size', 'value': {{'string_value': {pick(["S", "M", "L"], "product", "size")}, 'int_value': NULL::BIGINT, 'float_value': NULL::DOUBLE, 'double_value': NULL::DOUBLE}}}}]
+            }}"""
+
+    return f"""
+    WITH base AS (
+        SELECT
+            {day_index} * {events_per_day} + i AS g,
+            (hash(i, 'user', {day_index}, {seed}) % {users})::BIGINT AS u,
+            {rnd("i", f"ecommerce{day_index}")} < {ecommerce_ratio} AS is_ecommerce
+        FROM range({events_per_day}) AS t(i)
+    ),
+    named AS (
+        SELECT
+            *,
+            CASE WHEN is_ecommerce THEN {pick(ECOMMERCE_EVENT_NAMES, "g", "ecommerce_name")} ELSE {pick(EVENT_NAMES, "g", "name")} END AS event_name,
+            {day_start_micros} + (hash(g, 'time', {seed}) % 86400000000)::BIGINT AS event_timestamp,
+            (({day_start_micros} // 1000000) + hash(u, {day_index}) % 1000)::BIGINT AS session_id,
+            'https://shop.example.com/' || {pick(["", "products", "cart", "checkout", "blog", "about"], "g", "page")} AS page_location,
+            {pick(["Home", "Products", "Cart", "Checkout", "Blog", "About"], "g", "page")} AS page_title,
+            floor({param_keys} * pow({rnd("g", "key_start")}, 2))::BIGINT AS key_start,
+            (1 + hash(g, 'item_count') % 4)::BIGINT AS item_count
+        FROM base
+    )
+    SELECT
+        '{suffix}' AS event_date,
+        event_timestamp,
+        event_name,
+        [
+                {standard_params}
+        ] || {custom_params} AS event_params,
+        NULL::BIGINT AS event_previous_timestamp,
+        CASE WHEN event_name = 'purchase' THEN (hash(g, 'value') % 50000) / 100.0 END AS event_value_in_usd,
+        (hash(g, 'bundle') % 1000000)::BIGINT AS event_bundle_sequence_id,
+        NULL::BIGINT AS event_server_timestamp_offset,
+        CASE WHEN u < {known_users} THEN 'user_' || u END AS user_id,
+        u || '.1700000000' AS user_pseudo_id,
+        {{'analytics_storage': 'Yes', 'ads_storage': {pick(["Yes", "No"], "u", "ads")}, 'uses_transient_token': 'No'}} AS privacy_info,
+        [
+            {{'key': 'membership_tier', 'value': {{'string_value': {pick(["free", "silver", "gold"], "u", "tier")}, 'int_value': NULL::BIGINT, 'float_value': NULL::DOUBLE, 'double_value': NULL::DOUBLE, 'set_timestamp_micros': {day_start_micros}::BIGINT}}}},
+            {{'key': 'signup_year', 'value': {{'string_value': NULL::VARCHAR, 'int_value': (2018 + hash(u) % 8)::BIGINT, 'float_value': NULL::DOUBLE, 'double_value': NULL::DOUBLE, 'set_timestamp_micros': {day_start_micros}::BIGINT}}}}
+        ] AS user_properties,
+        ({day_start_micros} - (hash(u, 'first_touch') % 31536000000000))::BIGINT AS user_first_touch_timestamp,
+        {{'revenue': (hash(u, 'ltv') % 100000) / 100.0, 'currency': 'USD'}} AS user_ltv,
+        {{
+            'category': {pick(["desktop", "mobile", "mobile", "tablet"], "u", "category")},
+            'mobile_brand_name': {pick(["Apple", "Samsung", "Google", "(not set)"], "u", "brand")},
+            'mobile_model_name': {pick(["iPhone", "Galaxy S24", "Pixel 9", "(not set)"], "u", "brand")},
+            'mobile_marketing_name': NULL::VARCHAR,
+            'mobile_os_hardware_model': NULL::VARCHAR,
+            'operating_system': {pick(["iOS", "Android", "Windows", "Macintosh", "Linux"], "u", "os")},
+            'operating_system_version': {pick(["iOS 18.1", "Android 15", "Windows 11", "Macintosh 14"], "u", "os")},
+            'vendor_id': NULL::VARCHAR,
+            'advertising_id': NULL::VARCHAR,
+            'language': {pick(["en-us", "en-gb", "de-de", "fr-fr", "ja-jp"], "u", "language")},
+            'is_limited_ad_tracking': 'No',
+            'time_zone_offset_seconds': NULL::BIGINT,
+            'browser': NULL::VARCHAR,
+            'browser_version': NULL::VARCHAR,
+            'web_info': {{
+                'browser': {pick(["Chrome", "Safari", "Firefox", "Edge"], "u", "browser")},
+                'browser_version': {pick(["130.0", "18.1", "131.0"], "u", "browser")},
+                'hostname': 'shop.example.com'
+            }}
+        }} AS device,
+        {{
+            'city': {pick(["Auckland", "London", "New York", "Berlin", "Tokyo", "Sydney"], "u", "geo")},
+            'country': {pick(["New Zealand", "United Kingdom", "United States", "Germany", "Japan", "Australia"], "u", "geo")},
+            'continent': {pick(["Oceania", "Europe", "Americas", "Europe", "Asia", "Oceania"], "u", "geo")},
+            'region': {pick(["Auckland", "England", "New York", "Berlin", "Tokyo", "New South Wales"], "u", "geo")},
+            'sub_continent': {pick(["Australasia", "Northern Europe", "Northern America", "Western Europe", "Eastern Asia", "Australasia"], "u", "geo")},
+            'metro': '(not set)'
+        }} AS geo,
+        NULL::STRUCT(id VARCHAR, version VARCHAR, install_store VARCHAR, firebase_app_id VARCHAR, install_source VARCHAR) AS app_info,
+        {{
+            'name': {pick(["(direct)", "(organic)", "spring_sale", "(referral)"], "u", "source")},
+            'medium': {pick(["(none)", "organic", "cpc", "referral"], "u", "source")},
+            'source': {pick(["(direct)", "google", "google", "news.example.com"], "u", "source")}
+        }} AS traffic_source,
+        '1234567890' AS stream_id,
+        'WEB' AS platform,
+        (g // 20)::BIGINT AS batch_page_id,
+        (g % 20)::BIGINT AS batch_event_index,
+        1::BIGINT AS batch_ordering_id,
+        CASE WHEN is_ecommerce THEN {{
+            'total_item_quantity': item_count::BIGINT,
+            'purchase_revenue_in_usd': CASE WHEN event_name = 'purchase' THEN (hash(g, 'value') % 50000) / 100.0 END,
+            'purchase_revenue': CASE WHEN event_name = 'purchase' THEN (hash(g, 'value') % 50000) / 100.0 END,
+            'refund_value_in_usd': NULL::DOUBLE,
+            'refund_value': NULL::DOUBLE,
+            'shipping_value_in_usd': CASE WHEN event_name = 'purchase' THEN 5.0 END,
+            'shipping_value': CASE WHEN event_name = 'purchase' THEN 5.0 END,
+            'tax_value_in_usd': NULL::DOUBLE,
+            'tax_value': NULL::DOUBLE,
+            'unique_items': item_count::BIGINT,
+            'transaction_id': CASE WHEN event_name = 'purchase' THEN 'T' || g END
+        }} END AS ecommerce,
+        CASE WHEN is_ecommerce THEN list_transform(range(item_count), k -> {item_struct.replace("product", "(hash(g, k, 'product') % 500)")}) ELSE [] END AS items
+    FROM named
+    """
+
+def generate_user_shard_query(suffix, day_index, users, known_user_ratio, active_user_ratio, known, seed):
+    # One day's users_ (known) or pseudonymous_users_ snapshot: every user active that day
+    day_start_micros = int(datetime.strptime(suffix, '%Y%m%d').timestamp() * 1_000_000)
+    known_users = int(users * known_user_ratio)
+    pick = lambda options, value, salt: f"{sql_list(options)}[1 + (hash({value}, '{salt}', {seed}) % {len(options)})::INTEGER]"
+    id_column = "'user_' || u AS user_id" if known else "u || '.1700000000' AS pseudo_user_id"
+    population = known_users if known else users
+
+    return f"""
+    SELECT
+        {id_column},
+        '1234567890' AS stream_id,
+        {{
+            'last_active_timestamp_micros': ({day_start_micros} + hash(u, 'active', {day_index}) % 86400000000)::BIGINT,
+            'user_first_touch_timestamp_micros': ({day_start_micros} - (hash(u, 'first_touch') % 31536000000000))::BIGINT,
+            'first_purchase_date': CASE WHEN hash(u, 'purchaser') % 5 = 0 THEN '{suffix}' END
+        }} AS user_info,
+        {{'is_limited_ad_tracking': 'No', 'is_ads_personalization_allowed': {pick(["Yes", "No"], "u", "ads")}}} AS privacy_info,
+        [
+            {{'key': 'membership_tier', 'value': {{'string_value': {pick(["free", "silver", "gold"], "u", "tier")}, 'set_timestamp_micros': {day_start_micros}::BIGINT, 'user_property_name': 'membership_tier'}}}}
+        ] AS user_properties,
+        list_transform(range((hash(u, 'audiences') % 3)::BIGINT), k -> {{
+            'id': (k + 1)::BIGINT,
+            'name': ['All Users', 'Purchasers', 'Engaged'][1 + k::INTEGER],
+            'membership_start_timestamp_micros': ({day_start_micros} - 86400000000 * (1 + hash(u, k) % 30))::BIGINT,
+            'membership_expiry_timestamp_micros': ({day_start_micros} + 86400000000 * 30)::BIGINT,
+            'npa': false
+        }}) AS audiences,
+        {{
+            'operating_system': {pick(["iOS", "Android", "Windows", "Macintosh", "Linux"], "u", "os")},
+            'category': {pick(["desktop", "mobile", "mobile", "tablet"], "u", "category")},
+            'mobile_brand_name': {pick(["Apple", "Samsung", "Google", "(not set)"], "u", "brand")},
+            'mobile_model_name': {pick(["iPhone", "Galaxy S24", "Pixel 9", "(not set)"], "u", "brand")},
+            'unified_screen_name': NULL::VARCHAR
+        }} AS device,
+        {{
+            'city': {pick(["Auckland", "London", "New York", "Berlin", "Tokyo", "Sydney"], "u", "geo")},
+            'country': {pick(["New Zealand", "United Kingdom", "United States", "Germany", "Japan", "Australia"], "u", "geo")},
+            'continent': {pick(["Oceania", "Europe", "Americas", "Europe", "Asia", "Oceania"], "u", "geo")},
+            'region': {pick(["Auckland", "England", "New York", "Berlin", "Tokyo", "New South Wales"], "u", "geo")}
+        }} AS geo,
+        {{
+            'revenue_in_usd': (hash(u, 'ltv') % 100000) / 100.0,
+            'sessions': (1 + hash(u) % 20)::BIGINT,
+            'engagement_time_millis': (hash(u, 'engagement') % 3600000)::BIGINT,
+            'purchases': (hash(u, 'purchases') % 5)::BIGINT,
+            'engaged_sessions': (hash(u) % 10)::BIGINT,
+            'session_duration_micros': (hash(u, 'duration') % 3600000000)::BIGINT
+        }} AS user_ltv,
+        {{
+            'in_app_purchase_score_7d': NULL::DOUBLE,
+            'purchase_score_7d': (hash(u, 'purchase_score') % 1000) / 1000.0,
+            'churn_score_7d': (hash(u, 'churn_score') % 1000) / 1000.0,
+            'revenue_28d_in_usd': (hash(u, 'revenue_28d') % 10000) / 100.0
+        }} AS predictions,
+        '{suffix}' AS occurrence_date,
+        '{suffix}' AS last_updated_date
+    FROM range({population}) AS t(u)
+    WHERE (hash(u, 'active_day', {day_index}, {seed}) % 1000) < {int(active_user_ratio * 1000)}
+    """
+
+def generate_export(output_dir, days=3, events_per_day=10000, users=1000, param_keys=50, params_per_event=8, ecommerce_ratio=0.1,
+                    known_user_ratio=0.2, active_user_ratio=0.3, intraday_days=1, overlap_days=0, end_date=None, seed=0, threads=None):
+    # Writes the shards and returns their table ids. end_date defaults to today, so yesterday has a daily shard
+    # and today an intraday one, which is what the pipeline's dataset check expects.
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("Generating synthetic exports needs duckdb, pip install -r requirements-local.txt")
+
+    os.makedirs(output_dir, exist_ok=True)
+    end_date = end_date or date.today()
+    con = duckdb.connect()
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+
+    table_ids = []
+    def write(table_id, query):
+        path = os.path.join(output_dir, f"{table_id}.parquet")
+        con.execute(f"COPY ({query}) TO '{path}' (FORMAT PARQUET)")
+        table_ids.append(table_id)
+        logging.info(f"Wrote synthetic shard {path}")
+
+    for day_index, (suffix, has_daily, has_intraday) in enumerate(shard_days(days, end_date, intraday_days, overlap_days)):
+        event_query = generate_event_shard_query(suffix, day_index, events_per_day, users, param_keys, params_per_event, ecommerce_ratio, known_user_ratio, seed)
+        if has_daily:
+            write(f"events_{suffix}", event_query)
+            write(f"pseudonymous_users_{suffix}", generate_user_shard_query(suffix, day_index, users, known_user_ratio, active_user_ratio, False, seed))
+            if known_user_ratio:
+                write(f"users_{suffix}", generate_user_shard_query(suffix, day_index, users, known_user_ratio, active_user_ratio, True, seed))
+        if has_intraday:
+            # Same events as the daily shard of that day, as GA4 streams them before finalising the day
+            write(f"events_intraday_{suffix}", event_query)
+    con.close()
+    return table_ids
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic GA4 BigQuery export as Parquet shards")
+    parser.add_argument("output_dir")
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--events-per-day", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--param-keys", type=int, default=50, help="custom event_params keys on top of the standard ones")
+    parser.add_argument("--params-per-event", type=int, default=8, help="custom keys set on each event")
+    parser.add_argument("--ecommerce-ratio", type=float, default=0.1, help="share of events with items")
+    parser.add_argument("--known-user-ratio", type=float, default=0.2, help="share of users with a user_id, 0 for no users_ tables")
+    parser.add_argument("--intraday-days", type=int, default=1, help="most recent days that only have an intraday shard")
+    parser.add_argument("--overlap-days", type=int, default=0, help="finalised days that still have their intraday shard")
+    parser.add_argument("--end-date", type=lambda value: datetime.strptime(value, '%Y%m%d').date(), help="last shard date, YYYYMMDD, today by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s - %(levelname)s - %(message)s', force=True)
+    table_ids = generate_export(
+        args.output_dir, args.days, args.events_per_day, args.users, args.param_keys, args.params_per_event, args.ecommerce_ratio,
+        args.known_user_ratio, intraday_days=args.intraday_days, overlap_days=args.overlap_days, end_date=args.end_date, seed=args.seed,
+    )
+    print(f"Wrote {len(table_ids)} shards to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# BigQuery job statistics for every query the pipeline runs.
+#
+# Queries go through run_query, which waits for the job and records what it cost: bytes processed and billed,
+# slot time, cache hits, shuffle bytes and the slowest stages of the query plan. Each record is appended as a JSON
+# line to GA4TOBQ_JOB_LOG (job_stats.jsonl by default, empty to turn it off) so cost and latency can be tracked
+# across runs, and to the records list of the run in progress for its report. Records are tagged with the pipeline
+# step running on the current thread, see recording. A run with a byte budget caps every job at its estimate and
+# only starts it while that fits in what is left, see reserve_bytes.
+
+JOB_LOG_ENV = "GA4TOBQ_JOB_LOG"
+DEFAULT_JOB_LOG = "job_stats.jsonl"
+
+# Query plan stages kept per job, by duration
+SLOWEST_STAGES = 3
+
+# A job's cap over its dry-run estimate, BigQuery bills at least 10 MB for every table a query reads
+BUDGET_MARGIN = 0.1
+MIN_BILLED_BYTES = 10 * 1024**2
+
+# The share of the byte budget a job that can't be dry run, like some scripts, is capped at
+UNESTIMATED_BUDGET_SHARE = 0.25
+
+_context = threading.local()
+_job_log_lock = threading.Lock()
+
+class BudgetExceededError(Exception):
+    # A job would bill more than is left of the run's byte budget
+    pass
+
+def byte_budget(limit_bytes):
+    # The byte budget of one run, shared by all of its jobs: what they have billed and what running ones may still bill
+    return {"limit": limit_bytes, "billed": 0, "reserved": 0, "condition": threading.Condition()}
+
+@contextmanager
+def recording(records, step=None, target=None, budget=None):
+    # Job records made on this thread inside the block are appended to records and tagged with step and target.
+    # Their jobs are charged to budget, from byte_budget.
+    previous = getattr(_context, "state", None)
+    _context.state = {"records": records, "step": step, "target": target, "budget": budget}
+    try:
+        yield records
+    finally:
+        _context.state = previous
+
+def tracked(step, fn, records, target=None, budget=None):
+    # A ga4jobs job function that records its queries under step
+    def run(results):
+        with recording(records, step, target, budget):
+            return fn(results)
+    return run
+
+def get_stage_stats(query_job, limit=SLOWEST_STAGES):
+    # The longest running query plan stages, with their slot time and shuffle output
+    stages = []
+    for entry in query_job.query_plan or []:
+        duration_ms = (entry.end - entry.start).total_seconds() * 1000 if entry.start and entry.end else None
+        stages.append({
+            "name": entry.name,
+            "duration_ms": duration_ms,
+            "slot_ms": entry.slot_ms,
+            "records_read": entry.records_read,
+            "records_written": entry.records_written,
+            "shuffle_output_bytes": entry.shuffle_output_bytes,
+            "shuffle_output_bytes_spilled": entry.shuffle_output_bytes_spilled,
+        })
+    return sorted(stages, key=lambda stage: stage["duration_ms"] or 0, reverse=True)[:limit]
+
+def get_job_stats(query_job):
+    plan = query_job.query_plan or []
+    return {
+        "job_id": query_job.job_id,
+        "location": query_job.location,
+        "statement_type": query_job.statement_type,
+        "bytes_processed": query_job.total_bytes_processed,
+        "bytes_billed": query_job.total_bytes_billed,
+        "slot_ms": query_job.slot_millis,
+        "cache_hit": query_job.cache_hit,
+        "shuffle_bytes": sum(entry.shuffle_output_bytes or 0 for entry in plan) if plan else None,
+        "job_seconds": (query_job.ended - query_job.started).total_seconds() if query_job.started and query_job.ended else None,
+        "slowest_stages": get_stage_stats(query_job),
+    }
+
+def record_job(kind, name, elapsed_seconds, stats=None, error=None):
+    state = getattr(_context, "state", None) or {}
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "target": state.get("target"),
+        "step": state.get("step"),
+        "kind": kind,
+        "name": name,
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "error": error,
+    }
+    record.update(stats or {})
+    if state.get("records") is not None:
+        state["records"].append(record)
+
+    job_log = os.environ.get(JOB_LOG_ENV, DEFAULT_JOB_LOG)
+    if job_log:
+        with _job_log_lock, open(job_log, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    logging.info(
+        f"{kind} {name} took {elapsed_seconds:.1f}s"
+        + (f", {format_bytes(record.get('bytes_billed') or 0)} billed, {record.get('slot_ms') or 0} slot ms" if "bytes_billed" in record else "")
+        + (", cached" if record.get("cache_hit") else "")
+        + (", unchanged so skipped" if record.get("skipped") else "")
+    )
+    return record
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024 or unit == "TB":
+            return f"{num_bytes:,.1f} {unit}"
+        num_bytes /= 1024
+
+def reserve_bytes(budget, client, query, job_config=None, name=None):
+    # (job_config, reserved): a copy of job_config with maximum_bytes_billed set to the query's dry-run estimate plus
+    # a margin, which is held back from the budget until the job is done so jobs running side by side can't bill
+    # more than the budget together. A query that can't be dry run is capped at UNESTIMATED_BUDGET_SHARE of the
+    # budget. A job waits while other jobs hold what it needs, and only fails if what they have already billed
+    # leaves too little for it.
+    from google.cloud import bigquery
+
+    dry_run_config = copy.deepcopy(job_config) if job_config else bigquery.QueryJobConfig()
+    dry_run_config.dry_run = True
+    dry_run_config.use_query_cache = False
+    try:
+        estimate = client.query(query, job_config=dry_run_config).total_bytes_processed or 0
+        cap = int(estimate * (1 + BUDGET_MARGIN)) + MIN_BILLED_BYTES
+    except Exception as e:
+        logging.debug(f"Could not dry run {name}: {e}")
+        cap = None
+    with budget["condition"]:
+        while True:
+            billable = budget["limit"] - budget["billed"]
+            job_cap = min(int(budget["limit"] * UNESTIMATED_BUDGET_SHARE), billable) if cap is None else cap
+            if job_cap > billable or billable <= 0:
+                raise BudgetExceededError(f"{name or 'A query'} could bill {format_bytes(job_cap)}, only {format_bytes(max(billable, 0))} of the byte budget is left")
+            if job_cap <= billable - budget["reserved"]:
+                break
+            logging.info(f"{name or 'A query'} is waiting for other jobs to finish, they hold {format_bytes(budget['reserved'])} of the byte budget")
+            budget["condition"].wait()
+        budget["reserved"] += job_cap
+    job_config = copy.deepcopy(job_config) if job_config else bigquery.QueryJobConfig()
+    job_config.maximum_bytes_billed = job_cap
+    return job_config, job_cap
+
+def release_bytes(budget, reserved, billed):
+    with budget["condition"]:
+        budget["reserved"] -= reserved
+        budget["billed"] += billed
+        budget["condition"].notify_all()
+
+def run_query_job(client, query, job_config=None, name=None):
+    # Runs query to completion with its statistics recorded, returns the finished job
+    logging.debug(query)
+    budget = (getattr(_context, "state", None) or {}).get("budget")
+    reserved = 0
+    if budget:
+        job_config, reserved = reserve_bytes(budget, client, query, job_config, name)
+    started = time.monotonic()
+    query_job = None
+    try:
+        query_job = client.query(query, job_config=job_config)
+        name = name or query_job.job_id
+        try:
+            query_job.result()
+        except Exception as e:
+            record_job("query", name, time.monotonic() - started, get_job_stats(query_job), str(e))
+            raise
+        record_job("query", name, time.monotonic() - started, get_job_stats(query_job))
+        return query_job
+    finally:
+        if budget:
+            release_bytes(budget, reserved, (query_job.total_bytes_billed or 0) if query_job else 0)
+
+def run_query(client, query, job_config=None, name=None):
+    # client.query(query).result(), with the job's statistics recorded
+    return run_query_job(client, query, job_config, name).result()
+
+def summarize_job_records(records):
+    # Totals per step for the run report, in the order steps first ran a job
+    steps = {}
+    for record in records:
+        step = steps.setdefault(record["step"] or "Planning", {"jobs": 0, "cached": 0, "skipped": 0, "elapsed_seconds": 0.0, "bytes_processed": 0, "bytes_billed": 0, "slot_ms": 0, "shuffle_bytes": 0})
+        step["jobs"] += 1
+        step["cached"] += 1 if record.get("cache_hit") else 0
+        step["skipped"] += 1 if record.get("skipped") else 0
+        step["elapsed_seconds"] = round(step["elapsed_seconds"] + record["elapsed_seconds"], 3)
+        for field in ("bytes_processed", "bytes_billed", "slot_ms", "shuffle_bytes"):
+            step[field] += record.get(field) or 0
+    return steps
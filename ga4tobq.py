@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Command line entry point, runs the same pipeline as the Streamlit app without a browser.
+#
+#   python ga4tobq.py run my-project.analytics_123456 other-project.analytics_654321 --days 30 --report report.json
+#   python ga4tobq.py watch my-project.analytics_123456 --days 30 --interval 300 --health-port 8080
+#   python ga4tobq.py flatten export_dump/ flattened/ --days 30
+#   python ga4tobq.py export my-project.analytics_123456 event_table_view_mini item_table_view_mini --output-dir out/
+#
+# Credentials come from GOOGLE_APPLICATION_CREDENTIALS or --credentials. The BigQuery client and the
+# pipeline modules are only imported once a command runs, so --help and argument errors are instant.
+
+def parse_target(target):
+    project_id, _, dataset_id = target.strip().partition(".")
+    if not project_id or not dataset_id:
+        raise argparse.ArgumentTypeError(f"Expected project.dataset, got {target!r}")
+    return project_id, dataset_id
+
+def read_targets(args):
+    targets = list(args.targets)
+    if args.targets_file:
+        with open(args.targets_file) as f:
+            targets += [parse_target(line) for line in f if line.strip() and not line.startswith("#")]
+    if not targets:
+        raise SystemExit("No targets given, pass project.dataset arguments or --targets-file")
+    return targets
+
+def get_date_window(args):
+    if args.days:
+        return {"days": args.days}
+    if args.start or args.end:
+        if not (args.start and args.end):
+            raise SystemExit("--start and --end must be given together")
+        return {"start": args.start, "end": args.end}
+    return None
+
+def make_credentials(credentials):
+    # The service account key's credentials, None for the application default credentials
+    if not credentials:
+        return None
+    from google.oauth2 import service_account
+
+    return service_account.Credentials.from_service_account_file(credentials, scopes=["https://www.googleapis.com/auth/cloud-platform"])
+
+def make_client(project_id, credentials):
+    from google.cloud import bigquery
+
+    return bigquery.Client(project=project_id, credentials=make_credentials(credentials))
+
+def get_pipeline_options(args):
+    # What to build, shared by run and watch
+    return {
+        "date_window": get_date_window(args),
+        "event_mode": args.event_mode,
+        "pivot_strategy": args.pivot,
+        "sample_percent": args.sample_percent,
+        "user_mode": args.user_mode,
+        "min_key_occurrences": args.min_key_occurrences,
+        "max_keys": args.max_keys,
+        "rollups": args.rollups,
+        "column_profiles": args.column_profiles,
+        "pivot_arrays": args.pivot_arrays,
+        "event_name_views": args.event_name_views,
+    }
+
+def set_environment(args):
+    if args.cache_dir:
+        os.environ["GA4TOBQ_CACHE_DIR"] = args.cache_dir
+    if args.job_log is not None:
+        os.environ["GA4TOBQ_JOB_LOG"] = args.job_log
+
+def run_target(args, project_id, dataset_id):
+    from ga4pipeline import run_pipeline
+
+    logging.info(f"Starting {project_id}.{dataset_id}")
+    try:
+        client = make_client(project_id, args.credentials)
+    except Exception as e:
+        logging.error(f"Could not create a BigQuery client for {project_id}: {e}")
+        return {"target": f"{project_id}.{dataset_id}", "status": "failed", "error": str(e)}
+    report = run_pipeline(
+        client, project_id, dataset_id,
+        utc_ts=args.timezone,
+        budget_bytes=int(args.budget_gb * 1024**3) if args.budget_gb else None,
+        max_workers=args.jobs_per_target,
+        **get_pipeline_options(args),
+    )
+    logging.info(f"Finished {project_id}.{dataset_id}: {report['status']}")
+    return report
+
+def command_run(args):
+    targets = read_targets(args)
+    set_environment(args)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        reports = list(executor.map(lambda target: run_target(args, *target), targets))
+
+    output = json.dumps({"targets": reports}, indent=2, default=str)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = [report["target"] for report in reports if report["status"] != "ok"]
+    for target in failed:
+        print(f"FAILED {target}", file=sys.stderr)
+    return 1 if failed else 0
+
+def command_watch(args):
+    import signal
+    import threading
+
+    from ga4watch import watch
+
+    targets = read_targets(args)
+    set_environment(args)
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    watch(
+        [(make_client(project_id, args.credentials), project_id, dataset_id) for project_id, dataset_id in targets],
+        stop,
+        health_port=args.health_port,
+        interval=args.interval,
+        max_backoff=args.max_backoff,
+        lock_dir=args.lock_dir,
+        utc_ts=args.timezone,
+        max_workers=args.jobs_per_target,
+        options=get_pipeline_options(args),
+    )
+    return 0
+
+def command_flatten(args):
+    from ga4local import flatten_export
+
+    written = flatten_export(
+        args.shard_dir, args.output_dir,
+        utc_ts=args.timezone,
+        date_window=get_date_window(args),
+        pivot_strategy=args.pivot,
+        threads=args.threads,
+        memory_limit=args.memory_limit,
+        temp_directory=args.temp_dir,
+        overwrite=args.overwrite,
+        min_key_occurrences=args.min_key_occurrences,
+        max_keys=args.max_keys,
+        pivot_arrays=args.pivot_arrays,
+    )
+    print(json.dumps(written, indent=2))
+    return 0
+
+def command_export(args):
+    from ga4export import export_view
+
+    project_id, dataset_id = args.target
+    client = make_client(project_id, args.credentials)
+    credentials = make_credentials(args.credentials)
+    written = {}
+    for view_name in args.views:
+        written[view_name] = export_view(
+            client, project_id, dataset_id, view_name, args.output_dir,
+            date_window=get_date_window(args),
+            utc_ts=args.timezone,
+            max_streams=args.streams,
+            overwrite=args.overwrite,
+            credentials=credentials,
+        )
+    print(json.dumps(written, indent=2))
+    return 0
+
+def add_window_arguments(command):
+    command.add_argument("--timezone", default="UTC", help="timezone for event_timezone and rolling windows, e.g. Pacific/Auckland")
+    window = command.add_mutually_exclusive_group()
+    window.add_argument("--days", type=int, help="rolling window of the last N days, including today")
+    window.add_argument("--start", help="first shard date, YYYYMMDD")
+    command.add_argument("--end", help="last shard date, YYYYMMDD")
+
+def add_common_arguments(command):
+    add_window_arguments(command)
+    command.add_argument("--pivot", default="unnest", choices=["unnest", "subquery"])
+    command.add_argument("--min-key-occurrences", type=int, help="only give event_params keys seen at least this often their own column")
+    command.add_argument("--max-keys", type=int, help="only give the N most frequent event_params keys their own column")
+    command.add_argument("--pivot-arrays", nargs="+", default=[], choices=["user_properties", "item_params", "audiences"], help="also give every key of these arrays its own column, found in the same scan as the event_params keys")
+
+def add_pipeline_arguments(command):
+    command.add_argument("targets", nargs="*", type=parse_target, help="project.dataset of each GA4 export")
+    command.add_argument("--targets-file", help="file with one project.dataset per line")
+    command.add_argument("--credentials", help="service account JSON key, instead of GOOGLE_APPLICATION_CREDENTIALS")
+    add_common_arguments(command)
+    command.add_argument("--event-mode", default="view", choices=["view", "materialized"])
+    command.add_argument("--user-mode", default="view", choices=["view", "materialized"])
+    command.add_argument("--rollups", action="store_true", help="also maintain the daily rollup tables for dashboards")
+    command.add_argument("--column-profiles", nargs="+", default=[], choices=["core", "acquisition", "ecommerce", "full"], help="also build a narrower event_table_view_PROFILE with only these dimensions")
+    command.add_argument("--event-name-views", nargs="+", default=[], metavar="EVENT_NAME", help="also build an EVENT_NAME_event_view for each of these event names, e.g. purchase, with only the params that event carries")
+    command.add_argument("--sample-percent", type=float, help="profile a sample of materialized tables, for the data quality checks only: no columns are dropped from a sample")
+    command.add_argument("--jobs-per-target", type=int, default=4, help="BigQuery jobs at the same time for each target")
+    command.add_argument("--cache-dir", help="keep each dataset's shard catalog here between runs, same as GA4TOBQ_CACHE_DIR")
+    command.add_argument("--job-log", help="append every BigQuery job's statistics to this JSON lines file, job_stats.jsonl by default, empty to turn off")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ga4tobq", description="Flatten GA4 BigQuery exports into reportable views")
+    parser.add_argument("--log-file", help="log here instead of stderr")
+    parser.add_argument("--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="build the views for one or more GA4 datasets")
+    add_pipeline_arguments(run)
+    run.add_argument("--budget-gb", type=float, help="pick the widest window that fits and stop once the run has billed this many GB")
+    run.add_argument("--workers", type=int, default=4, help="targets processed at the same time")
+    run.add_argument("--report", help="write the JSON report here instead of stdout")
+    run.set_defaults(handler=command_run)
+
+    watch = commands.add_parser("watch", help="keep the views of GA4 datasets refreshed as new shards land")
+    add_pipeline_arguments(watch)
+    watch.add_argument("--interval", type=int, default=300, help="seconds between polls of each dataset's shards")
+    watch.add_argument("--max-backoff", type=int, default=3600, help="longest wait in seconds between retries of a failing dataset")
+    watch.add_argument("--health-port", type=int, help="serve GET /health on this port")
+    watch.add_argument("--lock-dir", default=".", help="lock files here keep two watchers from refreshing the same dataset at once")
+    watch.set_defaults(handler=command_watch)
+
+    flatten = commands.add_parser("flatten", help="flatten a GA4 export saved as Parquet or Avro files, without BigQuery")
+    flatten.add_argument("shard_dir", help="directory of shard files named like the tables, e.g. events_20261017.parquet")
+    flatten.add_argument("output_dir", help="flattened Parquet is written here, partitioned by date")
+    add_common_arguments(flatten)
+    flatten.add_argument("--threads", type=int, help="duckdb threads, all cores by default")
+    flatten.add_argument("--memory-limit", help="duckdb memory limit, e.g. 4GB, larger days spill to --temp-dir")
+    flatten.add_argument("--temp-dir", help="where duckdb spills when over --memory-limit")
+    flatten.add_argument("--overwrite", action="store_true", help="rewrite partitions that are already there")
+    flatten.set_defaults(handler=command_flatten)
+
+    export = commands.add_parser("export", help="stream flattened views or tables to local Parquet, partitioned by date")
+    export.add_argument("target", type=parse_target, help="project.dataset the views were built in")
+    export.add_argument("views", nargs="+", help="e.g. event_table_view, item_table_view_mini, user_table_view")
+    export.add_argument("--output-dir", required=True, help="one directory per view is written here")
+    export.add_argument("--credentials", help="service account JSON key, instead of GOOGLE_APPLICATION_CREDENTIALS")
+    add_window_arguments(export)
+    export.add_argument("--streams", type=int, default=4, help="read streams per partition, each writes its own file")
+    export.add_argument("--overwrite", action="store_true", help="export partitions that are already there again")
+    export.set_defaults(handler=command_export)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        filename=args.log_file,
+        format='%(asctime)s %(threadName)s %(name)s - %(levelname)s - %(message)s',
+        force=True,
+    )
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
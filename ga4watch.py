@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import re
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ga4jobs import DONE, run_jobs, select_jobs
+from ga4pipeline import build_pipeline_jobs, get_table_patterns, summarize_jobs
+from ga4queries import get_shard_catalog
+from ga4telemetry import format_bytes, summarize_job_records
+
+# Keeps GA4 datasets refreshed as GA4 writes new shards, without anyone opening the app.
+#
+#   python ga4tobq.py watch my-project.analytics_123456 --interval 300 --health-port 8080
+#
+# Every --interval seconds each target's shard catalog is read from __TABLES__, which is metadata only, and compared
+# with the last one that was refreshed. New, restated or dropped daily event shards rerun key discovery, the event and
+# item steps and profiling; user snapshots the user step and profiling. Intraday shards, which streaming rewrites
+# every few minutes, only refresh the event and item tables and the rollups, with the keys and profile of the last
+# daily change. Steps nothing changed for keep their result from the previous refresh. A failed poll or refresh is retried with exponential backoff. A refresh holds a lock
+# file per target, so two watchers of the same dataset take turns, and GET /health reports every target as JSON.
+
+# The steps rerun when a shard of each kind is new, changed or gone. Steps the pipeline wasn't built with
+# (rollups, column profiles, event name views) are left out.
+REFRESH_STEPS = {
+    "events": ["Key discovery", "Event table", "Ecommerce check", "Item table", "Summary statistics", "Event table mini", "Item table mini", "Event profiles", "Event name views", "Daily rollups"],
+    "intraday": ["Event table", "Item table", "Daily rollups"],
+    "users": ["User table", "Summary statistics", "User table mini", "Event table mini", "Item table mini"],
+}
+
+# The kind of every dated GA4 shard, by the table name before its date
+SHARD_KINDS = {"events": "events", "events_intraday": "intraday", "users": "users", "pseudonymous_users": "users"}
+
+DAILY_EVENT_SHARD = re.compile(r"^events_[0-9]{8}$")
+
+_health_lock = threading.Lock()
+
+class RefreshError(Exception):
+    # Some steps of a refresh did not finish
+    pass
+
+def get_shard_kind(table_id):
+    return SHARD_KINDS.get(table_id.rsplit("_", 1)[0])
+
+def get_changed_kinds(previous, catalog):
+    # Kinds of shard with a table that is new, restated or dropped since the previous catalog
+    changed = set()
+    for table_id in set(previous) | set(catalog):
+        if table_id in previous and table_id in catalog and previous[table_id]["last_modified_time"] == catalog[table_id]["last_modified_time"]:
+            continue
+        kind = get_shard_kind(table_id)
+        if kind:
+            changed.add(kind)
+    return changed
+
+def get_refresh_steps(changed_kinds, pivot_arrays=()):
+    steps = list(dict.fromkeys(step for kind in sorted(changed_kinds) for step in REFRESH_STEPS[kind]))
+    # Audiences are discovered from the user snapshots
+    if "users" in changed_kinds and "audiences" in pivot_arrays and "Key discovery" not in steps:
+        steps.append("Key discovery")
+    return steps
+
+def get_backoff_seconds(failures, interval, max_backoff):
+    # Seconds to the next poll: the interval, doubled for every failure in a row up to max_backoff
+    return min(interval * 2 ** failures, max_backoff) if failures else interval
+
+@contextmanager
+def target_lock(lock_dir, project_id, dataset_id):
+    # Yields whether the target's lock was free and is now held. Nobody waits for it, a refresh that finds it
+    # taken tries again at the next poll.
+    import fcntl
+
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{project_id}.{dataset_id}.lock"), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def update_health(health, target, **fields):
+    with _health_lock:
+        health.setdefault(target, {}).update(fields)
+
+def refresh_target(client, project_id, dataset_id, catalog, changed_kinds, previous_results, utc_ts="UTC", max_workers=4, options=None):
+    # Rerun the steps changed_kinds feed, with everything else taken from previous_results, which is updated with
+    # what finished. Returns the summary of the steps that ran and the bytes they billed.
+    options = options or {}
+    daily_shards = sorted(table_id for table_id in catalog if DAILY_EVENT_SHARD.match(table_id))
+    if not daily_shards:
+        raise RefreshError("There is no daily events shard yet")
+    known_users = any(table_id.startswith("users_") for table_id in catalog)
+    event_table_patterns, user_table_pattern, userid_sub = get_table_patterns(known_users)
+
+    job_records = []
+    jobs = build_pipeline_jobs(client, project_id, dataset_id, event_table_patterns, user_table_pattern, userid_sub, utc_ts, daily_shards[-1], job_records=job_records, **options)
+    steps = get_refresh_steps(changed_kinds, options.get("pivot_arrays", ()))
+    jobs = select_jobs(jobs, steps, previous_results)
+    logging.info(f"Refreshing {', '.join(name for name in jobs if name in steps)} of {project_id}.{dataset_id} for changed {', '.join(sorted(changed_kinds))} shards")
+    status = run_jobs(jobs, max_workers=max_workers)
+    previous_results.update({name: entry["result"] for name, entry in status.items() if entry["status"] == DONE})
+
+    totals = summarize_job_records(job_records)
+    bytes_billed = sum(step["bytes_billed"] for step in totals.values())
+    failed = [name for name, entry in status.items() if entry["status"] != DONE]
+    if failed:
+        raise RefreshError(f"Steps did not finish: {', '.join(failed)}")
+    return {"steps": summarize_jobs(status), "bytes_billed": bytes_billed}
+
+def watch_target(client, project_id, dataset_id, health, stop, interval=300, max_backoff=3600, lock_dir=".", utc_ts="UTC", max_workers=4, options=None):
+    # Poll and refresh one target until stop is set. The first poll refreshes everything.
+    target = f"{project_id}.{dataset_id}"
+    refreshed_catalog = None
+    previous_results = {}
+    failures = 0
+    update_health(health, target, status="starting", failures=0)
+    while not stop.is_set():
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            catalog = get_shard_catalog(client, project_id, dataset_id, max_age_seconds=0)
+            changed_kinds = set(REFRESH_STEPS) if refreshed_catalog is None else get_changed_kinds(refreshed_catalog, catalog)
+            if changed_kinds:
+                with target_lock(lock_dir, project_id, dataset_id) as locked:
+                    if locked:
+                        update_health(health, target, status="refreshing", changed=sorted(changed_kinds))
+                        refresh = refresh_target(client, project_id, dataset_id, catalog, changed_kinds, previous_results, utc_ts, max_workers, options)
+                        refreshed_catalog = catalog
+                        update_health(health, target, last_refresh=now, last_refresh_steps=refresh["steps"], last_refresh_bytes_billed=refresh["bytes_billed"])
+                        logging.info(f"Refreshed {target}, {format_bytes(refresh['bytes_billed'])} billed")
+                    else:
+                        logging.info(f"{target} is being refreshed by another process, trying again at the next poll")
+            failures = 0
+            update_health(health, target, status="idle", failures=0, last_poll=now, last_success=now, last_error=None)
+        except Exception as e:
+            failures += 1
+            logging.error(f"Refreshing {target} failed ({failures} in a row): {e}")
+            update_health(health, target, status="failing", failures=failures, last_poll=now, last_error=str(e))
+        wait_seconds = get_backoff_seconds(failures, interval, max_backoff)
+        update_health(health, target, next_poll_in_seconds=wait_seconds)
+        stop.wait(wait_seconds)
+    update_health(health, target, status="stopped")
+
+def serve_health(health, port):
+    # GET /health: every target's state as JSON, 200 while no target is failing and 503 otherwise
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") not in ("", "/health"):
+                self.send_error(404)
+                return
+            with _health_lock:
+                healthy = all(entry.get("failures", 0) == 0 for entry in health.values())
+                body = json.dumps({"status": "ok" if healthy else "failing", "targets": health}, default=str).encode()
+            self.send_response(200 if healthy else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f"Health check from {self.client_address[0]}: {format % args}")
+
+    server = ThreadingHTTPServer(("", port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    logging.info(f"Health endpoint on port {server.server_port}")
+    return server
+
+def watch(targets, stop, health_port=None, **kwargs):
+    # Watch every (client, project_id, dataset_id) in targets, each on its own thread, until stop is set.
+    # kwargs go to watch_target.
+    health = {}
+    server = serve_health(health, health_port) if health_port is not None else None
+    threads = [
+        threading.Thread(target=watch_target, args=(client, project_id, dataset_id, health, stop), kwargs=kwargs, name=f"watch {project_id}.{dataset_id}")
+        for client, project_id, dataset_id in targets
+    ]
+    for thread in threads:
+        thread.start()
+    # Joined with a timeout so the main thread stays free to handle signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=1)
+    if server:
+        server.shutdown()
+    return health
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A BigQuery client for the materialized tables that runs the generated SQL on synthetic shards with duckdb, the
+# way ga4local does. Tables it creates are real duckdb tables, so one test can run several refreshes against them.
+
+PROJECT_ID = "local"
+DATASET_ID = "local"
+END_DATE = date(2026, 10, 17)
+
+# How duckdb spells the column types BigQuery reports for a table
+BIGQUERY_TYPES = {"BIGINT": "INTEGER", "DOUBLE": "FLOAT", "VARCHAR": "STRING", "BOOLEAN": "BOOLEAN", "DATE": "DATE", "TIMESTAMP WITH TIME ZONE": "TIMESTAMP"}
+
+class LocalJob:
+    def __init__(self, rows, total_bytes_processed=0):
+        self.rows = rows
+        self.job_id = "local"
+        self.location = "local"
+        self.statement_type = None
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_processed
+        self.slot_millis = 0
+        self.cache_hit = False
+        self.query_plan = []
+        self.started = self.ended = None
+
+    def result(self):
+        return self.rows
+
+class LocalClient:
+    def __init__(self, shard_dir):
+        from ga4local import connect, list_shards
+
+        self.con = connect()
+        self.shards = list_shards(shard_dir)
+        self.labels = {}
+        # Every statement run, in duckdb SQL, for tests that check what a refresh did
+        self.statements = []
+        # Stand-ins for BigQuery's HyperLogLog sketches, exact counts are enough here
+        self.con.execute("CREATE SCHEMA hll_count")
+        self.con.execute("CREATE MACRO hll_count.init(value) AS count(DISTINCT value)")
+        self.con.execute("CREATE MACRO hll_count.extract(sketch) AS sketch")
+        self.con.execute("CREATE MACRO hll_count.merge(sketch) AS sum(sketch)")
+
+    def register_shards(self, query):
+        # A view over the shard files for every table the query reads that is a shard, not one of our own tables
+        from ga4local import TABLE_REFERENCE, generate_shard_view_query, generate_tables_view_query, match_table_reference
+
+        for table_name in sorted({match.group(3) for match in TABLE_REFERENCE.finditer(query)}):
+            if table_name == "__TABLES__":
+                self.con.execute(f'CREATE OR REPLACE VIEW "{table_name}" AS {generate_tables_view_query(self.shards)}')
+                continue
+            matched = match_table_reference(self.shards, table_name)
+            if matched:
+                self.con.execute(f'CREATE OR REPLACE VIEW "{table_name}" AS {generate_shard_view_query(table_name, matched)}')
+
+    def to_statements(self, query):
+        # The duckdb statements of a BigQuery script. duckdb takes one ALTER action per statement.
+        import sqlglot
+        from sqlglot import exp
+        from ga4local import TABLE_REFERENCE
+
+        local_query = TABLE_REFERENCE.sub(lambda match: f"`{match.group(3)}`", query)
+        statements = []
+        for statement in sqlglot.parse(local_query, read="bigquery"):
+            if statement is None:
+                continue
+            if isinstance(statement, exp.Alter) and len(statement.args["actions"]) > 1:
+                for action in statement.args["actions"]:
+                    single = statement.copy()
+                    single.set("actions", [action.copy()])
+                    statements.append(single.sql("duckdb"))
+                continue
+            statements.append(statement.sql("duckdb"))
+        return statements
+
+    def query(self, query, job_config=None):
+        if job_config is not None and job_config.dry_run:
+            return LocalJob([], len(query))
+        self.register_shards(query)
+        rows = []
+        for statement in self.to_statements(query):
+            self.statements.append(statement)
+            cursor = self.con.execute(statement)
+            if cursor.description:
+                names = [column[0] for column in cursor.description]
+                rows = [SimpleNamespace(**dict(zip(names, row))) for row in cursor.fetchall()]
+        return LocalJob(rows)
+
+    def get_table(self, table_id):
+        from google.api_core.exceptions import NotFound
+
+        table_name = table_id.split(".")[-1]
+        self.register_shards(f"`{PROJECT_ID}.{DATASET_ID}.{table_name}`")
+        found = self.con.execute("SELECT table_type FROM information_schema.tables WHERE table_name = ?", [table_name]).fetchone()
+        if not found:
+            raise NotFound(f"Not found: Table {table_id}")
+        schema = [
+            SimpleNamespace(name=row[0], field_type=BIGQUERY_TYPES.get(row[1], row[1]))
+            for row in self.con.execute(f'DESCRIBE "{table_name}"').fetchall()
+        ]
+        return SimpleNamespace(schema=schema, table_type="VIEW" if found[0] == "VIEW" else "TABLE", labels=self.labels.get(table_name, {}))
+
+    def create_table(self, table):
+        from ga4local import to_duckdb_sql
+
+        self.con.execute(f'CREATE OR REPLACE VIEW "{table.table_id}" AS {to_duckdb_sql(table.view_query)}')
+        self.labels[table.table_id] = dict(table.labels)
+        return table
+
+    def update_table(self, table, fields):
+        return self.create_table(table)
+
+    def table_suffixes(self, table_name):
+        # The days a materialized table has rows for
+        rows = self.con.execute(f"SELECT DISTINCT strftime(event_partition_date, '%Y%m%d') FROM \"{table_name}\"").fetchall()
+        return sorted(row[0] for row in rows)
+
+    def state_suffixes(self, table_name):
+        from ga4queries import SHARD_STATE_TABLE
+
+        rows = self.con.execute(f"SELECT DISTINCT shard_suffix, config FROM \"{SHARD_STATE_TABLE}\" WHERE target_table = ?", [table_name]).fetchall()
+        return sorted(rows)
+
+@pytest.fixture(scope="session")
+def shard_dir(tmp_path_factory):
+    pytest.importorskip("duckdb")
+    from ga4synth import generate_export
+
+    shard_dir = tmp_path_factory.mktemp("shards")
+    generate_export(str(shard_dir), days=3, events_per_day=300, users=40, param_keys=6, intraday_days=0, end_date=END_DATE)
+    return str(shard_dir)
+
+@pytest.fixture
+def local_client(shard_dir, monkeypatch):
+    # A fresh database over the shared shards, with the shard catalog already fetched so no __TABLES__ read is needed
+    pytest.importorskip("sqlglot")
+    pytest.importorskip("google.cloud.bigquery")
+    import ga4queries
+
+    monkeypatch.setenv("GA4TOBQ_JOB_LOG", "")
+    monkeypatch.delenv("GA4TOBQ_CACHE_DIR", raising=False)
+    client = LocalClient(shard_dir)
+    catalog = {
+        table_id: {"row_count": 0, "size_bytes": os.path.getsize(path), "last_modified_time": 1}
+        for table_id, path in client.shards.items()
+    }
+    monkeypatch.setattr(ga4queries, "_shard_catalogs", {(PROJECT_ID, DATASET_ID): (time.time(), catalog)})
+    yield client
+    client.con.close()
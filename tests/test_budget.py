@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from ga4telemetry import BudgetExceededError, UNESTIMATED_BUDGET_SHARE, byte_budget, recording, run_query_job
+
+MB = 1024**2
+
+class BudgetJob:
+    def __init__(self, total_bytes_processed, total_bytes_billed=0):
+        self.job_id = "budget"
+        self.location = "local"
+        self.statement_type = "SELECT"
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_billed
+        self.slot_millis = 0
+        self.cache_hit = False
+        self.query_plan = []
+        self.started = self.ended = None
+
+    def result(self):
+        return []
+
+class BudgetClient:
+    # Dry runs estimate {query: bytes}, a query missing from it can't be dry run. Jobs bill billed[query], or their
+    # estimate, and take a moment so the ones started side by side overlap.
+    def __init__(self, estimates, billed=None):
+        self.estimates = estimates
+        self.billed = billed or {}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak_running = 0
+        self.caps = {}
+
+    def query(self, query, job_config=None):
+        if job_config.dry_run:
+            if query not in self.estimates:
+                raise ValueError(f"{query} can't be dry run")
+            return BudgetJob(self.estimates[query])
+        with self.lock:
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+            self.caps[query] = job_config.maximum_bytes_billed
+        time.sleep(0.2)
+        with self.lock:
+            self.running -= 1
+        return BudgetJob(self.estimates.get(query, 0), self.billed.get(query, self.estimates.get(query, 0)))
+
+def run_side_by_side(client, budget, queries, delays=None):
+    # {query: error or None} for queries run on their own threads, like ga4jobs runs independent steps
+    errors = {}
+    def run(query):
+        time.sleep((delays or {}).get(query, 0))
+        try:
+            with recording([], step=query, budget=budget):
+                run_query_job(client, query, name=query)
+            errors[query] = None
+        except BudgetExceededError as e:
+            errors[query] = e
+    threads = [threading.Thread(target=run, args=(query,)) for query in queries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return errors
+
+@pytest.fixture(autouse=True)
+def no_job_log(monkeypatch):
+    pytest.importorskip("google.cloud.bigquery")
+    monkeypatch.setenv("GA4TOBQ_JOB_LOG", "")
+
+def test_jobs_wait_for_reservations_instead_of_failing():
+    # Each job is capped at about 43 MB, two fit in the budget at a time
+    queries = [f"query {i}" for i in range(4)]
+    client = BudgetClient({query: 30 * MB for query in queries}, {query: 5 * MB for query in queries})
+    budget = byte_budget(100 * MB)
+
+    assert run_side_by_side(client, budget, queries) == {query: None for query in queries}
+    assert client.peak_running == 2
+    assert budget["billed"] == 20 * MB
+    assert budget["reserved"] == 0
+
+def test_waiting_job_fails_once_what_was_billed_leaves_too_little():
+    client = BudgetClient({"first": 30 * MB, "second": 45 * MB}, {"first": 43 * MB})
+    budget = byte_budget(100 * MB)
+
+    errors = run_side_by_side(client, budget, ["first", "second"], {"second": 0.05})
+    assert errors["first"] is None
+    assert isinstance(errors["second"], BudgetExceededError)
+    assert budget["reserved"] == 0
+
+def test_job_over_the_budget_fails_at_once():
+    client = BudgetClient({"large": 95 * MB})
+    with pytest.raises(BudgetExceededError):
+        with recording([], budget=byte_budget(100 * MB)):
+            run_query_job(client, "large", name="large")
+    assert client.caps == {}
+
+def test_job_that_cant_be_dry_run_gets_a_share_of_the_budget():
+    client = BudgetClient({})
+    budget = byte_budget(100 * MB)
+    assert run_side_by_side(client, budget, ["script"]) == {"script": None}
+    assert client.caps["script"] == int(100 * MB * UNESTIMATED_BUDGET_SHARE)
@@ -0,0 +1,59 @@
+import ga4queries
+
+from conftest import DATASET_ID, PROJECT_ID
+from ga4pipeline import get_table_patterns
+
+EVENT_TABLE_PATTERNS, _, USERID_SUB = get_table_patterns(True)
+
+def refresh_event_table(client, keys_and_types, date_window=None):
+    return ga4queries.create_event_table_materialized(client, PROJECT_ID, DATASET_ID, EVENT_TABLE_PATTERNS, USERID_SUB, keys_and_types, "UTC", date_window=date_window)
+
+def restate(suffix):
+    # GA4 rewrote the day's shard, so the next refresh merges it again
+    catalog = ga4queries._shard_catalogs[(PROJECT_ID, DATASET_ID)][1]
+    catalog[f"events_{suffix}"]["last_modified_time"] += 1
+
+def column_types(client, table_name="event_table"):
+    return {field.name: field.field_type for field in client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{table_name}").schema}
+
+def test_key_type_flip_leaves_the_key_unpivoted(local_client):
+    # page_title was mostly numbers when the table was built, it is text now
+    merged = refresh_event_table(local_client, {"page_title": "int", "ga_session_id": "int"})
+    assert len(merged) == 3
+    assert column_types(local_client)["event_param_page_title"] == "INTEGER"
+
+    suffix = merged[-1]
+    restate(suffix)
+    assert refresh_event_table(local_client, {"page_title": "string", "ga_session_id": "int"}) == [suffix]
+
+    assert column_types(local_client)["event_param_page_title"] == "INTEGER"
+    pivoted, unpivoted, other = local_client.con.execute(f"""
+        SELECT COUNT(event_param_page_title), COUNTIF(event_params_other LIKE '%"page_title"%'), COUNTIF(event_params_other LIKE '%"ga_session_id"%')
+        FROM event_table WHERE event_partition_date = DATE '{suffix[:4]}-{suffix[4:6]}-{suffix[6:]}'
+    """).fetchone()
+    assert pivoted == 0
+    assert unpivoted > 0
+    assert other == 0
+
+def test_new_key_gets_a_column_without_merging_any_day(local_client):
+    merged = refresh_event_table(local_client, {"page_title": "string"})
+    rows = local_client.con.execute("SELECT COUNT(*) FROM event_table").fetchone()[0]
+
+    statements = len(local_client.statements)
+    assert refresh_event_table(local_client, {"page_title": "string", "page_location": "string"}) == []
+    assert not any(statement.startswith("MERGE") for statement in local_client.statements[statements:])
+    assert column_types(local_client)["event_param_page_location"] == "STRING"
+    assert "event_param_page_location" in column_types(local_client, "event_table_view")
+    # Days merged before the key was found keep its values in event_params_other
+    assert local_client.con.execute("SELECT COUNT(*), COUNT(event_param_page_location), COUNTIF(event_params_other LIKE '%\"page_location\"%') FROM event_table").fetchone() == (rows, 0, rows)
+
+    restate(merged[0])
+    assert refresh_event_table(local_client, {"page_title": "string", "page_location": "string"}) == [merged[0]]
+    filled = local_client.con.execute("SELECT DISTINCT strftime(event_partition_date, '%Y%m%d') FROM event_table WHERE event_param_page_location IS NOT NULL").fetchall()
+    assert filled == [(merged[0],)]
+
+def test_window_drops_days_it_no_longer_covers(local_client):
+    merged = refresh_event_table(local_client, {"page_title": "string"})
+    assert refresh_event_table(local_client, {"page_title": "string"}, {"suffixes": merged[1:]}) == []
+    assert local_client.table_suffixes("event_table") == merged[1:]
+    assert [suffix for suffix, _ in local_client.state_suffixes("event_table")] == merged[1:]
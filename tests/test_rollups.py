@@ -0,0 +1,39 @@
+import ga4queries
+
+from conftest import DATASET_ID, PROJECT_ID
+from ga4pipeline import get_table_patterns
+
+EVENT_TABLE_PATTERNS, _, _ = get_table_patterns(True)
+
+def refresh_rollups(client, date_window=None, drop_outside_window=True):
+    return ga4queries.create_rollup_tables(client, PROJECT_ID, DATASET_ID, EVENT_TABLE_PATTERNS, date_window=date_window, drop_outside_window=drop_outside_window)
+
+def test_version_bump_with_a_narrower_window_rebuilds_only_the_window(local_client, monkeypatch):
+    merged = refresh_rollups(local_client)["daily_event_rollup"]
+    assert len(merged) == 3
+
+    monkeypatch.setattr(ga4queries, "ROLLUP_VERSION", ga4queries.ROLLUP_VERSION + 1)
+    window = {"suffixes": merged[1:]}
+    statements = len(local_client.statements)
+    assert refresh_rollups(local_client, window) == {"daily_event_rollup": merged[1:], "daily_item_rollup": merged[1:]}
+    assert sum(statement.startswith("CREATE OR REPLACE TABLE") for statement in local_client.statements[statements:]) == 2
+
+    config = f"rollup_v{ga4queries.ROLLUP_VERSION}"
+    for table_name in ("daily_event_rollup", "daily_item_rollup"):
+        assert local_client.table_suffixes(table_name) == merged[1:]
+        # The old version's days outside the window are forgotten too, not left for the next run to find
+        assert local_client.state_suffixes(table_name) == [(suffix, config) for suffix in merged[1:]]
+
+    statements = len(local_client.statements)
+    assert refresh_rollups(local_client, window) == {"daily_event_rollup": [], "daily_item_rollup": []}
+    assert not any(statement.startswith(("CREATE OR REPLACE TABLE", "MERGE")) for statement in local_client.statements[statements:])
+
+def test_window_drops_days_unless_narrowed_for_a_budget(local_client):
+    merged = refresh_rollups(local_client)["daily_event_rollup"]
+
+    refresh_rollups(local_client, {"suffixes": merged[1:]}, drop_outside_window=False)
+    assert local_client.table_suffixes("daily_event_rollup") == merged
+
+    refresh_rollups(local_client, {"suffixes": merged[1:]})
+    assert local_client.table_suffixes("daily_event_rollup") == merged[1:]
+    assert [suffix for suffix, _ in local_client.state_suffixes("daily_event_rollup")] == merged[1:]